@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""asyncio通知客户端
+
+在asyncio服务中直接发送通知，不需要run_in_executor和线程：
+
+    async with AsyncNotifyClient() as client:
+        status = await client.send("部署完成")
+
+客户端与服务器保持持久的流式连接（与服务器之间转发使用的协议相同），
+多条消息按flush_interval合并成一帧发送，同一连接上可以同时有多帧等待确认。
+错误以NotifyError的子类抛出，而不是打印错误信息。
+"""
+
+import asyncio
+import json
+
+from send import ConfigError, get_servers, get_tls_context, read_client_config
+
+# 流式连接握手，后面可跟空格和客户端令牌，以换行结束
+STREAM_HANDSHAKE = b'NOTIFYPY-STREAM/1'
+
+__all__ = [
+    'AsyncNotifyClient', 'NotifyError', 'ConfigError', 'ConnectionFailed',
+    'Unauthorized', 'Throttled', 'AckTimeout', 'ProtocolError', 'ClientClosed'
+]
+
+class NotifyError(Exception):
+    """发送通知失败的基类"""
+
+class ConnectionFailed(NotifyError):
+    """无法连接服务器，或连接在收到确认前断开"""
+    def __init__(self, server, reason):
+        super().__init__(f"{server[0]}:{server[1]} 连接失败: {reason}")
+        self.server = server
+        self.reason = reason
+
+class Unauthorized(NotifyError):
+    """服务器拒绝了客户端令牌"""
+    def __init__(self, server):
+        super().__init__(f"{server[0]}:{server[1]} 拒绝了客户端令牌")
+        self.server = server
+
+class Throttled(NotifyError):
+    """服务器持续限流，等待时间超过了max_wait"""
+    def __init__(self, server, retry_after):
+        super().__init__(f"{server[0]}:{server[1]} 服务器繁忙，消息被限流")
+        self.server = server
+        self.retry_after = retry_after
+
+class AckTimeout(NotifyError):
+    """在超时时间内没有收到服务器确认，消息可能已经送达"""
+
+class ProtocolError(NotifyError):
+    """服务器回复无法解析"""
+
+class ClientClosed(NotifyError):
+    """客户端已关闭"""
+
+class _StreamConnection:
+    """到一个服务器的持久流式连接，帧按序号等待确认"""
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.seq = 0
+        self.inflight = {}
+        self.closed = False
+        self.read_task = asyncio.get_running_loop().create_task(self._read_acks())
+
+    @classmethod
+    async def open(cls, server, config, timeout):
+        """连接服务器并发送握手"""
+        ssl_context = get_tls_context(config.get('tls_cafile', '')) if config.get('tls') else None
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(server[0], server[1], ssl=ssl_context,
+                                        server_hostname=server[0] if ssl_context else None),
+                timeout
+            )
+        except asyncio.TimeoutError:
+            raise ConnectionFailed(server, "连接超时") from None
+        except OSError as e:
+            raise ConnectionFailed(server, str(e)) from e
+
+        token = config.get('token', '')
+        writer.write(STREAM_HANDSHAKE + (b' ' + token.encode('utf-8') if token else b'') + b'\n')
+        return cls(server, reader, writer)
+
+    def send(self, items, futures):
+        """写入一帧，不等待确认；确认到达时设置futures的结果"""
+        self.seq += 1
+        self.inflight[self.seq] = futures
+        frame = {'seq': self.seq, 'messages': items}
+        self.writer.write(json.dumps(frame, ensure_ascii=False).encode('utf-8') + b'\n')
+
+    async def _read_acks(self):
+        """读取确认帧直到连接关闭"""
+        error = None
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    error = ConnectionFailed(self.server, "服务器关闭了连接")
+                    break
+                if line.startswith(b'Unauthorized'):
+                    error = Unauthorized(self.server)
+                    break
+
+                try:
+                    reply = json.loads(line.decode('utf-8'))
+                    futures = self.inflight.pop(reply['ack'])
+                except (ValueError, KeyError, TypeError):
+                    error = ProtocolError(f"无法解析服务器回复: {line[:100]!r}")
+                    break
+                # 被限流的帧没有送达，结果带上服务器要求的等待时间
+                result = (reply.get('status', 'accepted'), reply.get('retry_after'))
+                for future in futures:
+                    if not future.done():
+                        future.set_result(result)
+        except (OSError, asyncio.IncompleteReadError) as e:
+            error = ConnectionFailed(self.server, str(e))
+        finally:
+            self.closed = True
+            self._fail_inflight(error or ClientClosed("连接已关闭"))
+            self.writer.close()
+
+    def _fail_inflight(self, error):
+        """连接断开时让所有未确认的消息失败"""
+        for futures in self.inflight.values():
+            for future in futures:
+                if not future.done():
+                    future.set_exception(error)
+        self.inflight.clear()
+
+    async def close(self):
+        """关闭连接，未确认的消息以ClientClosed失败"""
+        self.writer.close()
+        self.read_task.cancel()
+        try:
+            await self.read_task
+        except asyncio.CancelledError:
+            pass
+        self._fail_inflight(ClientClosed("客户端已关闭"))
+
+class _ServerPool:
+    """一个服务器的连接池，负责把消息合并成帧并分配到连接"""
+    def __init__(self, server, config, size, batch_size, flush_interval, timeout):
+        self.server = server
+        self.config = config
+        self.size = size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.timeout = timeout
+        self.connections = []
+        self.pending = []
+        self.wakeup = asyncio.Event()
+        self.full = asyncio.Event()
+        self.flush_task = asyncio.get_running_loop().create_task(self._run())
+
+    def submit(self, message, options):
+        """把消息加入下一帧，返回等待确认的future"""
+        future = asyncio.get_running_loop().create_future()
+        item = {'message': message}
+        if options:
+            item['options'] = options
+        self.pending.append((item, future))
+        self.wakeup.set()
+        if len(self.pending) >= self.batch_size:
+            self.full.set()
+        return future
+
+    def flush(self):
+        """不再等待凑满一帧，立即发送已缓冲的消息"""
+        if self.pending:
+            self.full.set()
+
+    async def _run(self):
+        """发送循环：等待一帧凑满或到达flush_interval后写入连接"""
+        while True:
+            await self.wakeup.wait()
+            if len(self.pending) < self.batch_size:
+                try:
+                    await asyncio.wait_for(self.full.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            self.wakeup.clear()
+            self.full.clear()
+
+            while self.pending:
+                batch = self.pending[:self.batch_size]
+                del self.pending[:self.batch_size]
+                futures = [future for _, future in batch]
+                try:
+                    connection = await self._acquire()
+                    connection.send([item for item, _ in batch], futures)
+                    await connection.writer.drain()
+                except NotifyError as e:
+                    self._fail(futures, e)
+                except OSError as e:
+                    self._fail(futures, ConnectionFailed(self.server, str(e)))
+
+    @staticmethod
+    def _fail(futures, error):
+        for future in futures:
+            if not future.done():
+                future.set_exception(error)
+
+    async def _acquire(self):
+        """选择等待确认最少的连接，都在忙且未达到连接数上限时新建连接"""
+        self.connections = [connection for connection in self.connections if not connection.closed]
+        idle = min(self.connections, key=lambda connection: len(connection.inflight), default=None)
+        if idle is not None and (not idle.inflight or len(self.connections) >= self.size):
+            return idle
+
+        connection = await _StreamConnection.open(self.server, self.config, self.timeout)
+        self.connections.append(connection)
+        return connection
+
+    async def close(self):
+        """停止发送循环并关闭所有连接"""
+        self.flush_task.cancel()
+        try:
+            await self.flush_task
+        except asyncio.CancelledError:
+            pass
+        self._fail([future for _, future in self.pending], ClientClosed("客户端已关闭"))
+        self.pending = []
+        for connection in self.connections:
+            await connection.close()
+        self.connections = []
+
+class AsyncNotifyClient:
+    """asyncio通知客户端。
+
+    send()返回服务器的确认状态'accepted'、'queued'（消息只进入了转发队列、摘要或计划发送）、
+    'expired'（消息已过期被丢弃）、'full'（服务器计划发送的消息已达上限）
+    或'duplicate'（服务器上已有相同schedule_id的计划消息，新消息未保存），
+    失败时抛出NotifyError的子类。服务器限流时按确认中的retry_after等待后自动重发，
+    累计等待超过max_wait秒时抛出Throttled。服务器列表、令牌和TLS设置与send.py共用
+    client_config.json；failover模式按配置顺序尝试服务器（只在连接失败或持续限流时换下一个），fanout模式发送到所有服务器，
+    至少一个确认即视为成功。
+    """
+    def __init__(self, config=None, config_file=None, pool_size=2, batch_size=50,
+                 flush_interval=0.01, timeout=10.0, max_wait=30.0):
+        # 配置在构造时读取，文件损坏时抛出ConfigError
+        self.config = dict(config) if config is not None else read_client_config(config_file)
+        self.servers = get_servers(self.config)
+        self.pool_size = max(1, int(pool_size))
+        self.batch_size = max(1, int(batch_size))
+        self.flush_interval = float(flush_interval)
+        self.timeout = float(timeout)
+        self.max_wait = float(max_wait)
+        self.pools = {}
+        self.outstanding = set()
+        self.closed = False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def _pool(self, server):
+        """获取服务器的连接池，第一次使用时创建"""
+        pool = self.pools.get(server)
+        if pool is None:
+            pool = _ServerPool(server, self.config, self.pool_size, self.batch_size,
+                               self.flush_interval, self.timeout)
+            self.pools[server] = pool
+        return pool
+
+    async def _send_to(self, server, message, options):
+        """发送到一个服务器并返回确认状态，被限流时按retry_after等待后重发"""
+        waited = 0.0
+        while True:
+            status, retry_after = await self._await_ack(self._pool(server).submit(message, options))
+            if status != 'throttled':
+                return status
+            retry_after = float(retry_after or 1.0)
+            if waited + retry_after > self.max_wait:
+                raise Throttled(server, retry_after)
+            await asyncio.sleep(retry_after)
+            waited += retry_after
+
+    async def _await_ack(self, future):
+        """等待一条消息的确认，返回(状态, 限流等待秒数)"""
+        self.outstanding.add(future)
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except asyncio.TimeoutError:
+            raise AckTimeout(f"{self.timeout:g}秒内没有收到服务器确认") from None
+        finally:
+            self.outstanding.discard(future)
+
+    async def send(self, message, priority=None, deliver_at=None, delay=None, expire_at=None, schedule_id=None):
+        """发送一条消息并等待服务器确认，返回确认状态。
+        
+        deliver_at、expire_at为Unix时间戳，delay为秒数，服务器保存消息直到发送时间；
+        schedule_id可用于之后通过send.MessageSender.cancel()取消。
+        """
+        if self.closed:
+            raise ClientClosed("客户端已关闭")
+        if not message:
+            raise ValueError("消息内容不能为空")
+        options = {key: value for key, value in (('priority', priority), ('deliver_at', deliver_at),
+                                                   ('delay', delay), ('expire_at', expire_at),
+                                                   ('schedule_id', schedule_id)) if value} or None
+
+        if self.config.get('delivery_mode') == 'fanout' and len(self.servers) > 1:
+            results = await asyncio.gather(
+                *(self._send_to(server, message, options) for server in self.servers),
+                return_exceptions=True
+            )
+            statuses = [result for result in results if not isinstance(result, BaseException)]
+            if statuses:
+                for status in ('accepted', 'queued', 'expired'):
+                    if status in statuses:
+                        return status
+                return statuses[0]
+            raise results[0]
+
+        error = None
+        for server in self.servers:
+            try:
+                return await self._send_to(server, message, options)
+            except (ConnectionFailed, Throttled) as e:
+                # 连接失败或服务器繁忙时依次尝试下一个服务器，令牌被拒绝等直接抛出
+                error = e
+        raise error
+
+    async def send_many(self, messages, priority=None, deliver_at=None, delay=None, expire_at=None):
+        """并发发送多条消息，它们会合并成尽量少的帧，返回各条消息的确认状态"""
+        return await asyncio.gather(*(self.send(message, priority, deliver_at, delay, expire_at)
+                                      for message in messages))
+
+    async def flush(self):
+        """立即发送所有缓冲的消息并等待已发送消息的确认"""
+        for pool in self.pools.values():
+            pool.flush()
+        if self.outstanding:
+            await asyncio.wait(list(self.outstanding), timeout=self.timeout)
+
+    async def close(self):
+        """发送缓冲的消息后关闭所有连接"""
+        if self.closed:
+            return
+        await self.flush()
+        self.closed = True
+        for pool in self.pools.values():
+            await pool.close()
+        self.pools = {}
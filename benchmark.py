@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(script_dir)
+import send
+from server import MessageReceiver
+
+class BenchConfig:
+    """In-memory configuration shared by the benchmark server and client"""
+    def __init__(self, config):
+        self.config = config
+
+class NullSink:
+    """Delivery sink that discards messages"""
+    def update_status(self, message):
+        pass
+    
+    def add_log_message(self, message):
+        pass
+    
+    def show_notification(self, message):
+        pass
+
+def generate_certificates(directory):
+    """Create a throwaway CA and a server certificate for 127.0.0.1 with openssl"""
+    ca_key = os.path.join(directory, 'ca.key')
+    ca_cert = os.path.join(directory, 'ca.pem')
+    server_key = os.path.join(directory, 'server.key')
+    server_csr = os.path.join(directory, 'server.csr')
+    server_cert = os.path.join(directory, 'server.pem')
+    extensions = os.path.join(directory, 'server.ext')
+    
+    with open(extensions, 'w') as f:
+        f.write("subjectAltName=IP:127.0.0.1\n")
+    
+    commands = [
+        ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-keyout', ca_key,
+         '-out', ca_cert, '-days', '1', '-subj', '/CN=NotifyPy Bench CA'],
+        ['openssl', 'req', '-newkey', 'rsa:2048', '-nodes', '-keyout', server_key,
+         '-out', server_csr, '-subj', '/CN=127.0.0.1'],
+        ['openssl', 'x509', '-req', '-in', server_csr, '-CA', ca_cert, '-CAkey', ca_key,
+         '-CAcreateserial', '-out', server_cert, '-days', '1', '-extfile', extensions],
+    ]
+    for command in commands:
+        subprocess.run(command, check=True, capture_output=True)
+    return ca_cert, server_cert, server_key
+
+def time_sends(sender, count, forget_sessions=False):
+    """Average milliseconds per send_message() call"""
+    start = time.perf_counter()
+    for i in range(count):
+        if forget_sessions:
+            send._tls_sessions.clear()
+        success, response = sender.send_message(f"benchmark message {i}")
+        if not success:
+            raise RuntimeError(response)
+    return (time.perf_counter() - start) * 1000 / count
+
+def bench_tls(args):
+    """Compare plaintext sends with full and resumed TLS handshakes.
+    
+    Every send in a mode runs in this process, so the resumed numbers apply to
+    long-lived clients; separate send.py invocations always do a full handshake.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        if args.certfile:
+            ca_cert, server_cert, server_key = args.cafile, args.certfile, args.keyfile
+        else:
+            ca_cert, server_cert, server_key = generate_certificates(directory)
+        
+        results = []
+        for label, tls, forget_sessions in [
+            ("plaintext", False, False),
+            ("TLS full handshake", True, True),
+            ("TLS resumed session", True, False),
+        ]:
+            server_config = BenchConfig({
+                'host': '127.0.0.1',
+                'port': args.port,
+                'max_connections': 128,
+                'tls_certfile': server_cert if tls else '',
+                'tls_keyfile': server_key if tls else '',
+            })
+            receiver = MessageReceiver(server_config, NullSink())
+            success, message = receiver.start()
+            if not success:
+                raise RuntimeError(message)
+            
+            try:
+                client_config = BenchConfig({
+                    'server_ip': '127.0.0.1',
+                    'server_port': args.port,
+                    'tls': tls,
+                    'tls_cafile': ca_cert,
+                })
+                sender = send.MessageSender(client_config)
+                
+                # Warm up, this also caches the first TLS session
+                time_sends(sender, 5)
+                results.append((label, time_sends(sender, args.count, forget_sessions)))
+            finally:
+                receiver.stop()
+        
+        print(f"{'mode':<24}{'ms/message':>12}")
+        for label, milliseconds in results:
+            print(f"{label:<24}{milliseconds:>12.3f}")
+
+def run_curl(url, count, data, content_type):
+    """POST data to url count times from one curl process, reusing one keep-alive connection"""
+    lines = ['silent', f'header = "Content-Type: {content_type}"', f'data-binary = {json.dumps(data)}']
+    lines.extend(f'url = "{url}"' for _ in range(count))
+    result = subprocess.run(['curl', '--config', '-'], input='\n'.join(lines) + '\n',
+                            capture_output=True, text=True, check=True)
+    accepted = result.stdout.count('"status"')
+    if accepted != count:
+        raise RuntimeError(f"Only {accepted} of {count} requests succeeded: {result.stdout[-200:]}")
+
+def bench_http(args):
+    """Measure HTTP ingest throughput with curl over a keep-alive connection"""
+    if shutil.which('curl') is None:
+        raise SystemExit("curl is required for the http benchmark")
+    
+    server_config = BenchConfig({
+        'host': '127.0.0.1',
+        'port': args.port,
+        'http_port': args.http_port,
+        'max_connections': 128,
+    })
+    receiver = MessageReceiver(server_config, NullSink())
+    success, message = receiver.start()
+    if not success:
+        raise RuntimeError(message)
+    
+    url = f"http://127.0.0.1:{args.http_port}/notify"
+    try:
+        # Warm up
+        run_curl(url, 10, "warm up", 'text/plain')
+        
+        results = []
+        start = time.perf_counter()
+        run_curl(url, args.count, "benchmark message", 'text/plain')
+        elapsed = time.perf_counter() - start
+        results.append(("single POST, keep-alive", args.count / elapsed))
+        
+        batch = json.dumps([f"benchmark message {i}" for i in range(args.batch)])
+        requests = max(1, args.count // args.batch)
+        start = time.perf_counter()
+        run_curl(url, requests, batch, 'application/json')
+        elapsed = time.perf_counter() - start
+        results.append((f"batch POST of {args.batch}", requests * args.batch / elapsed))
+    finally:
+        receiver.stop()
+    
+    print(f"{'mode':<28}{'messages/s':>12}")
+    for label, rate in results:
+        print(f"{label:<28}{rate:>12.0f}")
+
+def main():
+    parser = argparse.ArgumentParser(description='NotifyPy benchmarks')
+    subparsers = parser.add_subparsers(dest='command')
+    
+    tls_parser = subparsers.add_parser('tls', help='Compare plaintext, full TLS and resumed TLS send latency within one process')
+    tls_parser.add_argument('--count', type=int, default=200, help='Messages per mode')
+    tls_parser.add_argument('--port', type=int, default=5999, help='Port of the temporary server')
+    tls_parser.add_argument('--certfile', help='Server certificate (default: generate one with openssl)')
+    tls_parser.add_argument('--keyfile', help='Server private key')
+    tls_parser.add_argument('--cafile', help='CA certificate that signed --certfile')
+    
+    http_parser = subparsers.add_parser('http', help='Measure HTTP ingest throughput with curl')
+    http_parser.add_argument('--count', type=int, default=5000, help='Messages per mode')
+    http_parser.add_argument('--batch', type=int, default=100, help='Messages per batch POST')
+    http_parser.add_argument('--port', type=int, default=5999, help='Socket port of the temporary server')
+    http_parser.add_argument('--http-port', type=int, default=5998, help='HTTP port of the temporary server')
+    
+    args = parser.parse_args()
+    if args.command == 'tls':
+        bench_tls(args)
+    elif args.command == 'http':
+        bench_http(args)
+    else:
+        parser.print_help()
+
+if __name__ == "__main__":
+    main()
@@ -5,13 +5,19 @@ import sys
 import os
 import subprocess
 import time
+import signal
+import select
+
+# 直通模式下保留的输出尾部字节数，仅用于生成失败通知
+TAIL_BYTES = 4096
+TAIL_LINES = 10
 
 # u5bfcu5165send.pyu4e2du7684u529fu80fd
 script_dir = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(script_dir)
 from send import NotifyClient
 
-def run_command_and_notify(command):
+def run_command_and_notify(command, attachments=None):
     """执行命令并在完成后发送通知"""
     start_time = time.time()
     
@@ -19,9 +25,6 @@ def run_command_and_notify(command):
     print(f"正在执行: {command}")
     
     try:
-        # 导入select模块用于非阻塞读取
-        import select
-        
         # 执行命令，实时显示输出
         process = subprocess.Popen(
             command, 
@@ -98,48 +101,182 @@ def run_command_and_notify(command):
         output = ''.join(all_output)
         error = ''.join(all_error)
     
-        # 计算执行时间
-        elapsed_time = time.time() - start_time
-        time_str = f"{elapsed_time:.2f}秒"
-        
-        # 准备通知消息
-        if success:
-            status = "成功"
-            message = f"命令已完成: {command} (用时: {time_str})"
+        notify_result(command, success, time.time() - start_time, error, attachments)
+    
+        # 返回原始命令的执行状态
+        return success
+    except Exception as e:
+        print(f"执行命令时发生错误: {str(e)}")
+        return False
+
+def notify_result(command, success, elapsed_time, error, attachments=None):
+    """打印执行结果并发送通知，attachments中命令结束时存在的文件会作为附件发送"""
+    time_str = f"{elapsed_time:.2f}秒"
+    
+    # 准备通知消息
+    if success:
+        status = "成功"
+        message = f"命令已完成: {command} (用时: {time_str})"
+    else:
+        status = "失败"
+        message = f"命令执行失败: {command} (用时: {time_str})\n错误: {error}"
+
+    # 打印命令执行结果
+    print(f"命令{status}执行完毕。用时: {time_str}")
+    
+    # 直接使用NotifyClient发送通知
+    client = NotifyClient()
+    
+    # 打印当前服务器地址和端口
+    server_ip = client.config_manager.config['server_ip']
+    server_port = client.config_manager.config['server_port']
+    print(f"发送通知到服务器: {server_ip}:{server_port}")
+    
+    # 附件通常由命令生成（如测试报告、图表），结束时不存在的跳过
+    existing = []
+    for path in attachments or []:
+        if os.path.isfile(path):
+            existing.append(path)
         else:
-            status = "失败"
-            message = f"命令执行失败: {command} (用时: {time_str})\n错误: {error}"
+            print(f"附件不存在，已跳过: {path}")
+    
+    client.send_message(message, attachments=existing)
+
+def _copy_winsize(src_fd, dst_fd):
+    """把终端窗口大小同步到伪终端"""
+    import fcntl, termios
+    try:
+        size = fcntl.ioctl(src_fd, termios.TIOCGWINSZ, b'\0' * 8)
+        fcntl.ioctl(dst_fd, termios.TIOCSWINSZ, size)
+    except OSError:
+        pass
+
+def _make_controlling_tty():
+    """子进程中执行：新建会话并把伪终端设为控制终端，使Ctrl-C等信号正常传递"""
+    import fcntl, termios
+    os.setsid()
+    fcntl.ioctl(0, termios.TIOCSCTTY, 0)
+
+def run_command_passthrough(command, attachments=None):
+    """在伪终端中执行命令，原始字节直接写到终端，只保留尾部用于通知
     
-        # 打印命令执行结果
-        print(f"命令{status}执行完毕。用时: {time_str}")
+    子进程看到的是终端，因此保留颜色、进度条和交互能力；
+    输出不做解码和逐行打印，只有最后TAIL_BYTES字节会在结束时解码。
+    """
+    import pty, tty, termios
+    start_time = time.time()
+    print(f"正在执行: {command}")
+    
+    try:
+        master_fd, slave_fd = pty.openpty()
+        stdin_fd = sys.stdin.fileno()
+        stdout_fd = sys.stdout.fileno()
+        interactive = os.isatty(stdin_fd)
+        if interactive:
+            _copy_winsize(stdin_fd, slave_fd)
         
-        # 直接使用NotifyClient发送通知
-        client = NotifyClient()
+        sys.stdout.flush()
+        process = subprocess.Popen(
+            command,
+            shell=True,
+            stdin=slave_fd,
+            stdout=slave_fd,
+            stderr=slave_fd,
+            preexec_fn=_make_controlling_tty,
+            close_fds=True
+        )
+        os.close(slave_fd)
         
-        # 打印当前服务器地址和端口
-        server_ip = client.config_manager.config['server_ip']
-        server_port = client.config_manager.config['server_port']
-        print(f"发送通知到服务器: {server_ip}:{server_port}")
+        # 终端设为原始模式，按键原样交给子进程的伪终端处理
+        saved_attrs = None
+        previous_winch = None
+        if interactive:
+            saved_attrs = termios.tcgetattr(stdin_fd)
+            tty.setraw(stdin_fd)
+            previous_winch = signal.signal(
+                signal.SIGWINCH, lambda signum, frame: _copy_winsize(stdin_fd, master_fd))
         
-        client.send_message(message)
-    
-        # 返回原始命令的执行状态
+        tail = bytearray()
+        inputs = [master_fd, stdin_fd]
+        try:
+            while True:
+                try:
+                    readable, _, _ = select.select(inputs, [], [])
+                except InterruptedError:
+                    continue
+                
+                if master_fd in readable:
+                    try:
+                        chunk = os.read(master_fd, 65536)
+                    except OSError:
+                        # 子进程关闭伪终端后Linux返回EIO
+                        chunk = b''
+                    if not chunk:
+                        break
+                    view = memoryview(chunk)
+                    while view:
+                        written = os.write(stdout_fd, view)
+                        view = view[written:]
+                    # 尾部采样：只保留最后TAIL_BYTES字节
+                    tail += chunk[-TAIL_BYTES:]
+                    if len(tail) > TAIL_BYTES:
+                        del tail[:-TAIL_BYTES]
+                
+                if stdin_fd in readable:
+                    data = os.read(stdin_fd, 4096)
+                    if data:
+                        os.write(master_fd, data)
+                    else:
+                        # 标准输入结束：发送EOF字符并停止转发
+                        inputs.remove(stdin_fd)
+                        os.write(master_fd, b'\x04')
+        finally:
+            if saved_attrs is not None:
+                termios.tcsetattr(stdin_fd, termios.TCSAFLUSH, saved_attrs)
+            if previous_winch is not None:
+                signal.signal(signal.SIGWINCH, previous_winch)
+            os.close(master_fd)
+        
+        success = (process.wait() == 0)
+        lines = tail.decode('utf-8', errors='replace').replace('\r', '').splitlines()
+        error = '\n'.join(lines[-TAIL_LINES:])
+        
+        notify_result(command, success, time.time() - start_time, error, attachments)
         return success
     except Exception as e:
         print(f"执行命令时发生错误: {str(e)}")
         return False
 
 def main():
-    if len(sys.argv) < 2:
-        print("用法: python notify.py <要执行的命令>")
+    # 解析notify.py自己的选项，第一个非选项参数开始是要执行的命令
+    args = sys.argv[1:]
+    passthrough = False
+    attachments = []
+    while args:
+        if args[0] in ('-p', '--passthrough'):
+            passthrough = True
+            args = args[1:]
+        elif args[0] in ('-a', '--attach') and len(args) > 1:
+            attachments.append(args[1])
+            args = args[2:]
+        else:
+            break
+    
+    if not args:
+        print("用法: python notify.py [-p|--passthrough] [-a|--attach 文件] <要执行的命令>")
         print("例如: python notify.py ls -la")
+        print("      python notify.py -p tar -xvf archive.tar  (在伪终端中运行，输出原样直通)")
+        print("      python notify.py -a report.png pytest  (命令结束后将report.png作为附件发送)")
         sys.exit(1)
     
     # 组合命令行参数为完整命令
-    command = " ".join(sys.argv[1:])
+    command = " ".join(args)
     
-    # 执行命令并发送通知
-    success = run_command_and_notify(command)
+    # 执行命令并发送通知；直通模式依赖伪终端，仅支持类Unix系统
+    if passthrough and os.name == 'posix':
+        success = run_command_passthrough(command, attachments)
+    else:
+        success = run_command_and_notify(command, attachments)
     
     # 返回与原始命令相同的退出状态
     sys.exit(0 if success else 1)
@@ -5,40 +5,206 @@ import socket
 import json
 import os
 import sys
+import re
+import ssl
+import time
+import uuid
 import argparse
+import datetime
+import threading
+
+# 服务器回复
+REPLY_QUEUED = "Message queued"
+REPLY_REJECTED = "Too many connections"
+REPLY_UNAUTHORIZED = "Unauthorized"
+REPLY_ATTACHMENT_TOO_LARGE = "Attachment too large"
+REPLY_BAD_ATTACHMENT = "Attachments not accepted"
+REPLY_EXPIRED = "Message expired"
+REPLY_SCHEDULE_FULL = "Too many scheduled messages"
+REPLY_NOT_SCHEDULED = "No such scheduled message"
+REPLY_SCHEDULE_ID_TAKEN = "Schedule id already in use"
+REPLY_TOO_LARGE = "Request too large"
+REPLY_MALFORMED = "Malformed request"
+THROTTLED_PATTERN = re.compile(r'^Throttled, retry after (\d+) ms')
+
+# 这些回复说明服务器繁忙，failover模式会换下一个服务器重试；
+# 其他拒绝（令牌、附件、过期、计划消息等）换服务器也不会成功，直接返回
+FAILOVER_STATUSES = ('rejected', 'throttled')
+
+# TLS上下文和会话按进程缓存，同一进程内再次连接同一服务器时恢复会话，省去完整握手。
+# 会话只在内存中：Python的ssl模块无法序列化会话，每次运行send.py/notify.py都是新进程，
+# 仍然进行完整握手；只有长时间运行的MessageSender、AsyncNotifyClient和转发服务器能恢复会话
+_tls_contexts = {}
+_tls_sessions = {}
+
+def get_tls_context(cafile=''):
+    """获取用于校验服务器证书的TLS上下文，cafile为空时使用系统CA"""
+    context = _tls_contexts.get(cafile)
+    if context is None:
+        context = ssl.create_default_context(cafile=cafile or None)
+        _tls_contexts[cafile] = context
+    return context
+
+def parse_reply(response):
+    """解析服务器回复，返回(状态, 重试等待秒数)。
+    
+    状态为accepted/queued/throttled/rejected/unauthorized/attachment/expired/full/duplicate/not_found/invalid
+    """
+    match = THROTTLED_PATTERN.match(response)
+    if match:
+        return 'throttled', int(match.group(1)) / 1000.0
+    if response.startswith(REPLY_UNAUTHORIZED):
+        return 'unauthorized', None
+    if response.startswith((REPLY_ATTACHMENT_TOO_LARGE, REPLY_BAD_ATTACHMENT)):
+        return 'attachment', None
+    if response.startswith(REPLY_REJECTED):
+        return 'rejected', None
+    if response.startswith(REPLY_EXPIRED):
+        return 'expired', None
+    if response.startswith(REPLY_SCHEDULE_FULL):
+        return 'full', None
+    if response.startswith(REPLY_SCHEDULE_ID_TAKEN):
+        return 'duplicate', None
+    if response.startswith((REPLY_TOO_LARGE, REPLY_MALFORMED)):
+        return 'invalid', None
+    if response.startswith(REPLY_NOT_SCHEDULED):
+        return 'not_found', None
+    if response.startswith(REPLY_QUEUED):
+        return 'queued', None
+    return 'accepted', None
+
+def summarize_results(results):
+    """汇总[(服务器, (是否成功, 回复)), ...]，返回(是否成功, 状态, 回复)。
+    
+    状态取自各服务器自己的回复：任一服务器已显示消息时为accepted，其次为queued和not_found，
+    所有服务器都失败时为None。只有一个结果时直接返回它的回复，多个结果时每行一个服务器。
+    """
+    statuses = {parse_reply(response)[0] for _, (ok, response) in results if ok}
+    status = next((status for status in ('accepted', 'queued', 'not_found') if status in statuses), None)
+    success = any(ok for _, (ok, _) in results)
+    if len(results) == 1:
+        return success, status, results[0][1][1]
+    
+    lines = [f"{ip}:{port} {'成功' if ok else '失败'}: {response}" for (ip, port), (ok, response) in results]
+    return success, status, '\n'.join(lines)
+
+DURATION_PATTERN = re.compile(r'^(\d+(?:\.\d+)?)([smhd]?)$')
+DURATION_UNITS = {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+def parse_duration(value):
+    """解析时长，如90、30s、5m、2h、1d，返回秒数"""
+    match = DURATION_PATTERN.match(value.strip().lower())
+    if not match:
+        raise ValueError(f"无法解析时长: {value}")
+    return float(match.group(1)) * DURATION_UNITS[match.group(2)]
+
+def parse_time(value, now=None):
+    """解析时间，返回Unix时间戳。
+    
+    支持Unix时间戳、"+时长"（如+10m）、"HH:MM[:SS]"（已过去则为明天）
+    以及"YYYY-MM-DD HH:MM[:SS]"等ISO格式的本地时间。
+    """
+    now = time.time() if now is None else now
+    value = value.strip()
+    if value.startswith('+'):
+        return now + parse_duration(value[1:])
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    
+    for time_format in ('%H:%M', '%H:%M:%S'):
+        try:
+            parsed = datetime.datetime.strptime(value, time_format).time()
+        except ValueError:
+            continue
+        today = datetime.datetime.fromtimestamp(now).date()
+        timestamp = datetime.datetime.combine(today, parsed).timestamp()
+        return timestamp if timestamp > now else timestamp + 86400
+    
+    try:
+        return datetime.datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise ValueError(f"无法解析时间: {value}") from None
+
+def format_time(timestamp):
+    """把Unix时间戳格式化为本地时间"""
+    return datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+
+class ConfigError(ValueError):
+    """客户端配置文件无法读取或格式错误"""
+
+class AttachmentTruncated(Exception):
+    """附件在发送过程中变得比信封中声明的大小还小"""
+    def __init__(self, name):
+        super().__init__(name)
+        self.name = name
+
+def default_config_file():
+    """默认配置文件路径：用户的.config目录"""
+    return os.path.join(os.path.expanduser('~'), '.config', 'notifypy', 'client_config.json')
+
+def default_client_config():
+    """客户端默认配置"""
+    return {
+        'server_ip': '127.0.0.1',
+        'server_port': 5000,
+        'token': '',  # 客户端令牌，服务器按令牌认证和限流
+        'tls': False,  # 是否使用TLS连接服务器
+        'tls_cafile': '',  # 校验服务器证书的CA文件，为空时使用系统CA
+        'servers': [],  # 多个服务器["ip:port", ...]，为空时使用server_ip和server_port
+        'delivery_mode': 'failover',  # failover: 依次尝试直到成功; fanout: 并发发送到所有服务器
+        'health_ttl': 60  # 失败的服务器在多少秒内排到最后尝试
+    }
+
+def read_client_config(config_file=None):
+    """读取客户端配置并补全默认值，同步和异步客户端共用。
+    
+    只读取文件，不创建目录也不打印；文件不存在时返回默认配置，
+    文件损坏时抛出ConfigError。
+    """
+    config_file = config_file or default_config_file()
+    config = default_client_config()
+    if not os.path.exists(config_file):
+        return config
+    
+    try:
+        with open(config_file, 'r', encoding='utf-8') as f:
+            loaded_config = json.load(f)
+    except (OSError, ValueError) as e:
+        raise ConfigError(f"加载配置文件失败: {e}") from e
+    if not isinstance(loaded_config, dict):
+        raise ConfigError(f"加载配置文件失败: {config_file} 不是JSON对象")
+    
+    # 确保所有默认配置项都存在
+    config.update(loaded_config)
+    return config
 
 class ConfigManager:
     """配置管理模块，用于保存和加载服务器IP和端口"""
-    def __init__(self):
-        # 使用用户的.config目录
-        config_dir = os.path.join(os.path.expanduser('~'), '.config', 'notifypy')
-        if not os.path.exists(config_dir):
-            os.makedirs(config_dir)
-        self.config_file = os.path.join(config_dir, 'client_config.json')
+    def __init__(self, config_file=None):
+        # 默认使用用户的.config目录，目录在第一次保存配置时创建
+        self.config_file = config_file or default_config_file()
         self.config = self.load_config()
     
     def load_config(self):
         """加载配置文件"""
-        default_config = {
-            'server_ip': '127.0.0.1',
-            'server_port': 5000
-        }
-        
-        if os.path.exists(self.config_file):
-            try:
-                with open(self.config_file, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-            except Exception as e:
-                print(f"加载配置文件失败: {e}")
-                return default_config
-        return default_config
+        try:
+            return read_client_config(self.config_file)
+        except ConfigError as e:
+            print(e)
+            return default_client_config()
     
-    def save_config(self, server_ip, server_port):
-        """保存配置到文件"""
+    def save_config(self, server_ip, server_port, **options):
+        """保存配置到文件，options中值为None的项保持不变"""
         self.config['server_ip'] = server_ip
         self.config['server_port'] = int(server_port)
+        for key, value in options.items():
+            if value is not None:
+                self.config[key] = value
         
         try:
+            os.makedirs(os.path.dirname(self.config_file), exist_ok=True)
             with open(self.config_file, 'w', encoding='utf-8') as f:
                 json.dump(self.config, f, indent=4)
             return True
@@ -46,30 +212,279 @@ class ConfigManager:
             print(f"保存配置文件失败: {e}")
             return False
 
+def get_servers(config):
+    """从配置中获取服务器列表[(ip, port), ...]，未配置servers时使用server_ip和server_port"""
+    servers = []
+    for server in config.get('servers') or []:
+        if isinstance(server, dict):
+            servers.append((server['ip'], int(server['port'])))
+        else:
+            ip, _, port = str(server).rpartition(':')
+            servers.append((ip, int(port)))
+    return servers or [(config['server_ip'], int(config['server_port']))]
+
+class HealthTable:
+    """服务器健康状态缓存，记录每个服务器的往返时间和最近一次失败时间"""
+    def __init__(self, health_file=None):
+        self.health_file = health_file
+        self.lock = threading.Lock()
+        self.table = self.load()
+    
+    def load(self):
+        """加载健康状态文件"""
+        if self.health_file and os.path.exists(self.health_file):
+            try:
+                with open(self.health_file, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+            except Exception:
+                # 缓存损坏时重新记录即可
+                pass
+        return {}
+    
+    def save(self):
+        """保存健康状态文件，先写临时文件再替换，避免并发进程读到不完整内容"""
+        if not self.health_file:
+            return
+        try:
+            with self.lock:
+                data = json.dumps(self.table, indent=4)
+            os.makedirs(os.path.dirname(self.health_file), exist_ok=True)
+            temp_file = f"{self.health_file}.{os.getpid()}.tmp"
+            with open(temp_file, 'w', encoding='utf-8') as f:
+                f.write(data)
+            os.replace(temp_file, self.health_file)
+        except Exception:
+            # 健康状态只是优化，保存失败不影响发送
+            pass
+    
+    def record_success(self, server, rtt):
+        """记录发送成功及往返时间（秒）"""
+        with self.lock:
+            entry = self.table.setdefault(f"{server[0]}:{server[1]}", {})
+            entry['rtt'] = rtt
+            entry['last_success'] = time.time()
+            entry.pop('last_failure', None)
+    
+    def record_failure(self, server):
+        """记录发送失败"""
+        with self.lock:
+            entry = self.table.setdefault(f"{server[0]}:{server[1]}", {})
+            entry['last_failure'] = time.time()
+    
+    def order(self, servers, ttl):
+        """按健康状态排序：最近ttl秒内失败过的服务器排在最后，其余按往返时间从小到大"""
+        now = time.time()
+        with self.lock:
+            def sort_key(indexed):
+                index, server = indexed
+                entry = self.table.get(f"{server[0]}:{server[1]}", {})
+                failed = now - entry.get('last_failure', 0) < ttl
+                # 没有测量过的服务器保持配置中的顺序
+                return (failed, entry.get('rtt', float('inf')), index)
+            return [server for _, server in sorted(enumerate(servers), key=sort_key)]
+
 class MessageSender:
     """消息发送模块，通过socket发送消息到服务器"""
-    def __init__(self, config_manager):
+    def __init__(self, config_manager, max_retries=3, max_wait=30, health_table=None):
         self.config_manager = config_manager
+        # 服务器限流时的最大重试次数和累计等待秒数
+        self.max_retries = max_retries
+        self.max_wait = max_wait
+        
+        # 健康状态缓存与配置文件放在同一目录
+        if health_table is None:
+            config_file = getattr(config_manager, 'config_file', None)
+            health_file = os.path.join(os.path.dirname(config_file), 'health.json') if config_file else None
+            health_table = HealthTable(health_file)
+        self.health_table = health_table
+    
+    def send_message(self, message, priority=None, attachments=None, schedule=None):
+        """发送消息到服务器，返回(是否成功, 回复)"""
+        success, _, response = self.send_with_status([message], priority, attachments, schedule)
+        return success, response
+    
+    def send_messages(self, messages, priority=None, attachments=None, schedule=None):
+        """发送消息到配置的服务器。
+        
+        failover模式按健康状态依次尝试，直到有一个服务器成功；
+        fanout模式并发发送到所有服务器，至少一个成功即视为成功。
+        attachments为附件文件路径列表，随消息分块发送。
+        schedule为计划发送选项，可包含deliver_at、delay、expire_at和schedule_id，
+        服务器保存消息直到指定时间再显示。返回(是否成功, 回复)。
+        """
+        success, _, response = self.send_with_status(messages, priority, attachments, schedule)
+        return success, response
+    
+    def send_with_status(self, messages, priority=None, attachments=None, schedule=None):
+        """与send_messages相同，返回(是否成功, 状态, 回复)，状态见summarize_results()"""
+        options = dict(schedule or {})
+        if priority:
+            # high优先级的消息不会被服务器合并到摘要中
+            options['priority'] = priority
+        return self._send(messages, options, list(attachments or []))
+    
+    def cancel(self, schedule_id):
+        """取消计划发送的消息。
+        
+        不知道消息保存在哪个服务器上，因此发送到所有配置的服务器，
+        任一服务器取消成功即视为成功。返回(是否成功, 状态, 回复)，
+        所有连上的服务器都没有这条消息时状态为not_found。
+        """
+        config = self.config_manager.config
+        servers = get_servers(config)
+        results = self._fan_out(servers, [], {'cancel': schedule_id}, [])
+        self.health_table.save()
+        
+        _, status, response = summarize_results(results)
+        return status == 'accepted', status, response
     
-    def send_message(self, message):
-        """发送消息到服务器"""
-        server_ip = self.config_manager.config['server_ip']
-        server_port = self.config_manager.config['server_port']
+    def _send(self, messages, options, attachments):
+        """按发送模式发送到配置的服务器，返回(是否成功, 状态, 回复)"""
+        config = self.config_manager.config
+        servers = get_servers(config)
+        
+        if config.get('delivery_mode') == 'fanout' and len(servers) > 1:
+            results = self._fan_out(servers, messages, options, attachments)
+        else:
+            results = self._fail_over(servers, messages, options, attachments)
+        self.health_table.save()
+        return summarize_results(results)
+    
+    def _fail_over(self, servers, messages, options, attachments):
+        """按健康状态依次尝试服务器，只有连接失败或服务器繁忙时才换下一个，返回[(服务器, 结果), ...]"""
+        ttl = float(self.config_manager.config.get('health_ttl', 60))
+        results = []
+        for server in self.health_table.order(servers, ttl):
+            success, response, status = self._send_to(server, messages, options, attachments)
+            results.append((server, (success, response)))
+            if success or (status is not None and status not in FAILOVER_STATUSES):
+                # 只返回这个服务器的结果，前面失败的服务器已记录在健康状态中
+                return results[-1:]
+        return results
+    
+    def _fan_out(self, servers, messages, options, attachments):
+        """并发发送到所有服务器，返回[(服务器, 结果), ...]"""
+        results = {}
+        
+        def worker(server):
+            results[server] = self._send_to(server, messages, options, attachments)[:2]
+        
+        threads = [threading.Thread(target=worker, args=(server,)) for server in servers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return [(server, results[server]) for server in servers]
+    
+    def _send_to(self, server, messages, options, attachments=()):
+        """发送到一个服务器，服务器限流时按提示的时间退避后重试。
+        
+        返回(是否成功, 回复, 状态)，状态见parse_reply()，连接失败时为None。
+        """
+        waited = 0
+        for attempt in range(self.max_retries + 1):
+            start_time = time.time()
+            success, response = self._send_once(server, messages, options, attachments)
+            if not success:
+                self.health_table.record_failure(server)
+                return False, response, None
+            self.health_table.record_success(server, time.time() - start_time)
+            
+            status, retry_after = parse_reply(response)
+            if status == 'rejected':
+                return False, f"服务器拒绝连接: {response}", status
+            if status == 'unauthorized':
+                return False, "服务器拒绝了客户端令牌，请使用 config --token 设置正确的令牌", status
+            if status == 'attachment':
+                return False, f"服务器拒绝了附件（大小或数量超过限制）: {response}", status
+            if status == 'expired':
+                return False, "消息在送达前已过期", status
+            if status == 'full':
+                return False, f"服务器计划发送的消息已达上限: {response}", status
+            if status == 'duplicate':
+                return False, f"服务器上已有相同ID的计划消息，请换一个ID: {response}", status
+            if status == 'invalid':
+                return False, f"服务器无法处理该请求（消息过长或格式错误）: {response}", status
+            if status != 'throttled':
+                return True, response, status
+            
+            # 超过重试次数或等待时间上限则放弃
+            if attempt == self.max_retries or waited + retry_after > self.max_wait:
+                return False, f"服务器繁忙，消息被限流: {response}", status
+            time.sleep(retry_after)
+            waited += retry_after
+    
+    def _encode(self, messages, options=None, attachments=()):
+        """单条普通消息且未配置令牌时发送纯文本，否则发送JSON信封。
+        
+        options（如priority、deliver_at、cancel）作为信封的键发送。
+        attachments为[(文件名, 大小), ...]，信封中声明每个附件的文件名和大小，
+        附件内容紧跟在信封行之后发送。
+        """
+        token = self.config_manager.config.get('token', '')
+        if len(messages) == 1 and not token and not options and not attachments:
+            return messages[0].encode('utf-8')
+        
+        # "notifypy"必须是第一个键，服务器据此识别信封
+        envelope = {'notifypy': 1, 'messages': list(messages)}
+        if token:
+            envelope['token'] = token
+        envelope.update(options or {})
+        if attachments:
+            envelope['attachments'] = [{'name': name, 'size': size} for name, size in attachments]
+        return json.dumps(envelope, ensure_ascii=False).encode('utf-8') + b'\n'
+    
+    def _send_once(self, server, messages, options=None, attachments=()):
+        """建立一次连接发送消息并读取服务器回复"""
+        server_ip, server_port = server
         
         # 创建socket连接
         client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        files = []
         
         try:
+            # 附件的大小只取一次，之后正好发送声明的字节数，
+            # 文件在发送期间继续增长（如正在写入的日志）时多出的内容不发送
+            for path in attachments:
+                f = open(path, 'rb')
+                files.append((f, os.path.basename(path), os.fstat(f.fileno()).st_size))
+            
             # 设置连接超时时间
             client_socket.settimeout(5)
             # 连接服务器
             client_socket.connect((server_ip, server_port))
             
+            if self.config_manager.config.get('tls'):
+                # 有缓存的会话时恢复会话，避免完整握手
+                client_socket = get_tls_context(self.config_manager.config.get('tls_cafile', '')).wrap_socket(
+                    client_socket,
+                    server_hostname=server_ip,
+                    session=_tls_sessions.get((server_ip, server_port))
+                )
+            
             # 发送消息
-            client_socket.send(message.encode('utf-8'))
+            client_socket.sendall(self._encode(messages, options, [(name, size) for _, name, size in files]))
+            
+            # 分块发送附件，服务器拒绝时会提前关闭连接，此时仍读取它的回复
+            try:
+                for f, name, size in files:
+                    remaining = size
+                    while remaining:
+                        chunk = f.read(min(65536, remaining))
+                        if not chunk:
+                            # 文件在发送期间被截断，凑不足声明的大小，关闭连接让服务器放弃这次接收
+                            raise AttachmentTruncated(name)
+                        client_socket.sendall(chunk)
+                        remaining -= len(chunk)
+            except (BrokenPipeError, ConnectionResetError):
+                pass
             
             # 接收服务器确认
             response = client_socket.recv(1024).decode('utf-8')
+            
+            if isinstance(client_socket, ssl.SSLSocket):
+                # TLS 1.3的会话票据在握手后才到达，读到回复后再保存
+                _tls_sessions[(server_ip, server_port)] = client_socket.session
             client_socket.close()
             
             return True, response
@@ -77,9 +492,17 @@ class MessageSender:
             return False, "连接服务器超时，请检查网络或服务器是否启动"
         except ConnectionRefusedError:
             return False, "无法连接到服务器，请检查服务器是否启动"
+        except ssl.SSLError as e:
+            return False, f"TLS握手失败，请检查服务器证书和tls_cafile配置: {str(e)}"
+        except FileNotFoundError as e:
+            return False, f"附件不存在: {e.filename}"
+        except AttachmentTruncated as e:
+            return False, f"附件在发送过程中变小了，消息未发送: {e.name}"
         except Exception as e:
             return False, f"发送消息失败: {str(e)}"
         finally:
+            for f, _, _ in files:
+                f.close()
             client_socket.close()
 
 class NotifyClient:
@@ -89,30 +512,77 @@ class NotifyClient:
         self.config_manager = ConfigManager()
         self.message_sender = MessageSender(self.config_manager)
     
-    def send_message(self, message):
-        """发送消息"""
+    def send_message(self, message, priority=None, attachments=None, deliver_at=None, delay=None, expire_at=None):
+        """发送消息，可指定发送时间（deliver_at或delay秒后）和过期时间expire_at"""
         if not message:
             print("错误: 消息内容不能为空！")
             return False
         
-        print(f"正在发送消息到 {self.config_manager.config['server_ip']}:{self.config_manager.config['server_port']}...")
+        # 计划发送的消息带上ID，之后可以用cancel命令取消
+        schedule = {}
+        if deliver_at is not None:
+            schedule['deliver_at'] = deliver_at
+        if delay is not None:
+            schedule['delay'] = delay
+        if expire_at is not None:
+            schedule['expire_at'] = expire_at
+        if deliver_at is not None or delay is not None:
+            schedule['schedule_id'] = uuid.uuid4().hex[:12]
+        
+        for path in attachments or []:
+            if not os.path.isfile(path):
+                print(f"错误: 附件不存在: {path}")
+                return False
         
-        success, response = self.message_sender.send_message(message)
+        servers = ', '.join(f"{ip}:{port}" for ip, port in get_servers(self.config_manager.config))
+        print(f"正在发送消息到 {servers}...")
+        
+        success, status, response = self.message_sender.send_with_status([message], priority, attachments, schedule)
         
         if success:
-            print("消息发送成功！")
+            if '\n' in response:
+                # 多个服务器的发送结果
+                print(response)
+            if 'schedule_id' in schedule:
+                when = deliver_at if deliver_at is not None else time.time() + delay
+                print(f"消息将在 {format_time(when)} 发送，ID: {schedule['schedule_id']}")
+                print(f"取消发送: python send.py cancel {schedule['schedule_id']}")
+            elif status == 'queued':
+                print("消息已进入服务器队列。")
+            else:
+                print("消息发送成功！")
             return True
         else:
             print(f"发送失败: {response}")
             return False
     
-    def configure(self, ip=None, port=None):
+    def cancel(self, schedule_id):
+        """取消计划发送的消息"""
+        success, status, response = self.message_sender.cancel(schedule_id)
+        if '\n' in response:
+            print(response)
+        if success:
+            print(f"已取消计划发送的消息 {schedule_id}")
+        elif status == 'not_found':
+            print("取消失败: 服务器上没有这条计划消息，可能已经发送、过期或被取消")
+        else:
+            print(f"取消失败: {response}")
+        return success
+    
+    def configure(self, ip=None, port=None, token=None, tls=None, tls_cafile=None, servers=None, mode=None):
         """配置服务器设置"""
         # 如果没有提供参数，显示当前配置
-        if ip is None and port is None:
+        if all(value is None for value in (ip, port, token, tls, tls_cafile, servers, mode)):
             print(f"当前配置:")
             print(f"  服务器IP: {self.config_manager.config['server_ip']}")
             print(f"  服务器端口: {self.config_manager.config['server_port']}")
+            if self.config_manager.config.get('servers'):
+                print(f"  服务器列表: {', '.join(map(str, self.config_manager.config['servers']))}")
+                print(f"  发送模式: {self.config_manager.config.get('delivery_mode', 'failover')}")
+            print(f"  客户端令牌: {'已设置' if self.config_manager.config.get('token') else '未设置'}")
+            print(f"  TLS: {'启用' if self.config_manager.config.get('tls') else '未启用'}")
+            if self.config_manager.config.get('tls_cafile'):
+                print(f"  CA证书: {self.config_manager.config['tls_cafile']}")
             return True
         
         # 如果只提供了一个参数，使用当前配置的另一个参数
@@ -130,8 +600,22 @@ class NotifyClient:
             print("错误: 端口必须是1-65535之间的整数！")
             return False
         
+        # 验证服务器列表，格式为逗号分隔的ip:port，空字符串表示清空
+        if servers is not None:
+            servers = [server.strip() for server in servers.split(',') if server.strip()]
+            try:
+                get_servers({'servers': servers})
+            except ValueError:
+                print("错误: 服务器列表格式应为 ip:port,ip:port ！")
+                return False
+        
+        # CA文件保存为绝对路径，避免在其他目录运行时找不到
+        if tls_cafile:
+            tls_cafile = os.path.abspath(tls_cafile)
+        
         # 保存配置
-        if self.config_manager.save_config(ip, port):
+        if self.config_manager.save_config(ip, port, token=token, tls=tls, tls_cafile=tls_cafile,
+                                           servers=servers, delivery_mode=mode):
             print(f"配置已保存: 服务器 {ip}:{port}")
             return True
         else:
@@ -148,6 +632,11 @@ def main():
     config_parser = subparsers.add_parser('config', help='\u914d\u7f6e\u670d\u52a1\u5668\u8bbe\u7f6e')
     config_parser.add_argument('--ip', help='\u670d\u52a1\u5668IP\u5730\u5740')
     config_parser.add_argument('--port', type=int, help='\u670d\u52a1\u5668\u7aef\u53e3')
+    config_parser.add_argument('--token', help='\u5ba2\u6237\u7aef\u4ee4\u724c\uff0c\u670d\u52a1\u5668\u6309\u4ee4\u724c\u8ba4\u8bc1\u548c\u9650\u6d41')
+    config_parser.add_argument('--tls', action=argparse.BooleanOptionalAction, help='\u662f\u5426\u4f7f\u7528TLS\u8fde\u63a5\u670d\u52a1\u5668')
+    config_parser.add_argument('--tls-cafile', help='\u6821\u9a8c\u670d\u52a1\u5668\u8bc1\u4e66\u7684CA\u6587\u4ef6')
+    config_parser.add_argument('--servers', help='\u591a\u4e2a\u670d\u52a1\u5668\uff0c\u683c\u5f0f\u4e3aip:port,ip:port\uff0c\u7a7a\u5b57\u7b26\u4e32\u8868\u793a\u53ea\u4f7f\u7528--ip\u548c--port')
+    config_parser.add_argument('--mode', choices=['failover', 'fanout'], help='\u591a\u670d\u52a1\u5668\u53d1\u9001\u6a21\u5f0f\uff1afailover\u4f9d\u6b21\u5c1d\u8bd5\u76f4\u5230\u6210\u529f\uff0cfanout\u5e76\u53d1\u53d1\u9001\u5230\u6240\u6709\u670d\u52a1\u5668')
     
     # \u67e5\u770b\u914d\u7f6e\u547d\u4ee4
     subparsers.add_parser('show', help='\u67e5\u770b\u5f53\u524d\u914d\u7f6e')
@@ -155,9 +644,18 @@ def main():
     # \u53d1\u9001\u6d88\u606f\u547d\u4ee4
     send_parser = subparsers.add_parser('send', help='\u53d1\u9001\u901a\u77e5\u6d88\u606f')
     send_parser.add_argument('message', help='\u8981\u53d1\u9001\u7684\u6d88\u606f\u5185\u5bb9')
+    send_parser.add_argument('--priority', choices=['low', 'normal', 'high'], help='\u6d88\u606f\u4f18\u5148\u7ea7\uff0chigh\u4e0d\u4f1a\u88ab\u5408\u5e76\u5230\u6458\u8981\u4e2d')
+    send_parser.add_argument('--attach', action='append', metavar='FILE', help='\u9644\u4ef6\u6587\u4ef6\uff0c\u53ef\u591a\u6b21\u6307\u5b9a\uff0c\u56fe\u7247\u4f1a\u5728\u901a\u77e5\u7a97\u53e3\u4e2d\u663e\u793a\u7f29\u7565\u56fe')
+    send_parser.add_argument('--at', metavar='TIME', help='\u53d1\u9001\u65f6\u95f4\uff0c\u598218:30\u30012026-10-20 09:00\u3001Unix\u65f6\u95f4\u6233\u6216+10m\uff0c\u670d\u52a1\u5668\u4fdd\u5b58\u6d88\u606f\u5230\u8be5\u65f6\u95f4\u518d\u663e\u793a')
+    send_parser.add_argument('--delay', metavar='DURATION', help='\u5ef6\u8fdf\u53d1\u9001\uff0c\u598290\u300130s\u30015m\u30012h')
+    send_parser.add_argument('--expire', metavar='TIME', help='\u8fc7\u671f\u65f6\u95f4\uff0c\u683c\u5f0f\u540c--at\uff0c\u5230\u671f\u4ecd\u672a\u53d1\u9001\u7684\u6d88\u606f\u88ab\u4e22\u5f03')
+    
+    # \u53d6\u6d88\u8ba1\u5212\u6d88\u606f\u547d\u4ee4
+    cancel_parser = subparsers.add_parser('cancel', help='\u53d6\u6d88\u8ba1\u5212\u53d1\u9001\u7684\u6d88\u606f')
+    cancel_parser.add_argument('id', help='\u53d1\u9001\u65f6\u8f93\u51fa\u7684\u6d88\u606fID')
     
     # \u89e3\u6790\u53c2\u6570
-    if len(sys.argv) > 1 and sys.argv[1] not in ['config', 'show', 'send', '-h', '--help']:
+    if len(sys.argv) > 1 and sys.argv[1] not in ['config', 'show', 'send', 'cancel', '-h', '--help']:
         # \u5982\u679c\u7b2c\u4e00\u4e2a\u53c2\u6570\u4e0d\u662f\u5df2\u77e5\u547d\u4ee4\uff0c\u5219\u5c06\u5176\u89c6\u4e3a\u6d88\u606f\u5185\u5bb9
         args = parser.parse_args(['send'] + sys.argv[1:])
     else:
@@ -169,7 +667,7 @@ def main():
     # \u6839\u636e\u547d\u4ee4\u6267\u884c\u64cd\u4f5c
     if args.command == 'config':
         # \u914d\u7f6e\u547d\u4ee4
-        if client.configure(args.ip, args.port):
+        if client.configure(args.ip, args.port, args.token, args.tls, args.tls_cafile, args.servers, args.mode):
             sys.exit(0)
         else:
             sys.exit(1)
@@ -179,10 +677,21 @@ def main():
         sys.exit(0)
     elif args.command == 'send':
         # \u53d1\u9001\u6d88\u606f
-        if client.send_message(args.message):
+        try:
+            deliver_at = parse_time(args.at) if args.at else None
+            delay = parse_duration(args.delay) if args.delay else None
+            expire_at = parse_time(args.expire) if args.expire else None
+        except ValueError as e:
+            parser.error(str(e))
+        if deliver_at is not None and delay is not None:
+            parser.error('--at\u548c--delay\u4e0d\u80fd\u540c\u65f6\u4f7f\u7528')
+        if client.send_message(args.message, args.priority, args.attach, deliver_at, delay, expire_at):
             sys.exit(0)
         else:
             sys.exit(1)
+    elif args.command == 'cancel':
+        # \u53d6\u6d88\u8ba1\u5212\u53d1\u9001\u7684\u6d88\u606f
+        sys.exit(0 if client.cancel(args.id) else 1)
     else:
         # \u5982\u679c\u6ca1\u6709\u63d0\u4f9b\u4efb\u4f55\u53c2\u6570\uff0c\u663e\u793a\u5e2e\u52a9
         parser.print_help()
@@ -5,7 +5,28 @@ import socket
 import threading
 import json
 import os
+import sys
+import stat
 import time
+import argparse
+import queue
+import select
+import hashlib
+import uuid
+import collections
+import heapq
+import itertools
+import subprocess
+import math
+import urllib.parse
+import struct
+import ssl
+import sqlite3
+import multiprocessing
+import signal
+import traceback
+import tracemalloc
+import weakref
 import tkinter as tk
 from tkinter import font as tkfont
 from tkinter import ttk, messagebox
@@ -21,11 +42,324 @@ except ImportError:
     PUSHBULLET_AVAILABLE = False
     print("Pushbullet library not available. Mobile notifications will be disabled.")
 
+# Handshake line sent by servers opening a persistent forwarding stream
+# followed by an optional space and forward token, then a newline
+STREAM_HANDSHAKE = b'NOTIFYPY-STREAM/1'
+
+# Longest stream handshake and stream frame line accepted, in bytes
+STREAM_MAX_HANDSHAKE = 4096
+STREAM_MAX_FRAME = 16 * 1024 * 1024
+
+# Prefix of a JSON envelope message, clients always serialize the "notifypy" key first
+ENVELOPE_PREFIX = b'{"notifypy":'
+
+# Replies to plain and envelope clients
+REPLY_ACCEPTED = "Message received"
+REPLY_QUEUED = "Message queued"
+REPLY_THROTTLED = "Throttled, retry after {} ms"
+REPLY_UNAUTHORIZED = "Unauthorized"
+REPLY_ATTACHMENT_TOO_LARGE = "Attachment too large"
+REPLY_BAD_ATTACHMENT = "Attachments not accepted"
+REPLY_EXPIRED = "Message expired"
+REPLY_SCHEDULE_FULL = "Too many scheduled messages"
+REPLY_CANCELLED = "Message cancelled"
+REPLY_NOT_SCHEDULED = "No such scheduled message"
+REPLY_SCHEDULE_ID_TAKEN = "Schedule id already in use"
+REPLY_TOO_LARGE = "Request too large"
+REPLY_MALFORMED = "Malformed request"
+
+# Seconds a client waits before resending when the forwarding queue stays full
+FORWARD_RETRY_AFTER = 1.0
+
+# Envelope keys passed through to the delivery path with each message
+DELIVERY_OPTIONS = ('priority', 'deliver_at', 'delay', 'expire_at', 'schedule_id')
+
+# Delivery options consumed by the delivery scheduler, times are Unix timestamps
+SCHEDULE_OPTIONS = ('deliver_at', 'delay', 'expire_at', 'schedule_id')
+
+# HTTP ingest limits and status lines
+HTTP_MAX_HEADER_SIZE = 65536
+HTTP_DEFAULT_MAX_BODY = 1048576
+HTTP_REASONS = {
+    200: 'OK', 400: 'Bad Request', 401: 'Unauthorized', 404: 'Not Found', 405: 'Method Not Allowed',
+    409: 'Conflict', 413: 'Payload Too Large', 429: 'Too Many Requests', 431: 'Request Header Fields Too Large',
+    503: 'Service Unavailable'
+}
+
+
+class AttachmentError(Exception):
+    """An attachment that cannot be accepted, the message is the reply sent to the client"""
+
+class LineTooLong(Exception):
+    """A client sent more bytes than allowed without ending the line"""
+
+class AttachmentSpool:
+    """Spools attachment bytes received after an envelope to files on disk.
+    
+    Each attachment is streamed to its own file in chunks and hashed on the
+    way, the hash keys the thumbnail cache. The oldest files are removed
+    once the spool grows beyond max_total bytes.
+    """
+    def __init__(self, directory, max_size=0, max_count=0, max_total=0):
+        self.directory = directory
+        self.max_size = int(max_size)
+        self.max_count = int(max_count)
+        self.max_total = int(max_total)
+        self.lock = threading.Lock()
+    
+    @classmethod
+    def from_config(cls, config, base_dir):
+        """Create a spool from the attachment settings, relative paths are resolved against base_dir"""
+        directory = config.get('attachment_dir') or 'attachments'
+        if not os.path.isabs(directory):
+            directory = os.path.join(base_dir, directory)
+        return cls(
+            directory,
+            config.get('max_attachment_size', 0),
+            config.get('max_attachments', 0),
+            config.get('attachment_spool_size', 0)
+        )
+    
+    def validate(self, attachments):
+        """Check declared attachments before any bytes are read, returns [(name, size), ...]"""
+        if not isinstance(attachments, list):
+            raise AttachmentError(REPLY_BAD_ATTACHMENT)
+        if self.max_count and len(attachments) > self.max_count:
+            raise AttachmentError(REPLY_ATTACHMENT_TOO_LARGE)
+        
+        declared = []
+        for attachment in attachments:
+            try:
+                name = os.path.basename(str(attachment['name'])) or 'attachment'
+                size = int(attachment['size'])
+            except (KeyError, TypeError, ValueError):
+                raise AttachmentError(REPLY_BAD_ATTACHMENT) from None
+            if size < 0:
+                raise AttachmentError(REPLY_BAD_ATTACHMENT)
+            if self.max_size and size > self.max_size:
+                raise AttachmentError(REPLY_ATTACHMENT_TOO_LARGE)
+            declared.append((name, size))
+        return declared
+    
+    def receive(self, client_socket, buffer, declared, connection=None):
+        """Stream the declared attachments from buffer and the socket into the spool.
+        
+        Returns a list of {"name", "path", "size", "sha256"} dicts. Partially
+        written files are removed if the client disconnects early.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        spooled = []
+        try:
+            for name, size in declared:
+                path = os.path.join(self.directory, f"{uuid.uuid4().hex}-{name}")
+                digest = hashlib.sha256()
+                spooled.append({'name': name, 'path': path, 'size': size})
+                with open(path, 'wb') as f:
+                    remaining = size
+                    while remaining:
+                        if not buffer:
+                            buffer = client_socket.recv(min(remaining, 65536))
+                            if not buffer:
+                                raise AttachmentError(REPLY_BAD_ATTACHMENT)
+                            if connection is not None:
+                                connection.received(len(buffer))
+                        chunk, buffer = buffer[:remaining], buffer[remaining:]
+                        f.write(chunk)
+                        digest.update(chunk)
+                        remaining -= len(chunk)
+                spooled[-1]['sha256'] = digest.hexdigest()
+        except BaseException:
+            for attachment in spooled:
+                try:
+                    os.remove(attachment['path'])
+                except OSError:
+                    pass
+            raise
+        
+        # The files just received are about to be shown, even if they alone exceed max_total
+        self.prune(keep={attachment['path'] for attachment in spooled})
+        return spooled
+    
+    def prune(self, keep=()):
+        """Remove the oldest spooled files beyond max_total bytes, never the paths in keep"""
+        if not self.max_total:
+            return
+        with self.lock:
+            entries = []
+            total = 0
+            for entry in os.scandir(self.directory):
+                if entry.is_file():
+                    info = entry.stat()
+                    total += info.st_size
+                    if entry.path not in keep:
+                        entries.append((info.st_mtime, info.st_size, entry.path))
+            for _, size, path in sorted(entries):
+                if total <= self.max_total:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                except OSError:
+                    pass
+
+class ThumbnailCache:
+    """Two-level LRU cache of attachment thumbnails.
+    
+    Thumbnails are decoded from the full image once, saved as PNG files in
+    directory (bounded by max_disk bytes, least recently used removed first)
+    and kept in memory for the last max_memory lookups. Keys are the SHA-256
+    of the attachment, so identical images share one thumbnail. Windows use
+    get_async() so that decoding never runs on the Tk thread.
+    """
+    def __init__(self, directory, size=(160, 120), max_memory=64, max_disk=0):
+        self.directory = directory
+        self.size = tuple(size)
+        self.max_memory = int(max_memory)
+        self.max_disk = int(max_disk)
+        self.memory = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.requests = queue.Queue()
+        self.worker = None
+    
+    def get_async(self, attachment, callback):
+        """Look up a thumbnail without blocking the caller.
+        
+        Returns the image right away when it is held in memory. Otherwise
+        returns None and loads or decodes the thumbnail on the cache's worker
+        thread, which then calls callback(image) with None for non-images.
+        """
+        key = attachment.get('sha256')
+        if not key:
+            return None
+        
+        with self.lock:
+            image = self.memory.get(key)
+            if image is not None:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return image
+            if self.worker is None:
+                # One thread decodes at a time, so a burst of large images is not held in memory at once
+                self.worker = threading.Thread(target=self._work, name="notifypy-thumbnails", daemon=True)
+                self.worker.start()
+        self.requests.put((attachment, callback))
+        return None
+    
+    def _work(self):
+        """Worker thread serving get_async() requests in order"""
+        while True:
+            attachment, callback = self.requests.get()
+            try:
+                callback(self.get(attachment))
+            except Exception:
+                traceback.print_exc()
+    
+    def get(self, attachment):
+        """Return the thumbnail of an attachment as a PIL image, or None if it is not an image"""
+        key = attachment.get('sha256')
+        if not key:
+            return None
+        
+        with self.lock:
+            image = self.memory.get(key)
+            if image is not None:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return image
+        
+        path = os.path.join(self.directory, f"{key}-{self.size[0]}x{self.size[1]}.png")
+        image = None
+        if os.path.exists(path):
+            try:
+                with Image.open(path) as cached:
+                    image = cached.copy()
+                os.utime(path)  # Mark as recently used for pruning
+                self.disk_hits += 1
+            except (OSError, ValueError):
+                image = None
+        
+        if image is None:
+            try:
+                with Image.open(attachment['path']) as original:
+                    # draft() lets JPEG decode at a reduced scale
+                    original.draft('RGB', self.size)
+                    original.thumbnail(self.size)
+                    image = original.convert('RGBA')
+            except (OSError, ValueError, Image.DecompressionBombError):
+                # Not an image, or the spooled file was already pruned
+                return None
+            self.misses += 1
+            self._store(path, image)
+        
+        with self.lock:
+            self.memory[key] = image
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.max_memory:
+                self.memory.popitem(last=False)
+        return image
+    
+    def _store(self, path, image):
+        """Save a thumbnail to disk and prune the least recently used ones"""
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            temp_path = f"{path}.{threading.get_ident()}.tmp"
+            image.save(temp_path, 'PNG')
+            os.replace(temp_path, path)
+        except OSError:
+            return
+        
+        if not self.max_disk:
+            return
+        with self.lock:
+            entries = []
+            for entry in os.scandir(self.directory):
+                if entry.is_file() and entry.name.endswith('.png'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, old_path in sorted(entries):
+                if total <= self.max_disk:
+                    break
+                try:
+                    os.remove(old_path)
+                    total -= size
+                except OSError:
+                    pass
+    
+    def stats(self):
+        """Cache hit counters"""
+        with self.lock:
+            return {'memory_hits': self.hits, 'disk_hits': self.disk_hits, 'decoded': self.misses,
+                    'in_memory': len(self.memory)}
+
+# Attachments that a click opens in the default viewer once they decoded as images,
+# any other attachment only has its folder opened since it was sent over the network
+VIEWABLE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp')
+
+def open_path(path):
+    """Open a file or folder with the desktop's default application"""
+    if sys.platform.startswith('win'):
+        os.startfile(path)
+    elif sys.platform == 'darwin':
+        subprocess.Popen(['open', path])
+    else:
+        subprocess.Popen(['xdg-open', path])
 
 class NotificationWindow:
     """Notification window to display received messages"""
-    def __init__(self, message, parent=None):
+    # Windows whose Python objects are still alive, reported by the diagnostics
+    instances = weakref.WeakSet()
+    
+    def __init__(self, message, parent=None, attachments=None, thumbnails=None, received=None):
         self.message = message
+        self.received = received
+        self.attachments = attachments or []
+        self.thumbnails = thumbnails
+        self.photos = []  # PhotoImages must stay referenced while shown
+        NotificationWindow.instances.add(self)
         
         # Create window
         self.window = tk.Toplevel(parent)
@@ -37,7 +371,7 @@ class NotificationWindow:
         
         # Set window size and position (random position to avoid stacking)
         window_width = 400
-        window_height = 220
+        window_height = 220 + (150 if self.attachments else 0)
         x_position = random.randint(50, max(50, screen_width - window_width - 50))
         y_position = random.randint(50, max(50, screen_height - window_height - 50))
         
@@ -75,7 +409,7 @@ class NotificationWindow:
         title_label.pack(side=tk.LEFT)
         
         # Time label
-        current_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        current_time = datetime.datetime.fromtimestamp(self.received or time.time()).strftime("%Y-%m-%d %H:%M:%S")
         time_label = tk.Label(
             self.window,
             text=f"Received: {current_time}",
@@ -107,6 +441,9 @@ class NotificationWindow:
         message_text.insert(tk.END, self.message)
         message_text.config(state=tk.DISABLED)  # Set to read-only
         
+        if self.attachments:
+            self.setup_attachments(message_font)
+        
         # Bottom button frame
         button_frame = tk.Frame(self.window, bg="#2c3e50", pady=10)
         button_frame.pack(fill=tk.X)
@@ -128,36 +465,145 @@ class NotificationWindow:
         )
         close_button.pack()
     
+    def setup_attachments(self, label_font):
+        """Show attachments as thumbnails, or file names for other files.
+        
+        Clicking a file name opens the folder holding the file; only a
+        thumbnail of a file with one of the VIEWABLE_EXTENSIONS opens the file
+        itself, received files are never run.
+        """
+        attachment_frame = tk.Frame(self.window, bg="#2c3e50")
+        attachment_frame.pack(fill=tk.X, padx=15)
+        
+        for attachment in self.attachments[:4]:
+            # The file name is shown until the thumbnail is ready
+            label = tk.Label(
+                attachment_frame,
+                text=f"📎 {attachment['name']}\n{attachment['size'] // 1024 + 1} KB",
+                font=label_font,
+                bg="#34495e",
+                fg="#ecf0f1",
+                padx=8,
+                pady=8,
+                cursor="hand2"
+            )
+            label.bind("<Button-1>", lambda event, path=attachment['path']: open_path(os.path.dirname(path)))
+            label.pack(side=tk.LEFT, padx=(0, 8))
+            
+            if self.thumbnails is not None:
+                image = self.thumbnails.get_async(
+                    attachment,
+                    lambda image, label=label, path=attachment['path']: self.thumbnail_ready(label, image, path)
+                )
+                if image is not None:
+                    self.show_thumbnail(label, image, attachment['path'])
+        
+        if len(self.attachments) > 4:
+            tk.Label(attachment_frame, text=f"+{len(self.attachments) - 4}", font=label_font,
+                     bg="#2c3e50", fg="#ecf0f1").pack(side=tk.LEFT)
+    
+    def thumbnail_ready(self, label, image, path):
+        """Called on the thumbnail thread, hands the image to the Tk thread"""
+        if image is None:
+            return
+        try:
+            self.window.after(0, self.show_thumbnail, label, image, path)
+        except (tk.TclError, RuntimeError):
+            pass  # The window or the main loop is already gone
+    
+    def show_thumbnail(self, label, image, path):
+        """Replace an attachment's file name label with its thumbnail"""
+        try:
+            if not label.winfo_exists():
+                return
+            photo = ImageTk.PhotoImage(image, master=self.window)
+            label.configure(image=photo, bg="#2c3e50", padx=0, pady=0)
+            if path.lower().endswith(VIEWABLE_EXTENSIONS):
+                # The file decoded as an image, so its viewer can open it
+                label.bind("<Button-1>", lambda event: open_path(path))
+        except tk.TclError:
+            return
+        self.photos.append(photo)
+    
     def close(self):
         """Close notification window"""
-        self.window.destroy()
+        if self.is_open():
+            self.window.destroy()
+    
+    def is_open(self):
+        """Whether the window has not been closed yet"""
+        try:
+            return bool(self.window.winfo_exists())
+        except tk.TclError:
+            return False
+    
+    @classmethod
+    def live_count(cls):
+        """Number of notification windows not yet garbage collected"""
+        return len(cls.instances)
 
 class ServerConfig:
     """Server configuration management"""
-    def __init__(self):
-        self.config_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server_config.json')
+    def __init__(self, config_file=None):
+        # Defaults to server_config.json next to this script
+        self.config_file = config_file or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server_config.json')
         self.config = self.load_config()
     
-    def load_config(self):
-        """Load configuration"""
-        default_config = {
+    def default_config(self):
+        """Default configuration"""
+        return {
             'host': '0.0.0.0',  # Listen on all network interfaces
             'port': 5000,
             'max_connections': 10,
-            'pushbullet_token': ''  # Pushbullet access token, empty by default
+            'max_connections_per_ip': 20,  # Open connections allowed per client IP (0 = unlimited)
+            'idle_timeout': 60,  # Seconds without traffic before a connection is closed (0 = never)
+            'drain_timeout': 2.0,  # Seconds in-flight connections may take to finish when stopping
+            'ip_rate_limit': 5,  # Messages per second allowed per client IP (0 = unlimited)
+            'ip_rate_burst': 30,  # Messages a client IP may send in a burst
+            'token_rate_limit': 0,  # Messages per second allowed per client token (0 = unlimited)
+            'token_rate_burst': 30,  # Messages a client token may send in a burst
+            'auth_tokens': [],  # Client tokens accepted by the server (empty = no authentication)
+            'tls_certfile': '',  # Server certificate (PEM) enabling TLS, empty for plaintext
+            'tls_keyfile': '',  # Private key of the server certificate, if not in tls_certfile
+            'http_port': 0,  # Port of the HTTP ingest listener on the same address (0 = disabled)
+            'http_max_body': 1048576,  # Largest accepted HTTP request body and envelope line in bytes (0 = unlimited)
+            'workers': 1,  # Number of SO_REUSEPORT worker processes (1 = single process)
+            'upstreams': [],  # Upstream servers ("host:port") to forward received messages to
+            'forward_batch_size': 50,  # Maximum messages per forwarded batch
+            'forward_interval': 0.5,  # Seconds to wait for a batch to fill before forwarding
+            'forward_queue_size': 1000,  # Pending forwarded messages before clients are blocked
+            'forward_token': '',  # Token presented to upstream servers
+            'forward_tls': False,  # Connect to upstream servers with TLS
+            'forward_tls_cafile': '',  # CA certificate used to verify upstream servers (empty = system CAs)
+            'deliver_locally': True,  # Also show forwarded messages on this server
+            'digest_window': 0,  # Seconds to collect messages into one summary notification (0 = off)
+            'digest_max_messages': 0,  # Deliver the summary early after this many messages (0 = no limit)
+            'schedule_file': 'scheduled.jsonl',  # Journal of scheduled messages kept across restarts (empty = memory only)
+            'max_scheduled': 1000000,  # Scheduled messages held at once (0 = unlimited)
+            'history_file': 'history.db',  # SQLite database of received messages for the history browser (empty = off)
+            'history_max_messages': 1000000,  # Messages kept in the history, the oldest are deleted first (0 = unlimited)
+            'history_search_index': True,  # Keep a full-text index for searching the history
+            'control_socket': 'notifypy.sock',  # Local diagnostics control socket (empty = disabled)
+            'diagnostics_dir': 'diagnostics',  # Directory for profiles, memory snapshots and thread dumps
+            'attachment_dir': 'attachments',  # Directory received attachments are spooled to
+            'max_attachment_size': 20971520,  # Largest accepted attachment in bytes (0 = unlimited)
+            'max_attachments': 10,  # Attachments accepted per message (0 = unlimited)
+            'attachment_spool_size': 524288000,  # Bytes of attachments kept, the oldest are removed first (0 = unlimited)
+            'thumbnail_cache_dir': 'thumbnails',  # Directory of cached attachment thumbnails
+            'thumbnail_cache_size': 52428800,  # Bytes of thumbnails kept on disk (0 = unlimited)
+            'max_notification_windows': 20,  # Open notification windows kept, the oldest close first (0 = unlimited)
+            'log_max_lines': 1000,  # Lines kept in the log window (0 = unlimited)
+            'pushbullet_token': '',  # Pushbullet access token, empty by default
+            'watch_config': True  # Apply changes to the config file while the server is running
         }
         
+    def load_config(self):
+        """Load configuration"""
+        default_config = self.default_config()
+        
         if os.path.exists(self.config_file):
             try:
-                with open(self.config_file, 'r', encoding='utf-8') as f:
-                    loaded_config = json.load(f)
-                    
-                # 确保所有默认配置项都存在
-                for key, value in default_config.items():
-                    if key not in loaded_config:
-                        loaded_config[key] = value
-                        
-                return loaded_config
+                return self._read_config_file(default_config)
             except Exception as e:
                 print(f"Failed to load config file: {e}")
                 return default_config
@@ -166,6 +612,70 @@ class ServerConfig:
         self.save_config(default_config)
         return default_config
     
+    def _read_config_file(self, default_config):
+        """Read the config file, filling in missing keys from default_config"""
+        with open(self.config_file, 'r', encoding='utf-8') as f:
+            loaded_config = json.load(f)
+            
+        # 确保所有默认配置项都存在
+        for key, value in default_config.items():
+            if key not in loaded_config:
+                loaded_config[key] = value
+                
+        return loaded_config
+    
+    @staticmethod
+    def validate_config(config):
+        """Check configuration values, returns (valid, message)"""
+        try:
+            if not isinstance(config['host'], str):
+                raise ValueError("host must be a string")
+            if not 0 < int(config['port']) <= 65535:
+                raise ValueError("port must be between 1-65535")
+            if int(config['max_connections']) <= 0:
+                raise ValueError("max_connections must be positive")
+            if int(config['workers']) < 1:
+                raise ValueError("workers must be at least 1")
+            for key in ('max_connections_per_ip', 'idle_timeout', 'drain_timeout', 'ip_rate_limit',
+                        'ip_rate_burst', 'token_rate_limit', 'token_rate_burst', 'digest_window',
+                        'digest_max_messages', 'max_scheduled', 'history_max_messages'):
+                if float(config[key]) < 0:
+                    raise ValueError(f"{key} must not be negative")
+            if not isinstance(config['upstreams'], list):
+                raise ValueError("upstreams must be a list")
+            if not isinstance(config['auth_tokens'], list):
+                raise ValueError("auth_tokens must be a list")
+            for key in ('tls_certfile', 'tls_keyfile', 'forward_tls_cafile'):
+                if config[key] and not os.path.exists(config[key]):
+                    raise ValueError(f"{key} {config[key]} does not exist")
+            for address in config['upstreams']:
+                UpstreamForwarder._parse_address(address)
+        except (KeyError, TypeError, ValueError) as e:
+            return False, f"Invalid configuration: {e}"
+        return True, "Configuration is valid"
+    
+    def reload(self):
+        """Re-read the config file and swap in the new settings if they are valid.
+        
+        The whole dictionary is replaced at once, so readers see either the old
+        or the new settings. Returns (success, message, changed_keys).
+        """
+        try:
+            new_config = self._read_config_file(self.default_config())
+        except Exception as e:
+            return False, f"Failed to load config file: {e}", []
+        
+        valid, message = self.validate_config(new_config)
+        if not valid:
+            return False, message, []
+        
+        old_config = self.config
+        changed = sorted(key for key in set(old_config) | set(new_config)
+                         if old_config.get(key) != new_config.get(key))
+        if changed:
+            self.config = new_config
+        return True, f"Configuration reloaded, changed: {', '.join(changed) or 'nothing'}", changed
+    
     def save_config(self, config=None):
         """Save configuration"""
         if config is not None:
@@ -179,60 +689,2641 @@ class ServerConfig:
             print(f"Failed to save config file: {e}")
             return False
 
+class ConfigWatcher:
+    """Watches the config file and reloads it when it changes.
+    
+    Uses inotify on Linux and falls back to polling the file's modification
+    time elsewhere. Valid changes are passed to on_change(old_config, changed_keys)
+    after ServerConfig has swapped in the new settings.
+    """
+    # inotify event masks from <sys/inotify.h>
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    
+    def __init__(self, config, on_change, log, poll_interval=1.0):
+        self.config = config
+        self.on_change = on_change
+        self.log = log
+        self.poll_interval = poll_interval
+        self.inotify_fd = None
+        self.wake_reader = None
+        self.wake_writer = None
+        self.thread = None
+        self.last_stat = None
+    
+    def start(self):
+        """Start watching"""
+        self.inotify_fd = self._init_inotify()
+        self.last_stat = self._stat()
+        self.wake_reader, self.wake_writer = socket.socketpair()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+    
+    def stop(self):
+        """Stop watching"""
+        if self.thread is None:
+            return
+        self.wake_writer.send(b'\0')
+        self.thread.join(timeout=1.0)
+        self.thread = None
+        self.wake_reader.close()
+        self.wake_writer.close()
+        if self.inotify_fd is not None:
+            os.close(self.inotify_fd)
+            self.inotify_fd = None
+    
+    def _init_inotify(self):
+        """Watch the config directory with inotify, returns None if unavailable"""
+        try:
+            import ctypes
+            import ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                return None
+            
+            # Watch the directory, editors often replace the file instead of rewriting it
+            directory = os.path.dirname(self.config.config_file)
+            mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+            if libc.inotify_add_watch(fd, directory.encode(), mask) < 0:
+                os.close(fd)
+                return None
+            return fd
+        except (OSError, AttributeError):
+            return None
+    
+    def _stat(self):
+        """Modification time and size of the config file"""
+        try:
+            stat = os.stat(self.config.config_file)
+            return stat.st_mtime_ns, stat.st_size
+        except OSError:
+            return None
+    
+    def _config_file_changed(self):
+        """Read pending inotify events, or compare mtimes when polling"""
+        if self.inotify_fd is None:
+            current = self._stat()
+            changed = current is not None and current != self.last_stat
+            self.last_stat = current
+            return changed
+        
+        filename = os.path.basename(self.config.config_file)
+        changed = False
+        while True:
+            try:
+                data = os.read(self.inotify_fd, 4096)
+            except BlockingIOError:
+                return changed
+            
+            # struct inotify_event { int wd; uint32_t mask, cookie, len; char name[]; }
+            offset = 0
+            while offset < len(data):
+                _, _, _, name_length = struct.unpack_from('iIII', data, offset)
+                offset += struct.calcsize('iIII')
+                name = data[offset:offset + name_length].rstrip(b'\0').decode('utf-8', 'replace')
+                offset += name_length
+                if name == filename:
+                    changed = True
+    
+    def _run(self):
+        """Watch loop"""
+        sources = [self.wake_reader]
+        timeout = self.poll_interval
+        if self.inotify_fd is not None:
+            sources.append(self.inotify_fd)
+            timeout = None
+        
+        while True:
+            readable, _, _ = select.select(sources, [], [], timeout)
+            if self.wake_reader in readable:
+                return
+            if not self._config_file_changed():
+                continue
+            
+            old_config = self.config.config
+            success, message, changed = self.config.reload()
+            if not success:
+                self.log(f"Ignoring config file change: {message}")
+            elif changed:
+                self.log(message)
+                try:
+                    self.on_change(old_config, changed)
+                except Exception as e:
+                    self.log(f"Failed to apply configuration: {e}")
+
+def create_server_socket(host, port, backlog):
+    """Create a non-blocking listening socket with address and port reuse enabled"""
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    
+    # Set socket options to reuse address and port
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    
+    # On some platforms, SO_REUSEPORT might be needed as well (if available)
+    # This is not available on all systems, so we use try/except
+    try:
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    except (AttributeError, OSError):
+        # SO_REUSEPORT not available on this platform
+        pass
+    
+    # The accept loop waits in select(), so accept() itself must never block
+    server_socket.setblocking(False)
+    
+    # Bind address and port, then start listening
+    server_socket.bind((host, port))
+    server_socket.listen(backlog)
+    return server_socket
+
+class ClientConnection:
+    """Bookkeeping for one accepted client connection"""
+    def __init__(self, conn_id, client_socket, address):
+        self.conn_id = conn_id
+        self.socket = client_socket
+        self.address = address
+        self.connected_at = time.time()
+        self.last_activity = self.connected_at
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.messages = 0
+        self.is_stream = False
+        # An HTTP keep-alive connection waiting for its next request
+        self.is_idle = False
+    
+    def received(self, byte_count):
+        """Record bytes read from the client"""
+        self.bytes_received += byte_count
+        self.last_activity = time.time()
+    
+    def sent(self, byte_count):
+        """Record bytes written to the client"""
+        self.bytes_sent += byte_count
+        self.last_activity = time.time()
+    
+    def delivered(self, count=1):
+        """Record messages received from the client"""
+        self.messages += count
+    
+    def shutdown(self):
+        """Shut the socket down, waking a handler thread blocked in recv()"""
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            # Socket is already closed or was never connected
+            pass
+    
+    def info(self):
+        """Return a snapshot of the connection statistics"""
+        return {
+            'id': self.conn_id,
+            'address': f"{self.address[0]}:{self.address[1]}",
+            'connected_at': self.connected_at,
+            'last_activity': self.last_activity,
+            'bytes_received': self.bytes_received,
+            'bytes_sent': self.bytes_sent,
+            'messages': self.messages,
+            'stream': self.is_stream,
+            'idle': self.is_idle
+        }
+
+class ConnectionRegistry:
+    """Thread-safe registry of open client connections keyed by connection ID.
+    
+    Enforces a per-IP connection cap on registration and can reap
+    connections that have been idle for too long.
+    """
+    def __init__(self, max_per_ip=0):
+        self.max_per_ip = max_per_ip
+        self.connections = {}
+        self.per_ip = {}
+        self.next_id = 0
+        self.condition = threading.Condition()
+    
+    def add(self, client_socket, address):
+        """Register a connection, returning None if its IP is over the cap"""
+        ip = address[0]
+        with self.condition:
+            if self.max_per_ip and self.per_ip.get(ip, 0) >= self.max_per_ip:
+                return None
+            
+            self.next_id += 1
+            connection = ClientConnection(self.next_id, client_socket, address)
+            self.connections[connection.conn_id] = connection
+            self.per_ip[ip] = self.per_ip.get(ip, 0) + 1
+            return connection
+    
+    def remove(self, connection):
+        """Unregister a connection"""
+        with self.condition:
+            if self.connections.pop(connection.conn_id, None) is None:
+                return
+            
+            ip = connection.address[0]
+            self.per_ip[ip] -= 1
+            if not self.per_ip[ip]:
+                del self.per_ip[ip]
+            self.condition.notify_all()
+    
+    def snapshot(self):
+        """Return the registered connections"""
+        with self.condition:
+            return list(self.connections.values())
+    
+    def __len__(self):
+        with self.condition:
+            return len(self.connections)
+    
+    def reap_idle(self, idle_timeout):
+        """Shut down connections without activity for idle_timeout seconds"""
+        cutoff = time.time() - idle_timeout
+        reaped = [connection for connection in self.snapshot() if connection.last_activity < cutoff]
+        for connection in reaped:
+            connection.shutdown()
+        return reaped
+    
+    def shutdown_streams(self):
+        """Shut down persistent stream connections and idle HTTP keep-alive connections"""
+        for connection in self.snapshot():
+            if connection.is_stream or connection.is_idle:
+                connection.shutdown()
+    
+    def shutdown_all(self):
+        """Shut down every registered connection"""
+        for connection in self.snapshot():
+            connection.shutdown()
+    
+    def wait_until_empty(self, timeout):
+        """Wait until every connection is unregistered, returns False on timeout"""
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.connections, timeout)
+
+class TokenBucket:
+    """Token bucket refilled at rate tokens per second up to burst tokens"""
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+    
+    def consume(self, count=1):
+        """Take count tokens, returning 0 on success or the seconds to wait until they are available"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        
+        # A request larger than the bucket can never fit, charge it a full bucket instead
+        count = min(count, self.burst)
+        if self.tokens >= count:
+            self.tokens -= count
+            return 0
+        return (count - self.tokens) / self.rate
+
+class RateLimiter:
+    """Per-key token bucket rate limiter, a rate of 0 disables limiting"""
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = max(1.0, float(burst))
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.last_prune = time.monotonic()
+    
+    def consume(self, key, count=1):
+        """Take count tokens from the bucket of key, returning seconds to wait if throttled"""
+        if self.rate <= 0 or key is None:
+            return 0
+        
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = TokenBucket(self.rate, self.burst)
+            retry_after = bucket.consume(count)
+            self._prune()
+            return retry_after
+    
+    def _prune(self):
+        """Drop buckets that have refilled completely so idle sources do not accumulate"""
+        now = time.monotonic()
+        refill_time = self.burst / self.rate
+        if now - self.last_prune < refill_time:
+            return
+        
+        self.buckets = {
+            key: bucket for key, bucket in self.buckets.items()
+            if now - bucket.updated < refill_time
+        }
+        self.last_prune = now
+
+class Admission:
+    """Authenticates client tokens and rate limits clients per source IP and per token"""
+    def __init__(self, config, share=1):
+        # An empty token list means authentication is not required
+        self.auth_tokens = set(config.get('auth_tokens') or [])
+        # Streams from servers presenting the cluster's forward token carry many clients' messages
+        self.forward_token = config.get('forward_token') or None
+        
+        # Worker processes each enforce an equal share of the configured rates
+        self.ip_limiter = RateLimiter(
+            float(config.get('ip_rate_limit', 0)) / share,
+            config.get('ip_rate_burst', 30)
+        )
+        self.token_limiter = RateLimiter(
+            float(config.get('token_rate_limit', 0)) / share,
+            config.get('token_rate_burst', 30)
+        )
+    
+    def authorized(self, token):
+        """Whether a client presenting token may send messages"""
+        return not self.auth_tokens or token in self.auth_tokens
+    
+    def is_forwarder(self, token):
+        """Whether token is the forward token, whose streams are not rate limited"""
+        return token is not None and token == self.forward_token
+    
+    def check(self, ip, token, count=1):
+        """Return 0 if count messages are admitted, otherwise seconds to wait before retrying"""
+        retry_after = self.ip_limiter.consume(ip, count)
+        if retry_after:
+            return retry_after
+        return self.token_limiter.consume(token or None, count)
+
+def create_tls_context(certfile, keyfile=None):
+    """Create the server TLS context, None when no certificate is configured.
+    
+    The context lives as long as the listener so that session tickets it
+    issues can be used by clients to resume later connections.
+    """
+    if not certfile:
+        return None
+    
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(certfile, keyfile or None)
+    return context
+
+def encode_frame(obj):
+    """Encode a stream protocol frame as a JSON line"""
+    return json.dumps(obj, ensure_ascii=False).encode('utf-8') + b'\n'
+
+def read_line(client_socket, data, connection, max_length=0):
+    """Read from client_socket until data holds a complete line.
+    
+    Returns (line, rest) with the newline removed, or (None, data) when the
+    peer closes the connection first. Raises LineTooLong once more than
+    max_length bytes arrived without a newline (0 means no limit).
+    """
+    buffer = bytearray(data)
+    start = 0
+    while True:
+        end = buffer.find(b'\n', start)
+        if end >= 0:
+            return bytes(buffer[:end]), bytes(buffer[end + 1:])
+        if max_length and len(buffer) > max_length:
+            raise LineTooLong(f"No newline in the first {max_length} bytes")
+        
+        # Only search the new bytes on the next pass
+        start = len(buffer)
+        chunk = client_socket.recv(65536)
+        if not chunk:
+            return None, bytes(buffer)
+        connection.received(len(chunk))
+        buffer += chunk
+
+def start_tls(client_socket, connection, tls_context):
+    """Run the server side of the TLS handshake if tls_context is set, returns the socket to use"""
+    if tls_context is None:
+        return client_socket
+    
+    # Bound the handshake so a silent client cannot hold the thread forever
+    client_socket.settimeout(10)
+    client_socket = tls_context.wrap_socket(client_socket, server_side=True)
+    client_socket.settimeout(None)
+    connection.socket = client_socket
+    return client_socket
+
+def combine_statuses(statuses):
+    """Overall status of the deliver() results for one request.
+    
+    'throttled' when the forwarding queue refused a message, 'full' when the
+    scheduler refused one, 'duplicate' when its schedule id is already pending,
+    'expired' when every message had already expired,
+    'queued' when none was shown yet and 'accepted' otherwise.
+    """
+    statuses = set(statuses)
+    if 'throttled' in statuses:
+        return 'throttled'
+    if 'full' in statuses:
+        return 'full'
+    if 'duplicate' in statuses:
+        return 'duplicate'
+    if statuses == {'expired'}:
+        return 'expired'
+    if statuses and statuses <= {'queued', 'expired'}:
+        return 'queued'
+    return 'accepted'
+
+# Reply line sent to socket clients for each combined status
+STATUS_REPLIES = {
+    'accepted': REPLY_ACCEPTED,
+    'queued': REPLY_QUEUED,
+    'expired': REPLY_EXPIRED,
+    'full': REPLY_SCHEDULE_FULL,
+    'duplicate': REPLY_SCHEDULE_ID_TAKEN,
+    'throttled': REPLY_THROTTLED.format(int(FORWARD_RETRY_AFTER * 1000)),
+}
+
+def parse_envelope(line):
+    """Fields of an envelope line, returns (messages, token, options, attachments, cancel).
+    
+    "messages" must be a list of strings, or "message" a single string, and
+    "token" a string when present. Raises ValueError for anything else.
+    """
+    envelope = json.loads(line.decode('utf-8'))
+    if not isinstance(envelope, dict):
+        raise ValueError("Envelope must be a JSON object")
+    
+    messages = envelope.get('messages') or [envelope.get('message', '')]
+    if not isinstance(messages, list) or not all(isinstance(message, str) for message in messages):
+        raise ValueError("\"messages\" must be a list of strings")
+    token = envelope.get('token')
+    if token is not None and not isinstance(token, str):
+        raise ValueError("\"token\" must be a string")
+    
+    options = {key: envelope[key] for key in DELIVERY_OPTIONS if key in envelope}
+    return messages, token, options, envelope.get('attachments') or [], envelope.get('cancel')
+
+def serve_client(client_socket, client_address, deliver, connection=None, admission=None, tls_context=None,
+                 spool=None, max_envelope=HTTP_DEFAULT_MAX_BODY):
+    """Read messages from a connected client and pass each to deliver(message, source, options).
+    
+    A plain client sends one UTF-8 message. An envelope client sends one JSON
+    line starting with ENVELOPE_PREFIX, e.g.
+    {"notifypy": 1, "message": ..., "token": ...} or with a "messages" list;
+    keys listed in DELIVERY_OPTIONS (such as "priority" or "deliver_at") are passed on as options,
+    together with the client's "token" so scheduled messages know their sender.
+    An envelope of the form {"notifypy": 1, "cancel": id, "token": ...}
+    cancels a scheduled message instead, passing deliver(None, source,
+    {"cancel": id, "token": token}) and replying REPLY_CANCELLED or REPLY_NOT_SCHEDULED.
+    An envelope may declare "attachments": [{"name": ..., "size": n}, ...],
+    whose raw bytes follow the JSON line back to back; they are streamed into
+    spool and passed on as the "attachments" option (REPLY_ATTACHMENT_TOO_LARGE
+    or REPLY_BAD_ATTACHMENT reject them).
+    Both receive one reply line: REPLY_ACCEPTED, REPLY_QUEUED when deliver()
+    only queued or scheduled the messages, REPLY_EXPIRED, REPLY_SCHEDULE_FULL or
+    REPLY_SCHEDULE_ID_TAKEN (see combine_statuses()), REPLY_THROTTLED when admission rate limits them,
+    or REPLY_UNAUTHORIZED when the token is not accepted. An envelope line
+    longer than max_envelope bytes (0 means no limit) is answered with
+    REPLY_TOO_LARGE without being read any further, and one that is not valid
+    (see parse_envelope()) with REPLY_MALFORMED.
+    A stream client (another server forwarding upstream, or AsyncNotifyClient) opens with
+    STREAM_HANDSHAKE, an optional token and a newline, then sends JSON line frames of the form
+    {"seq": n, "messages": [{"message": ..., "source": [ip, port], "options": {...}}]}
+    over the same connection, each acknowledged with {"ack": n, "status": ...}
+    where status is combined from the deliver() results by combine_statuses(), or
+    "throttled" with "retry_after" seconds when the frame is over the rate limits.
+    Streams presenting the forward token are exempt from the rate limits, and
+    only their frames may name the original "source" (see _serve_stream()). With
+    tls_context the TLS handshake runs first, in the calling thread. Traffic
+    is recorded on connection when one is given.
+    """
+    if connection is None:
+        connection = ClientConnection(0, client_socket, client_address)
+    client_socket = start_tls(client_socket, connection, tls_context)
+    
+    data = client_socket.recv(4096)
+    if not data:
+        return
+    connection.received(len(data))
+    
+    if data.startswith(STREAM_HANDSHAKE):
+        handshake, buffer = read_line(client_socket, data, connection, STREAM_MAX_HANDSHAKE)
+        if handshake is None:
+            return
+        token = handshake[len(STREAM_HANDSHAKE):].strip().decode('utf-8') or None
+        if admission is not None and not admission.authorized(token):
+            client_socket.sendall(REPLY_UNAUTHORIZED.encode('utf-8'))
+            return
+        
+        connection.is_stream = True
+        # Only other servers presenting the forward token may name the original sender
+        forwarder = admission is not None and admission.is_forwarder(token)
+        _serve_stream(connection, buffer, deliver, None if forwarder else admission, token, forwarder)
+        return
+    
+    token = None
+    options = {}
+    attachments = []
+    cancel = None
+    if data.startswith(ENVELOPE_PREFIX):
+        # Envelopes are newline terminated and may span several reads,
+        # attachment bytes, if any, start right after the newline
+        try:
+            line, data = read_line(client_socket, data, connection, max_envelope)
+        except LineTooLong:
+            client_socket.sendall(REPLY_TOO_LARGE.encode('utf-8'))
+            connection.sent(len(REPLY_TOO_LARGE))
+            return
+        if line is None:
+            line, data = data, b''
+        try:
+            messages, token, options, attachments, cancel = parse_envelope(line)
+        except ValueError:
+            client_socket.sendall(REPLY_MALFORMED.encode('utf-8'))
+            connection.sent(len(REPLY_MALFORMED))
+            return
+    else:
+        messages = [data.decode('utf-8')]
+    
+    # Rejected tokens must not drain the address's rate limit or create buckets of their own
+    authorized = admission is None or admission.authorized(token)
+    retry_after = admission.check(client_address[0], token, len(messages)) if admission and authorized else 0
+    if not authorized:
+        reply = REPLY_UNAUTHORIZED
+    elif retry_after:
+        reply = REPLY_THROTTLED.format(int(retry_after * 1000) + 1)
+    else:
+        reply = None
+        if attachments:
+            try:
+                if spool is None:
+                    raise AttachmentError(REPLY_BAD_ATTACHMENT)
+                options['attachments'] = spool.receive(client_socket, data, spool.validate(attachments), connection)
+            except AttachmentError as e:
+                reply = str(e)
+    
+    if token is not None:
+        options['token'] = token
+    if reply is None and cancel is not None:
+        status = deliver(None, client_address, {'cancel': str(cancel), 'token': token})
+        if status == 'throttled':
+            reply = STATUS_REPLIES['throttled']  # The client may retry the cancel
+        else:
+            reply = REPLY_NOT_SCHEDULED if status == 'not_found' else REPLY_CANCELLED
+    elif reply is None:
+        statuses = [deliver(message, client_address, options) for message in messages]
+        connection.delivered(len(messages))
+        reply = STATUS_REPLIES[combine_statuses(statuses)]
+    
+    # Send confirmation to client
+    reply = reply.encode('utf-8')
+    client_socket.sendall(reply)
+    connection.sent(len(reply))
+
+def _stream_messages(frame):
+    """The message items of a stream frame, raising ValueError when they are malformed"""
+    messages = frame.get('messages', []) if isinstance(frame, dict) else None
+    if not isinstance(messages, list):
+        raise ValueError("Frame has no message list")
+    for item in messages:
+        if not isinstance(item, dict) or not isinstance(item.get('message'), str):
+            raise ValueError("Frame item has no message text")
+        if not isinstance(item.get('options') or {}, dict):
+            raise ValueError("Frame item options are not an object")
+    return messages
+
+def _forwarded_source(item, default):
+    """The [ip, port] source a forwarding server recorded for item, or default"""
+    source = item.get('source')
+    if (isinstance(source, list) and len(source) == 2 and isinstance(source[0], str)
+            and isinstance(source[1], int)):
+        return tuple(source)
+    return default
+
+def _serve_stream(connection, buffer, deliver, admission=None, token=None, forwarder=False):
+    """Serve a persistent stream connection until the peer closes it.
+    
+    With admission, every frame is rate limited like any other request and
+    a frame over the limit is acknowledged with {"ack": n, "status":
+    "throttled", "retry_after": seconds} without delivering its messages.
+    The "source" of each message is only taken from the frame when forwarder
+    is set, i.e. the stream presented the forward token; otherwise messages are
+    attributed to the connection's own address. A frame that cannot be
+    parsed or is longer than STREAM_MAX_FRAME is answered with {"error": ...}
+    and the connection is closed.
+    """
+    client_socket = connection.socket
+    while True:
+        try:
+            line, buffer = read_line(client_socket, buffer, connection, STREAM_MAX_FRAME)
+            if line is None:
+                return
+            if not line.strip():
+                continue
+            frame = json.loads(line.decode('utf-8'))
+            messages = _stream_messages(frame)
+        except (LineTooLong, ValueError) as e:
+            reply = encode_frame({'error': str(e)})
+            client_socket.sendall(reply)
+            connection.sent(len(reply))
+            return
+        
+        retry_after = admission.check(connection.address[0], token, len(messages)) if admission else 0
+        if retry_after:
+            reply = encode_frame({'ack': frame.get('seq'), 'status': 'throttled', 'retry_after': retry_after})
+            client_socket.sendall(reply)
+            connection.sent(len(reply))
+            continue
+        
+        statuses = []
+        for item in messages:
+            source = _forwarded_source(item, connection.address) if forwarder else connection.address
+            # Only pass on known options, attachment paths are never taken from the wire
+            options = {key: value for key, value in (item.get('options') or {}).items() if key in DELIVERY_OPTIONS}
+            if token is not None and not forwarder:
+                options['token'] = token
+            statuses.append(deliver(item['message'], source, options))
+        connection.delivered(len(messages))
+        
+        ack = {'ack': frame.get('seq'), 'status': combine_statuses(statuses)}
+        if ack['status'] == 'throttled':
+            ack['retry_after'] = FORWARD_RETRY_AFTER
+        reply = encode_frame(ack)
+        client_socket.sendall(reply)
+        connection.sent(len(reply))
+
+def reject_client(client_socket, reason):
+    """Tell a client why its connection is refused and close it"""
+    try:
+        client_socket.send(reason.encode('utf-8'))
+    except OSError:
+        pass
+    client_socket.close()
+
+class HTTPError(Exception):
+    """An HTTP request that is answered with an error status"""
+    def __init__(self, status, message, close=False, headers=None):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.close = close
+        self.headers = headers or {}
+
+def _read_http_head(rfile):
+    """Read a request line and headers, returns (method, target, version, headers, size) or None at EOF"""
+    line = rfile.readline(HTTP_MAX_HEADER_SIZE + 1)
+    # Tolerate blank lines left over from a previous request
+    while line in (b'\r\n', b'\n'):
+        line = rfile.readline(HTTP_MAX_HEADER_SIZE + 1)
+    if not line:
+        return None
+    
+    size = len(line)
+    parts = line.decode('latin-1').split()
+    if size > HTTP_MAX_HEADER_SIZE or len(parts) != 3 or not parts[2].startswith('HTTP/1.'):
+        raise HTTPError(400, "Malformed request line", close=True)
+    
+    headers = {}
+    while True:
+        line = rfile.readline(HTTP_MAX_HEADER_SIZE + 1)
+        size += len(line)
+        if size > HTTP_MAX_HEADER_SIZE:
+            raise HTTPError(431, "Request headers too large", close=True)
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, separator, value = line.decode('latin-1').partition(':')
+        if not separator:
+            raise HTTPError(400, "Malformed header line", close=True)
+        headers[name.strip().lower()] = value.strip()
+    
+    return parts[0], parts[1], parts[2], headers, size
+
+def _iter_http_body(rfile, headers, max_body):
+    """Yield the request body as it arrives, decoding chunked transfer encoding"""
+    if 'chunked' in headers.get('transfer-encoding', '').lower():
+        total = 0
+        while True:
+            size_line = rfile.readline(1024)
+            try:
+                size = int(size_line.split(b';', 1)[0].strip(), 16)
+            except ValueError:
+                raise HTTPError(400, "Malformed chunked body", close=True) from None
+            if size == 0:
+                # Skip trailer fields up to the blank line ending the body
+                while rfile.readline(HTTP_MAX_HEADER_SIZE) not in (b'\r\n', b'\n', b''):
+                    pass
+                return
+            
+            total += size
+            if max_body and total > max_body:
+                raise HTTPError(413, f"Request body exceeds {max_body} bytes", close=True)
+            data = rfile.read(size)
+            if len(data) < size:
+                raise HTTPError(400, "Incomplete chunked body", close=True)
+            rfile.readline(1024)
+            yield data
+        return
+    
+    try:
+        remaining = int(headers.get('content-length') or 0)
+    except ValueError:
+        raise HTTPError(400, "Invalid Content-Length", close=True) from None
+    if remaining < 0:
+        raise HTTPError(400, "Invalid Content-Length", close=True)
+    if max_body and remaining > max_body:
+        raise HTTPError(413, f"Request body exceeds {max_body} bytes", close=True)
+    
+    while remaining:
+        data = rfile.read1(min(remaining, 65536))
+        if not data:
+            raise HTTPError(400, "Incomplete request body", close=True)
+        remaining -= len(data)
+        yield data
+
+def _http_item(item):
+    """Message and delivery options of one batch entry, a string or {"message": ..., "priority": ...}"""
+    if isinstance(item, str):
+        return item, {}
+    if isinstance(item, dict) and isinstance(item.get('message'), str):
+        return item['message'], {key: item[key] for key in DELIVERY_OPTIONS if key in item}
+    raise HTTPError(400, "Each message must be a string or an object with a \"message\" string")
+
+def parse_http_body(body, content_type):
+    """Messages of a buffered request body, returns ([(message, options), ...], token).
+    
+    A JSON body is one message object, an object with a "messages" list, or an
+    array of strings and message objects. A form body may carry "message",
+    "token" and DELIVERY_OPTIONS fields such as "priority" or "delay". Any other body is one plain text message.
+    """
+    try:
+        text = body.decode('utf-8')
+    except UnicodeDecodeError:
+        raise HTTPError(400, "Request body must be UTF-8") from None
+    
+    if content_type == 'application/json':
+        try:
+            data = json.loads(text)
+        except ValueError:
+            raise HTTPError(400, "Malformed JSON body") from None
+        if isinstance(data, list):
+            return [_http_item(item) for item in data], None
+        if not isinstance(data, dict):
+            raise HTTPError(400, "JSON body must be an object or an array")
+        
+        options = {key: data[key] for key in DELIVERY_OPTIONS if key in data}
+        if 'messages' in data:
+            if not isinstance(data['messages'], list):
+                raise HTTPError(400, "\"messages\" must be a list")
+            items = []
+            for item in data['messages']:
+                message, item_options = _http_item(item)
+                items.append((message, {**options, **item_options}))
+        else:
+            items = [_http_item(data)]
+        return items, data.get('token')
+    
+    if content_type == 'application/x-www-form-urlencoded':
+        # curl -d sends this type by default, even for a bare message
+        fields = urllib.parse.parse_qs(text)
+        if 'message' in fields:
+            options = {key: fields[key][0] for key in DELIVERY_OPTIONS if key in fields}
+            return [(message, options) for message in fields['message']], fields.get('token', [None])[0]
+    
+    return [(text, {})], None
+
+def _http_response(status, payload, keep_alive, headers=None, include_body=True):
+    """Encode a JSON response"""
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    lines = [
+        f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}",
+        "Content-Type: application/json; charset=utf-8",
+        f"Content-Length: {len(body)}",
+        f"Connection: {'keep-alive' if keep_alive else 'close'}"
+    ]
+    lines.extend(f"{name}: {value}" for name, value in (headers or {}).items())
+    head = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+    return head + body if include_body else head
+
+def serve_http(client_socket, client_address, deliver, connection=None, admission=None, tls_context=None,
+               max_body=HTTP_DEFAULT_MAX_BODY):
+    """Serve HTTP/1.1 ingest requests on a keep-alive connection, passing messages to deliver().
+    
+    POST / or /notify delivers the messages in the body, see parse_http_body().
+    The token is read from an "Authorization: Bearer" header, or from the body.
+    An application/x-ndjson body is delivered line by line while it streams
+    in. GET /health reports that the server is up. Replies are JSON:
+    {"status": "accepted" | "queued" | "expired", "count": n} on success, or {"error": ...}
+    with 401, 429 (and Retry-After) or a 4xx status describing the problem,
+    409 when a schedule id is already pending and 503 when the delivery scheduler is full.
+    """
+    if connection is None:
+        connection = ClientConnection(0, client_socket, client_address)
+    client_socket = start_tls(client_socket, connection, tls_context)
+    rfile = client_socket.makefile('rb')
+    
+    while True:
+        # An idle keep-alive connection can be closed when the server stops
+        connection.is_idle = True
+        try:
+            request = _read_http_head(rfile)
+        except HTTPError as e:
+            client_socket.sendall(_http_response(e.status, {'error': e.message}, False))
+            return
+        if request is None:
+            return
+        connection.is_idle = False
+        
+        method, target, version, headers, size = request
+        connection.received(size)
+        connection_header = headers.get('connection', '').lower()
+        keep_alive = connection_header != 'close' if version == 'HTTP/1.1' else connection_header == 'keep-alive'
+        
+        response_headers = {}
+        try:
+            status, payload = _handle_http_request(
+                method, target, headers, rfile, client_socket, client_address,
+                deliver, connection, admission, max_body
+            )
+        except HTTPError as e:
+            status, payload = e.status, {'error': e.message}
+            response_headers = e.headers
+            keep_alive = keep_alive and not e.close
+        
+        reply = _http_response(status, payload, keep_alive, response_headers, method != 'HEAD')
+        client_socket.sendall(reply)
+        connection.sent(len(reply))
+        if not keep_alive:
+            return
+
+def _handle_http_request(method, target, headers, rfile, client_socket, client_address,
+                         deliver, connection, admission, max_body):
+    """Handle one HTTP request, returns (status, payload) or raises HTTPError"""
+    path = target.split('?', 1)[0]
+    has_body = 'transfer-encoding' in headers or headers.get('content-length', '0').strip() not in ('', '0')
+    
+    if path == '/health':
+        if method not in ('GET', 'HEAD'):
+            raise HTTPError(405, "Use GET", close=has_body, headers={'Allow': 'GET, HEAD'})
+        return 200, {'status': 'ok'}
+    if path not in ('/', '/notify'):
+        raise HTTPError(404, "Not found, POST messages to /notify", close=has_body)
+    if method != 'POST':
+        raise HTTPError(405, "Use POST", close=has_body, headers={'Allow': 'POST'})
+    
+    authorization = headers.get('authorization', '')
+    token = authorization[7:].strip() if authorization.lower().startswith('bearer ') else None
+    content_type = headers.get('content-type', '').split(';', 1)[0].strip().lower()
+    
+    if headers.get('expect', '').lower() == '100-continue':
+        # curl waits for this before sending larger bodies
+        client_socket.sendall(b'HTTP/1.1 100 Continue\r\n\r\n')
+    
+    if content_type == 'application/x-ndjson':
+        return _handle_http_stream(rfile, headers, token, client_address, deliver, connection, admission, max_body)
+    
+    body = bytearray()
+    for chunk in _iter_http_body(rfile, headers, max_body):
+        connection.received(len(chunk))
+        body += chunk
+    items, body_token = parse_http_body(bytes(body), content_type)
+    token = token or body_token
+    if not items:
+        raise HTTPError(400, "No messages in request body")
+    
+    _admit_http(admission, client_address, token, len(items))
+    statuses = [deliver(message, client_address, _with_token(options, token)) for message, options in items]
+    connection.delivered(len(items))
+    return _http_status(combine_statuses(statuses), len(items))
+
+def _handle_http_stream(rfile, headers, token, client_address, deliver, connection, admission, max_body):
+    """Deliver an application/x-ndjson body one line at a time as it arrives"""
+    if admission is not None and not admission.authorized(token):
+        raise HTTPError(401, REPLY_UNAUTHORIZED, close=True)
+    
+    buffer = b''
+    count = 0
+    statuses = set()
+    for chunk in _iter_http_body(rfile, headers, max_body):
+        connection.received(len(chunk))
+        lines = (buffer + chunk).split(b'\n')
+        buffer = lines.pop()
+        
+        items = []
+        for line in lines:
+            if line.strip():
+                try:
+                    items.append(_http_item(json.loads(line.decode('utf-8'))))
+                except ValueError:
+                    raise HTTPError(400, f"Malformed JSON line after {count} messages", close=True) from None
+                except HTTPError as e:
+                    # As below, the rest of the body is left unread
+                    e.close = True
+                    e.message = f"{e.message} after {count} messages"
+                    raise
+        if not items:
+            continue
+        
+        try:
+            _admit_http(admission, client_address, token, len(items))
+        except HTTPError as e:
+            # The rest of the body is not read, so the connection cannot be reused
+            e.close = True
+            e.message = f"{e.message} after {count} messages"
+            raise
+        for message, options in items:
+            statuses.add(deliver(message, client_address, _with_token(options, token)))
+        connection.delivered(len(items))
+        count += len(items)
+    
+    if buffer.strip():
+        raise HTTPError(400, f"Incomplete JSON line after {count} messages")
+    return _http_status(combine_statuses(statuses), count)
+
+def _with_token(options, token):
+    """Delivery options with the client's token added, see serve_client()"""
+    return dict(options, token=token) if token is not None else options
+
+def _http_status(status, count):
+    """Response to a delivered request with its combined status"""
+    if status == 'throttled':
+        raise HTTPError(429, STATUS_REPLIES['throttled'],
+                        headers={'Retry-After': str(math.ceil(FORWARD_RETRY_AFTER))})
+    if status == 'full':
+        return 503, {'error': REPLY_SCHEDULE_FULL, 'count': count}
+    if status == 'duplicate':
+        return 409, {'error': REPLY_SCHEDULE_ID_TAKEN, 'count': count}
+    return 200, {'status': status, 'count': count}
+
+def _admit_http(admission, client_address, token, count):
+    """Raise HTTPError unless the token is accepted and count messages are within the rate limits"""
+    if admission is None:
+        return
+    if not admission.authorized(token):
+        raise HTTPError(401, REPLY_UNAUTHORIZED)
+    retry_after = admission.check(client_address[0], token, count)
+    if retry_after:
+        milliseconds = int(retry_after * 1000) + 1
+        raise HTTPError(429, REPLY_THROTTLED.format(milliseconds),
+                        headers={'Retry-After': str(math.ceil(retry_after))})
+
+def schedule_owner(token, source):
+    """Who may cancel a scheduled message: a hash of the sender's token, or its IP without one"""
+    if token:
+        return 'token:' + hashlib.sha256(token.encode('utf-8')).hexdigest()
+    return 'ip:' + source[0]
+
+def reap_interval(idle_timeout):
+    """How often to check for idle connections, None when reaping is disabled"""
+    if not idle_timeout or idle_timeout <= 0:
+        return None
+    return min(5.0, idle_timeout / 2)
+
+def _worker_main(worker_id, host, port, settings, message_queue, wake_reader, reply_reader):
+    """Entry point of a pre-forked worker process.
+    
+    Each worker binds the shared port with SO_REUSEPORT so the kernel spreads
+    incoming connections across workers. Received messages are passed to the
+    delivery process through message_queue. Plain messages are answered right
+    away with the status the delivery process would give them (see
+    settings['reply_locally'] and settings['digest']); scheduling, cancelling
+    and messages only forwarded upstream wait for the status sent back on
+    reply_reader, so refusals and throttling are reported exactly as in a
+    single process. Reloaded settings arrive on reply_reader as well, as
+    ('settings', settings), and apply to the next connection. The worker stops accepting as soon as wake_reader becomes readable,
+    serves the connections already queued on its sockets and
+    gives in-flight connections up to settings['drain_timeout'] seconds to
+    finish. Per-IP caps and idle reaping apply per worker.
+    """
+    try:
+        server_socket = create_server_socket(host, port, settings['backlog'])
+        http_port = int(settings.get('http_port', 0))
+        http_socket = create_server_socket(host, http_port, settings['backlog']) if http_port else None
+        tls_context = create_tls_context(settings.get('tls_certfile'), settings.get('tls_keyfile'))
+    except Exception as e:
+        message_queue.put(('error', f"Worker {worker_id} failed to bind: {e}"))
+        return
+    message_queue.put(('ready', worker_id))
+    
+    registry = ConnectionRegistry(settings['max_connections_per_ip'])
+    # Read by every new connection, replaced as a whole when settings are reloaded
+    state = {
+        'admission': Admission(settings, settings['workers']),
+        'tls_context': tls_context,
+        'spool': AttachmentSpool.from_config(settings, ''),
+    }
+    last_reap = time.monotonic()
+    # Wakes the accept loop so a new idle_timeout takes effect
+    settings_reader, settings_writer = socket.socketpair()
+    
+    def configure(new_settings):
+        try:
+            tls_context = create_tls_context(new_settings.get('tls_certfile'), new_settings.get('tls_keyfile'))
+        except Exception as e:
+            message_queue.put(('status', f"Worker {worker_id} keeps its TLS certificate: {e}"))
+            tls_context = state['tls_context']
+        settings.update(new_settings)
+        registry.max_per_ip = int(settings['max_connections_per_ip'])
+        state.update(admission=Admission(settings, settings['workers']), tls_context=tls_context,
+                     spool=AttachmentSpool.from_config(settings, ''))
+        try:
+            settings_writer.send(b'\0')
+        except OSError:
+            pass  # The worker is stopping
+    
+    # Delivery statuses arrive in any order, keyed by request ID
+    waiting = {}
+    request_ids = itertools.count()
+    
+    def read_replies():
+        while True:
+            try:
+                request_id, status = reply_reader.recv()
+            except (EOFError, OSError):
+                return
+            if request_id == 'settings':
+                configure(status)
+                continue
+            waiter = waiting.pop(request_id, None)
+            if waiter is not None:
+                waiter[1] = status
+                waiter[0].set()
+    
+    reply_thread = threading.Thread(target=read_replies, daemon=True)
+    reply_thread.start()
+    
+    def deliver(message, source, options):
+        # Without the delivery process nothing is shown, so the client should send again later
+        if not reply_thread.is_alive():
+            return 'throttled'
+        if settings.get('reply_locally') and not any(key in options for key in ('cancel',) + SCHEDULE_OPTIONS):
+            # Nothing can refuse a plain message, so skip the round trip
+            message_queue.put(('message', message, source, options, worker_id, None))
+            if settings.get('digest') and options.get('priority') != 'high' and not options.get('attachments'):
+                return 'queued'
+            return 'accepted'
+        
+        request_id = next(request_ids)
+        waiter = [threading.Event(), None]
+        waiting[request_id] = waiter
+        message_queue.put(('message', message, source, options, worker_id, request_id))
+        # The status never arrives once the delivery process has gone away
+        while not waiter[0].wait(1.0):
+            if not reply_thread.is_alive():
+                waiting.pop(request_id, None)
+                return 'throttled'
+        return waiter[1]
+    
+    def serve_socket_client(client_socket, client_address, deliver, connection, admission, tls_context):
+        serve_client(client_socket, client_address, deliver, connection, admission, tls_context, state['spool'],
+                     int(settings.get('http_max_body', HTTP_DEFAULT_MAX_BODY)))
+    
+    def serve_http_client(client_socket, client_address, deliver, connection, admission, tls_context):
+        serve_http(client_socket, client_address, deliver, connection, admission, tls_context,
+                   int(settings.get('http_max_body', HTTP_DEFAULT_MAX_BODY)))
+    
+    def handle_client(connection, serve):
+        try:
+            serve(connection.socket, connection.address, deliver, connection, state['admission'], state['tls_context'])
+        except Exception as e:
+            message_queue.put(('status', f"Worker {worker_id} error handling client message: {e}"))
+        finally:
+            connection.socket.close()
+            registry.remove(connection)
+    
+    def accept(listener, serve):
+        """Accept one queued connection, raises BlockingIOError when there is none"""
+        client_socket, client_address = listener.accept()
+        client_socket.setblocking(True)
+        
+        connection = registry.add(client_socket, client_address)
+        if connection is None:
+            reject_client(client_socket, "Too many connections from this address")
+        else:
+            threading.Thread(target=handle_client, args=(connection, serve), daemon=True).start()
+    
+    served = ((server_socket, serve_socket_client), (http_socket, serve_http_client))
+    listeners = [server_socket, wake_reader, settings_reader] + ([http_socket] if http_socket else [])
+    while True:
+        # Read on every pass so reloaded settings take effect
+        idle_timeout = settings['idle_timeout']
+        interval = reap_interval(idle_timeout)
+        try:
+            readable, _, _ = select.select(listeners, [], [], interval)
+        except Exception as e:
+            message_queue.put(('status', f"Worker {worker_id} listener error: {e}"))
+            break
+        if wake_reader in readable:
+            break
+        if settings_reader in readable:
+            settings_reader.recv(4096)
+        
+        if interval is not None and time.monotonic() - last_reap >= interval:
+            registry.reap_idle(idle_timeout)
+            last_reap = time.monotonic()
+        
+        failed = False
+        for listener, serve in served:
+            if listener not in readable:
+                continue
+            try:
+                accept(listener, serve)
+            except BlockingIOError:
+                continue
+            except Exception as e:
+                message_queue.put(('status', f"Worker {worker_id} listener error: {e}"))
+                failed = True
+                break
+        if failed:
+            break
+    
+    # Connections already queued would be reset when the socket closes, serve them first
+    # (new workers bound to the same port keep accepting meanwhile)
+    for listener, serve in served:
+        while listener is not None:
+            try:
+                accept(listener, serve)
+            except OSError:
+                break
+    
+    server_socket.close()
+    if http_socket is not None:
+        http_socket.close()
+    settings_reader.close()
+    settings_writer.close()
+    
+    # Give in-flight connections a chance to finish before the process exits
+    registry.shutdown_streams()
+    if not registry.wait_until_empty(settings['drain_timeout']):
+        registry.shutdown_all()
+
+class UpstreamForwarder:
+    """Forwards received messages in batches to upstream servers.
+    
+    Messages are queued by the receiving threads and sent by a single
+    forwarding thread over one persistent stream connection. Each batch is
+    retried until an upstream acknowledges it, failing over to the next
+    upstream in the list when a connection breaks. When the queue is full,
+    submit() blocks so that clients are slowed down instead of messages
+    being dropped.
+    """
+    def __init__(self, upstreams, log, batch_size=50, interval=0.5, queue_size=1000,
+                 token='', tls=False, tls_cafile=''):
+        self.upstreams = [self._parse_address(address) for address in upstreams]
+        self.log = log
+        self.token = token
+        self.tls_context = ssl.create_default_context(cafile=tls_cafile or None) if tls else None
+        self.tls_sessions = {}
+        self.batch_size = max(1, int(batch_size))
+        self.interval = float(interval)
+        self.queue = queue.Queue(maxsize=max(1, int(queue_size)))
+        self.is_running = False
+        self.upstream_index = 0
+        self.connection = None
+        self.buffer = b''
+        self.seq = 0
+        self.thread = None
+        self.stop_event = threading.Event()
+    
+    @staticmethod
+    def _parse_address(address):
+        """Parse a "host:port" upstream address"""
+        host, _, port = str(address).rpartition(':')
+        return host, int(port)
+    
+    def start(self):
+        """Start forwarding thread"""
+        self.is_running = True
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+    
+    def stop(self):
+        """Stop forwarding thread, pending messages that were not acknowledged are lost"""
+        self.is_running = False
+        self.stop_event.set()
+        
+        # Wake the forwarding thread if it is waiting for messages or an ack
+        try:
+            self.queue.put_nowait(None)
+        except queue.Full:
+            pass
+        connection = self.connection
+        if connection is not None:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        
+        if self.thread is not None:
+            self.thread.join(timeout=2.0)
+            self.thread = None
+        self._disconnect()
+    
+    def submit(self, message, source, options=None, timeout=5.0):
+        """Queue a message for forwarding, blocking while the queue is full"""
+        item = {'message': message, 'source': list(source)}
+        if options:
+            item['options'] = options
+        try:
+            self.queue.put(item, timeout=timeout)
+            return True
+        except queue.Full:
+            return False
+    
+    def _next_batch(self):
+        """Collect up to batch_size messages, waiting at most interval for the first one"""
+        try:
+            batch = [self.queue.get(timeout=self.interval)]
+        except queue.Empty:
+            return []
+        
+        # Stay well below the upstream's STREAM_MAX_FRAME, even if every character needs escaping
+        budget = STREAM_MAX_FRAME // 8 - len(batch[0]['message'] if batch[0] else '')
+        while len(batch) < self.batch_size and budget > 0:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            batch.append(item)
+            if item is not None:
+                budget -= len(item['message'])
+        
+        # None is the wake-up sentinel queued by stop()
+        return [item for item in batch if item is not None]
+    
+    def _run(self):
+        """Forwarding loop"""
+        batch = []
+        failures = 0
+        
+        while self.is_running:
+            if not batch:
+                batch = self._next_batch()
+                if not batch:
+                    continue
+            
+            if self._send_batch(batch):
+                batch = []
+                failures = 0
+                continue
+            if not self.is_running:
+                break
+            
+            # Every upstream failed, back off before trying the same batch again
+            failures += 1
+            delay = min(30.0, 0.5 * (2 ** min(failures, 6)))
+            self.log(f"All upstreams unavailable, retrying {len(batch)} messages in {delay:.1f}s")
+            self.stop_event.wait(delay)
+    
+    def _send_batch(self, batch):
+        """Send a batch and wait for its ack, failing over through the upstream list"""
+        for _ in range(len(self.upstreams)):
+            host, port = self.upstreams[self.upstream_index]
+            
+            # A kept-alive connection may have been closed by the upstream's idle
+            # timeout, so retry once on a fresh connection before failing over
+            attempts = 2 if self.connection is not None else 1
+            for _ in range(attempts):
+                try:
+                    if self.connection is None:
+                        self._connect(host, port)
+                    
+                    while True:
+                        self.seq += 1
+                        self.connection.sendall(encode_frame({'seq': self.seq, 'messages': batch}))
+                        ack = self._wait_for_ack(self.seq)
+                        if ack.get('status') != 'throttled':
+                            break
+                        # The upstream delivered nothing, resend the batch once it asks to
+                        if self.stop_event.wait(float(ack.get('retry_after') or FORWARD_RETRY_AFTER)):
+                            return False
+                    if self.tls_context is not None:
+                        # TLS 1.3 session tickets arrive after the handshake, save it once data was read
+                        self.tls_sessions[(host, port)] = self.connection.session
+                    return True
+                except Exception as e:
+                    error = e
+                    self._disconnect()
+            
+            self.log(f"Forwarding to upstream {host}:{port} failed: {error}")
+            self.upstream_index = (self.upstream_index + 1) % len(self.upstreams)
+        return False
+    
+    def _connect(self, host, port):
+        """Open a persistent stream connection to an upstream server"""
+        connection = socket.create_connection((host, port), timeout=5)
+        if self.tls_context is not None:
+            # Resume the previous TLS session with this upstream when possible
+            connection = self.tls_context.wrap_socket(
+                connection,
+                server_hostname=host,
+                session=self.tls_sessions.get((host, port))
+            )
+        connection.settimeout(10)
+        
+        handshake = STREAM_HANDSHAKE
+        if self.token:
+            handshake += b' ' + self.token.encode('utf-8')
+        connection.sendall(handshake + b'\n')
+        self.connection = connection
+        self.buffer = b''
+        self.log(f"Connected to upstream {host}:{port}")
+    
+    def _disconnect(self):
+        """Close the upstream connection"""
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except Exception:
+                pass
+            self.connection = None
+    
+    def _wait_for_ack(self, seq):
+        """Read ack frames until the one for seq arrives and return it"""
+        while True:
+            while b'\n' in self.buffer:
+                line, self.buffer = self.buffer.split(b'\n', 1)
+                ack = json.loads(line.decode('utf-8'))
+                if ack.get('ack') == seq:
+                    return ack
+            
+            chunk = self.connection.recv(4096)
+            if not chunk:
+                raise ConnectionError("Upstream closed the connection")
+            self.buffer += chunk
+            if self.buffer.startswith(REPLY_UNAUTHORIZED.encode('utf-8')):
+                raise ConnectionError("Upstream rejected the forward token")
+
+def classify_message(message):
+    """Classify a message as 'success', 'failure' or 'info' from the wording used by notify.py"""
+    if "命令执行失败" in message:
+        return 'failure'
+    if "命令已完成" in message:
+        return 'success'
+    return 'info'
+
+class DigestScheduler:
+    """Buffers low-priority messages and delivers them as one periodic summary.
+    
+    A digest is delivered window seconds after the first buffered message,
+    or as soon as max_messages messages are buffered. The summary groups
+    messages by source and by success/failure status.
+    """
+    def __init__(self, deliver, window=60, max_messages=0):
+        self.deliver = deliver
+        self.window = float(window)
+        self.max_messages = int(max_messages)
+        self.buffer = []
+        self.first_buffered = None
+        self.is_running = False
+        self.condition = threading.Condition()
+        self.thread = None
+    
+    def start(self):
+        """Start digest thread"""
+        self.is_running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+    
+    def stop(self):
+        """Stop digest thread, delivering anything still buffered"""
+        with self.condition:
+            self.is_running = False
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join(timeout=2.0)
+            self.thread = None
+    
+    def add(self, message, source):
+        """Buffer a message for the next digest"""
+        with self.condition:
+            if not self.buffer:
+                # Start the window timer
+                self.first_buffered = time.monotonic()
+                self.condition.notify_all()
+            self.buffer.append((source[0], classify_message(message), message))
+            if self.max_messages and len(self.buffer) >= self.max_messages:
+                self.condition.notify_all()
+    
+    def _run(self):
+        """Digest loop"""
+        while True:
+            with self.condition:
+                while self.is_running:
+                    if self.buffer:
+                        remaining = self.first_buffered + self.window - time.monotonic()
+                        if remaining <= 0 or (self.max_messages and len(self.buffer) >= self.max_messages):
+                            break
+                        self.condition.wait(remaining)
+                    else:
+                        self.condition.wait()
+                
+                batch, self.buffer = self.buffer, []
+                stopping = not self.is_running
+            
+            if batch:
+                self.deliver(self.summarize(batch))
+            if stopping:
+                return
+    
+    @staticmethod
+    def summarize(batch):
+        """Build the summary text for a list of (source, status, message) entries"""
+        lines = [f"Digest: {len(batch)} messages"]
+        
+        by_source = {}
+        for source, status, message in batch:
+            by_source.setdefault(source, []).append((status, message))
+        
+        for source, entries in by_source.items():
+            counts = {'success': 0, 'failure': 0, 'info': 0}
+            for status, _ in entries:
+                counts[status] += 1
+            lines.append(f"{source}: {counts['success']} succeeded, {counts['failure']} failed, {counts['info']} other")
+            
+            # Failures are the entries worth reading, list their first lines
+            for status, message in entries:
+                if status == 'failure':
+                    lines.append(f"  ✗ {message.splitlines()[0]}")
+        
+        return '\n'.join(lines)
+
+class DeliveryScheduler:
+    """Holds messages until their delivery time, then passes them to deliver(message, source, options).
+    
+    Pending messages are kept in a binary heap ordered by due time, so adding
+    one is O(log n) and the single scheduler thread only looks at the earliest.
+    Cancelling drops the entry from the index and leaves its heap slot behind
+    (lazy deletion); the heap is rebuilt once stale slots make up half of it.
+    Every add, cancel and delivery is appended to a JSON lines journal that is
+    replayed by the scheduler thread after start, so pending messages survive
+    a restart. start() returns right away, while add() and cancel() wait
+    until the journal is loaded since it may hold the ids they use. Messages that
+    came due while the server was down are delivered right away, unless they
+    expired in the meantime.
+    """
+    # Entries delivered per wake-up before the lock is taken again
+    BATCH_SIZE = 100
+    
+    def __init__(self, deliver, journal_path=None, max_pending=0, log=None):
+        self.deliver = deliver
+        self.journal_path = journal_path
+        self.max_pending = int(max_pending)
+        self.log = log or (lambda message: None)
+        self.heap = []  # (due, seq, schedule id)
+        self.entries = {}  # schedule id -> entry dict
+        self.stale = 0
+        self.counter = itertools.count()
+        self.journal = None
+        self.journal_records = 0
+        self.loading = False
+        self.is_running = False
+        self.condition = threading.Condition()
+        self.thread = None
+    
+    def __len__(self):
+        return len(self.entries)
+    
+    def start(self):
+        """Open the journal and start the scheduler thread, which replays the journal first"""
+        with self.condition:
+            journal_size = self._open_journal() if self.journal_path else 0
+            self.loading = journal_size > 0
+            self.is_running = True
+        self.thread = threading.Thread(target=self._run, args=(journal_size,), daemon=True)
+        self.thread.start()
+    
+    def stop(self):
+        """Stop the scheduler thread, pending messages stay in the journal"""
+        with self.condition:
+            self.is_running = False
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join(timeout=2.0)
+            self.thread = None
+        with self.condition:
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+    
+    def add(self, schedule_id, due, expire_at, message, source, options, owner=None):
+        """Schedule a message, returns 'queued', or 'duplicate' or 'full' when it is refused.
+        
+        Ids come from the clients, so a pending message is never replaced by
+        another one with the same id. Only the same owner may cancel it.
+        """
+        with self.condition:
+            # Any id may be in the part of the journal still loading
+            while self.loading:
+                self.condition.wait()
+            if schedule_id in self.entries:
+                return 'duplicate'
+            if self.max_pending and len(self.entries) >= self.max_pending:
+                return 'full'
+            entry = {
+                'id': schedule_id,
+                'due': due,
+                'expire_at': expire_at,
+                'message': message,
+                'source': list(source),
+                'options': options,
+                'owner': owner,
+            }
+            self._insert(entry)
+            self._write_journal(dict(entry, op='add'))
+            if self.heap[0][2] == schedule_id:
+                # New earliest entry, shorten the thread's wait
+                self.condition.notify_all()
+        return 'queued'
+    
+    def cancel(self, schedule_id, owner=None):
+        """Cancel a pending message, returns False if it is not pending or has another owner"""
+        with self.condition:
+            # The id may be in the part of the journal still loading
+            while self.loading:
+                self.condition.wait()
+            entry = self.entries.get(schedule_id)
+            # Messages journaled before owners were recorded have none
+            if entry is None or entry.get('owner') not in (None, owner):
+                return False
+            if not self._discard(schedule_id):
+                return False
+            self._write_journal({'op': 'remove', 'id': schedule_id})
+        return True
+    
+    def _insert(self, entry):
+        """Index an entry and push it onto the heap"""
+        self._discard(entry['id'])
+        entry['seq'] = next(self.counter)
+        self.entries[entry['id']] = entry
+        heapq.heappush(self.heap, (entry['due'], entry['seq'], entry['id']))
+    
+    def _discard(self, schedule_id):
+        """Drop an entry from the index, its heap slot becomes stale"""
+        if self.entries.pop(schedule_id, None) is None:
+            return False
+        self.stale += 1
+        if self.stale > 1024 and self.stale * 2 > len(self.heap):
+            self.heap = [item for item in self.heap if self._is_live(item)]
+            heapq.heapify(self.heap)
+            self.stale = 0
+        return True
+    
+    def _is_live(self, item):
+        entry = self.entries.get(item[2])
+        return entry is not None and entry['seq'] == item[1]
+    
+    def _take_due(self, now):
+        """Pop up to BATCH_SIZE entries that are due"""
+        batch = []
+        while self.heap and self.heap[0][0] <= now and len(batch) < self.BATCH_SIZE:
+            item = heapq.heappop(self.heap)
+            if not self._is_live(item):
+                self.stale -= 1
+                continue
+            batch.append(self.entries.pop(item[2]))
+        return batch
+    
+    def _run(self, journal_size=0):
+        """Scheduler loop, one thread for all pending messages"""
+        if journal_size:
+            self._replay_journal(journal_size)
+        
+        while True:
+            with self.condition:
+                batch = []
+                while self.is_running:
+                    now = time.time()
+                    batch = self._take_due(now)
+                    if batch:
+                        break
+                    # Wake at least once a minute in case the wall clock was changed
+                    timeout = min(self.heap[0][0] - now, 60.0) if self.heap else None
+                    self.condition.wait(timeout)
+                if not self.is_running:
+                    # Entries taken but not delivered are still in the journal
+                    return
+            
+            now = time.time()
+            for entry in batch:
+                if entry['expire_at'] is not None and entry['expire_at'] <= now:
+                    self.log(f"Scheduled message {entry['id']} from {entry['source'][0]} expired before delivery")
+                    continue
+                try:
+                    self.deliver(entry['message'], tuple(entry['source']), entry['options'])
+                except Exception as e:
+                    self.log(f"Failed to deliver scheduled message {entry['id']}: {e}")
+            
+            # Journal the deliveries afterwards, a crash in between delivers them again
+            with self.condition:
+                for entry in batch:
+                    self._write_journal({'op': 'remove', 'id': entry['id']})
+    
+    def _open_journal(self):
+        """Open the journal for appending, returns the size of the records written before start"""
+        directory = os.path.dirname(self.journal_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.journal = open(self.journal_path, 'a', encoding='utf-8')
+        size = os.fstat(self.journal.fileno()).st_size
+        if size:
+            with open(self.journal_path, 'rb') as f:
+                f.seek(size - 1)
+                torn = f.read(1) != b'\n'
+            if torn:
+                # A crash mid-write left a partial line, start new records on a line of their own
+                self.journal.write('\n')
+                self.journal.flush()
+                size += 1
+        return size
+    
+    def _replay_journal(self, size):
+        """Replay the first size bytes of the journal, written before start().
+        
+        Runs on the scheduler thread without the lock; add() and cancel() wait
+        until it is done. A journal with a torn line or mostly obsolete records
+        is compacted.
+        """
+        loaded = {}
+        records = 0
+        intact = True
+        try:
+            with open(self.journal_path, 'rb') as f:
+                for line in f:
+                    size -= len(line)
+                    if size < 0:
+                        break
+                    records += 1
+                    if records % 10000 == 0 and not self.is_running:
+                        break
+                    try:
+                        record = json.loads(line)
+                        if record['op'] == 'add':
+                            record.pop('op')
+                            loaded.pop(record['id'], None)
+                            loaded[record['id']] = record
+                        else:
+                            loaded.pop(record['id'], None)
+                    except (ValueError, KeyError, TypeError):
+                        intact = False
+        except OSError as e:
+            self.log(f"Failed to read schedule file {self.journal_path}: {e}")
+            loaded = {}
+        
+        with self.condition:
+            self.loading = False
+            self.condition.notify_all()
+            if not self.is_running:
+                return
+            
+            for schedule_id, entry in loaded.items():
+                entry['seq'] = next(self.counter)
+                self.entries[schedule_id] = entry
+            # Build the heap in one pass instead of pushing every entry
+            self.heap.extend((entry['due'], entry['seq'], entry['id']) for entry in loaded.values())
+            heapq.heapify(self.heap)
+            
+            self.journal_records += records
+            if not intact or self.journal_records > 2 * len(self.entries) + 1000:
+                try:
+                    self._compact_journal()
+                except OSError as e:
+                    self.log(f"Failed to compact schedule file {self.journal_path}: {e}")
+        if loaded:
+            self.log(f"Loaded {len(loaded)} scheduled messages from {self.journal_path}")
+    
+    def _compact_journal(self):
+        """Rewrite the journal with only the pending entries and reopen it for appending"""
+        if self.journal is not None:
+            self.journal.close()
+        directory = os.path.dirname(self.journal_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        
+        temp_path = self.journal_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            for entry in self.entries.values():
+                record = {key: value for key, value in entry.items() if key != 'seq'}
+                f.write(json.dumps(dict(record, op='add'), ensure_ascii=False) + '\n')
+        os.replace(temp_path, self.journal_path)
+        
+        self.journal = open(self.journal_path, 'a', encoding='utf-8')
+        self.journal_records = len(self.entries)
+    
+    def _write_journal(self, record):
+        """Append a record, compacting once most of the journal is obsolete"""
+        if self.journal is None:
+            return
+        record = {key: value for key, value in record.items() if key != 'seq'}
+        self.journal.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self.journal.flush()
+        self.journal_records += 1
+        # Entries still loading would be lost by compacting now
+        if not self.loading and self.journal_records > 10000 and self.journal_records > 4 * len(self.entries):
+            self._compact_journal()
+
+class MessageHistory:
+    """Persistent record of received messages in an SQLite database.
+    
+    add() only queues a record; a writer thread commits queued records in
+    batches, so delivery never waits for the disk. Records beyond
+    max_messages are deleted oldest first, in chunks. Readers page through
+    the records newest first with query() and count(), each thread on its
+    own connection. Text search uses an FTS5 trigram index when SQLite
+    provides one (for search text of three or more characters), LIKE otherwise.
+    """
+    QUEUE_SIZE = 100000
+    BATCH_SIZE = 1000
+    PRUNE_CHUNK = 1000
+    
+    def __init__(self, path, max_messages=0, search_index=True, log=None):
+        self.path = path
+        self.max_messages = int(max_messages)
+        self.log = log or (lambda message: None)
+        self.queue = queue.Queue(self.QUEUE_SIZE)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.dropped = 0
+        
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        connection = self._reader()
+        self.fts = self._create_schema(connection, search_index)
+        # Id of the newest committed record, readers poll it to notice new messages
+        self.last_id = connection.execute("SELECT MAX(id) FROM messages").fetchone()[0] or 0
+    
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=10)
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+    
+    def _reader(self):
+        """Connection of the calling thread"""
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = self.local.connection = self._connect()
+        return connection
+    
+    def release(self):
+        """Close the calling thread's connection"""
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
+    
+    @staticmethod
+    def _create_schema(connection, search_index):
+        """Create the tables if needed, returns whether the trigram search index is in use"""
+        connection.execute("PRAGMA journal_mode=WAL")
+        with connection:
+            connection.executescript("""
+                CREATE TABLE IF NOT EXISTS messages (
+                    id INTEGER PRIMARY KEY,
+                    received REAL NOT NULL,
+                    source TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    message TEXT NOT NULL,
+                    attachments TEXT
+                );
+                CREATE INDEX IF NOT EXISTS messages_source ON messages (source, id);
+                CREATE INDEX IF NOT EXISTS messages_status ON messages (status, id);
+            """)
+        
+        exists = connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").fetchone() is not None
+        if not search_index:
+            with connection:
+                connection.executescript("""
+                    DROP TRIGGER IF EXISTS messages_fts_insert;
+                    DROP TRIGGER IF EXISTS messages_fts_delete;
+                    DROP TABLE IF EXISTS messages_fts;
+                """)
+            return False
+        try:
+            with connection:
+                connection.executescript("""
+                    CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                        message, content='messages', content_rowid='id', tokenize='trigram'
+                    );
+                    CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+                        INSERT INTO messages_fts (rowid, message) VALUES (new.id, new.message);
+                    END;
+                    CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+                        INSERT INTO messages_fts (messages_fts, rowid, message) VALUES ('delete', old.id, old.message);
+                    END;
+                """)
+                if not exists:
+                    # Index the messages recorded while the index was turned off
+                    connection.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+        except sqlite3.OperationalError:
+            # SQLite without FTS5 or the trigram tokenizer (before 3.34)
+            return False
+        return True
+    
+    def add(self, message, source, status, attachments=None):
+        """Queue a message for recording, returns False if the queue is full"""
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._write, daemon=True)
+                self.thread.start()
+        try:
+            self.queue.put_nowait((time.time(), source, status, message,
+                                   json.dumps(attachments, ensure_ascii=False) if attachments else None))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+    
+    def close(self):
+        """Commit the queued records and stop the writer thread"""
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is not None:
+            self.queue.put(None)
+            thread.join(timeout=10.0)
+    
+    def _write(self):
+        """Writer loop, commits up to BATCH_SIZE queued records per transaction"""
+        connection = self._connect()
+        oldest = connection.execute("SELECT MIN(id) FROM messages").fetchone()[0] or 1
+        stopping = False
+        while not stopping:
+            record = self.queue.get()
+            batch = []
+            while record is not None:
+                batch.append(record)
+                if len(batch) >= self.BATCH_SIZE:
+                    break
+                try:
+                    record = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            stopping = record is None
+            if not batch:
+                continue
+            
+            try:
+                with connection:
+                    connection.executemany(
+                        "INSERT INTO messages (received, source, status, message, attachments) VALUES (?, ?, ?, ?, ?)",
+                        batch
+                    )
+                    last_id = connection.execute("SELECT MAX(id) FROM messages").fetchone()[0]
+                    if self.max_messages and last_id - oldest >= self.max_messages + self.PRUNE_CHUNK:
+                        oldest = last_id - self.max_messages + 1
+                        connection.execute("DELETE FROM messages WHERE id < ?", (oldest,))
+                self.last_id = last_id
+            except sqlite3.Error as e:
+                self.log(f"Failed to record {len(batch)} messages in the history: {e}")
+        connection.close()
+    
+    def _where(self, source=None, status=None, text=None):
+        """WHERE clause and parameters of a filter"""
+        clauses, params = [], []
+        if source:
+            clauses.append("source = ?")
+            params.append(source)
+        if status:
+            clauses.append("status = ?")
+            params.append(status)
+        if text and self.fts and len(text) >= 3:
+            # A quoted phrase matches as a substring with the trigram tokenizer
+            clauses.append("id IN (SELECT rowid FROM messages_fts WHERE messages_fts MATCH ?)")
+            params.append('"' + text.replace('"', '""') + '"')
+        elif text:
+            clauses.append("message LIKE ? ESCAPE '\\'")
+            params.append('%' + text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%')
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+    
+    def count(self, source=None, status=None, text=None):
+        """Number of records matching the filter"""
+        where, params = self._where(source, status, text)
+        return self._reader().execute(f"SELECT COUNT(*) FROM messages{where}", params).fetchone()[0]
+    
+    def query(self, offset, limit, source=None, status=None, text=None):
+        """Matching records newest first, as dicts with id, received, source, status, message and attachments"""
+        where, params = self._where(source, status, text)
+        rows = self._reader().execute(
+            f"SELECT id, received, source, status, message, attachments FROM messages{where} "
+            "ORDER BY id DESC LIMIT ? OFFSET ?",
+            params + [limit, offset]
+        ).fetchall()
+        return [{
+            'id': row[0],
+            'received': row[1],
+            'source': row[2],
+            'status': row[3],
+            'message': row[4],
+            'attachments': json.loads(row[5]) if row[5] else [],
+        } for row in rows]
+    
+    def sources(self):
+        """Distinct sources in the history"""
+        return [row[0] for row in self._reader().execute("SELECT DISTINCT source FROM messages ORDER BY source")]
+
+class SamplingProfiler:
+    """Statistical profiler sampling the stacks of every thread in the process.
+    
+    cProfile only instruments the thread that enables it, so the accept,
+    client, dispatch, forwarding and digest threads are sampled instead.
+    Samples are aggregated as collapsed stacks, one line per unique stack,
+    the input format of flamegraph.pl and speedscope.
+    """
+    def __init__(self, interval=0.005):
+        self.interval = float(interval)
+        self.stacks = {}
+        self.samples = 0
+        self.started_at = None
+        self.stop_event = threading.Event()
+        self.thread = None
+    
+    @property
+    def is_running(self):
+        return self.thread is not None
+    
+    def start(self):
+        """Start sampling"""
+        self.stacks = {}
+        self.samples = 0
+        self.started_at = time.monotonic()
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, name="notifypy-profiler", daemon=True)
+        self.thread.start()
+    
+    def stop(self):
+        """Stop sampling and return the collected stacks"""
+        if self.thread is not None:
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
+        return self.stacks
+    
+    def _run(self):
+        """Sampling loop"""
+        own_ident = threading.get_ident()
+        while not self.stop_event.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                calls = []
+                while frame is not None:
+                    code = frame.f_code
+                    calls.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                calls.append(names.get(ident, str(ident)))
+                stack = ';'.join(reversed(calls))
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+            self.samples += 1
+    
+    def top_functions(self, limit=10):
+        """Return (function, samples) pairs for the functions most often on top of a stack"""
+        leaves = {}
+        for stack, count in self.stacks.items():
+            leaf = stack.rsplit(';', 1)[-1]
+            leaves[leaf] = leaves.get(leaf, 0) + count
+        return sorted(leaves.items(), key=lambda item: item[1], reverse=True)[:limit]
+
+class Diagnostics:
+    """On-demand profiling, memory snapshots and thread dumps for a running server.
+    
+    Reports are written to the diagnostics directory so they can be collected
+    from a production machine without restarting the server.
+    """
+    def __init__(self, config, receiver, log):
+        self.config = config
+        self.receiver = receiver
+        self.log = log
+        self.profiler = None
+        self.last_snapshot = None
+        self.started_at = time.time()
+        self.lock = threading.Lock()
+        # Statistics supplied by the GUI thread, merged into stats()
+        self.extra_stats = {}
+    
+    def _report_path(self, kind, extension='txt'):
+        """Path of a new timestamped report file"""
+        directory = self.config.config.get('diagnostics_dir') or 'diagnostics'
+        if not os.path.isabs(directory):
+            directory = os.path.join(os.path.dirname(self.config.config_file), directory)
+        os.makedirs(directory, exist_ok=True)
+        stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+        return os.path.join(directory, f"{kind}-{stamp}-{os.getpid()}.{extension}")
+    
+    def dump_threads(self):
+        """Write the current stack of every thread to a file"""
+        frames = sys._current_frames()
+        lines = [f"Thread dump of process {os.getpid()} at {datetime.datetime.now().isoformat()}", ""]
+        for thread in threading.enumerate():
+            frame = frames.get(thread.ident)
+            daemon = " daemon" if thread.daemon else ""
+            lines.append(f'Thread "{thread.name}" ({thread.ident}){daemon}')
+            if frame is not None:
+                lines.extend(line.rstrip('\n') for line in traceback.format_stack(frame))
+            lines.append("")
+        
+        path = self._report_path('threads')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines))
+        return True, f"Thread stacks written to {path}"
+    
+    def start_profiler(self, interval=0.005):
+        """Start the sampling profiler"""
+        with self.lock:
+            if self.profiler is not None:
+                return False, "Profiler is already running"
+            self.profiler = SamplingProfiler(interval)
+            self.profiler.start()
+        return True, f"Profiler started, sampling every {interval * 1000:g} ms"
+    
+    def stop_profiler(self):
+        """Stop the sampling profiler and write the collapsed stacks to a file"""
+        with self.lock:
+            profiler, self.profiler = self.profiler, None
+        if profiler is None:
+            return False, "Profiler is not running"
+        
+        stacks = profiler.stop()
+        path = self._report_path('profile', 'folded')
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in sorted(stacks.items(), key=lambda item: item[1], reverse=True):
+                f.write(f"{stack} {count}\n")
+        
+        top = ', '.join(f"{name} {count}" for name, count in profiler.top_functions(5))
+        return True, f"Profiler stopped after {profiler.samples} samples, written to {path}. Top: {top}"
+    
+    def toggle_profiler(self):
+        """Start the profiler, or stop it if it is running"""
+        if self.profiler is not None:
+            return self.stop_profiler()
+        return self.start_profiler()
+    
+    def memory_snapshot(self):
+        """Write the largest allocations, and the growth since the previous snapshot, to a file.
+        
+        The first call only starts tracing since earlier allocations are not
+        tracked, take a second snapshot once the server has run for a while.
+        """
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(25)
+            self.last_snapshot = None
+            return True, "Memory tracing started, take another snapshot later to see allocations"
+        
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [f"Memory snapshot of process {os.getpid()} at {datetime.datetime.now().isoformat()}",
+                 f"Traced memory: {current} bytes, peak {peak} bytes",
+                 f"Live notification windows: {NotificationWindow.live_count()}",
+                 "", "Largest allocations:"]
+        lines.extend(str(stat) for stat in snapshot.statistics('lineno')[:30])
+        
+        if self.last_snapshot is not None:
+            lines.extend(["", "Growth since previous snapshot:"])
+            lines.extend(str(stat) for stat in snapshot.compare_to(self.last_snapshot, 'lineno')[:30])
+        self.last_snapshot = snapshot
+        
+        path = self._report_path('memory')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        return True, f"Memory snapshot written to {path}"
+    
+    def stop_memory_tracing(self):
+        """Stop tracing allocations"""
+        if not tracemalloc.is_tracing():
+            return False, "Memory tracing is not running"
+        tracemalloc.stop()
+        self.last_snapshot = None
+        return True, "Memory tracing stopped"
+    
+    def stats(self):
+        """Return a snapshot of the server state"""
+        receiver = self.receiver
+        forwarder = receiver.forwarder
+        digest = receiver.digest
+        stats = {
+            'pid': os.getpid(),
+            'uptime': round(time.time() - self.started_at, 1),
+            'running': receiver.is_running,
+            'workers': len(receiver.workers),
+            'connections': receiver.get_client_stats(),
+            'threads': [thread.name for thread in threading.enumerate()],
+            'forward_queue': forwarder.queue.qsize() if forwarder is not None else None,
+            'digest_buffered': len(digest.buffer) if digest is not None else None,
+            'scheduled': len(receiver.scheduler) if receiver.scheduler is not None else None,
+            'history_queue': receiver.history.queue.qsize() if receiver.history is not None else None,
+            'history_dropped': receiver.history.dropped if receiver.history is not None else None,
+            'notification_windows': NotificationWindow.live_count(),
+            'profiling': self.profiler is not None,
+            'tracing_memory': tracemalloc.is_tracing()
+        }
+        stats.update(self.extra_stats)
+        
+        # Process resources, only available on Linux
+        try:
+            stats['open_fds'] = len(os.listdir('/proc/self/fd'))
+            with open('/proc/self/statm') as f:
+                stats['rss_bytes'] = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError, IndexError):
+            pass
+        return stats
+    
+    def execute(self, command):
+        """Run a control command, returns (success, reply text)"""
+        parts = command.split()
+        if not parts:
+            return False, "Empty command"
+        name, args = parts[0].lower(), parts[1:]
+        
+        try:
+            if name == 'stats':
+                return True, json.dumps(self.stats())
+            if name == 'threads':
+                return self.dump_threads()
+            if name == 'profile' and args[:1] == ['start']:
+                interval = float(args[1]) / 1000 if len(args) > 1 else 0.005
+                if interval <= 0:
+                    return False, "Sampling interval must be positive"
+                return self.start_profiler(interval)
+            if name == 'profile' and args[:1] == ['stop']:
+                return self.stop_profiler()
+            if name == 'memory' and args[:1] == ['stop']:
+                return self.stop_memory_tracing()
+            if name == 'memory':
+                return self.memory_snapshot()
+        except Exception as e:
+            return False, f"Command failed: {str(e)}"
+        
+        return False, "Commands: stats, threads, profile start [interval_ms], profile stop, memory, memory stop"
+    
+    def install_signal_handlers(self):
+        """Dump thread stacks on SIGUSR1 and toggle the profiler on SIGUSR2 (POSIX only)"""
+        if not hasattr(signal, 'SIGUSR1'):
+            return
+        signal.signal(signal.SIGUSR1, lambda signum, frame: self.log(self.dump_threads()[1]))
+        signal.signal(signal.SIGUSR2, lambda signum, frame: self.log(self.toggle_profiler()[1]))
+
+class ControlServer:
+    """Local control socket accepting one diagnostics command per line.
+    
+    Listens on a Unix domain socket readable only by the current user, for example:
+        python server.py --control stats
+    """
+    def __init__(self, path, diagnostics, log):
+        self.path = path
+        self.diagnostics = diagnostics
+        self.log = log
+        self.server_socket = None
+        self.thread = None
+    
+    def start(self):
+        """Start listening, returns False when the control socket cannot be created"""
+        if not hasattr(socket, 'AF_UNIX'):
+            self.log("Control socket not supported on this platform")
+            return False
+        
+        try:
+            if os.path.exists(self.path):
+                if not self._is_stale():
+                    return False
+                # Remove a socket left behind by a previous run
+                os.unlink(self.path)
+            server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            old_umask = os.umask(0o177)
+            try:
+                server_socket.bind(self.path)
+            finally:
+                os.umask(old_umask)
+            server_socket.listen(5)
+        except OSError as e:
+            self.log(f"Failed to open control socket {self.path}: {str(e)}")
+            return False
+        
+        self.server_socket = server_socket
+        self.thread = threading.Thread(target=self._run, name="notifypy-control", daemon=True)
+        self.thread.start()
+        self.log(f"Control socket listening on {self.path}")
+        return True
+    
+    def _is_stale(self):
+        """Whether the existing path is a socket no running server listens on any more"""
+        if not stat.S_ISSOCK(os.stat(self.path).st_mode):
+            self.log(f"Control socket path {self.path} exists and is not a socket, leaving it alone")
+            return False
+        
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        probe.settimeout(1.0)
+        try:
+            probe.connect(self.path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            return True
+        except OSError:
+            # A live server may just have a full backlog, never take its socket away
+            pass
+        finally:
+            probe.close()
+        self.log(f"Control socket {self.path} is in use by another running server, control socket disabled")
+        return False
+    
+    def stop(self):
+        """Stop listening and remove the socket file"""
+        server_socket, self.server_socket = self.server_socket, None
+        if server_socket is None:
+            return
+        try:
+            server_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        server_socket.close()
+        if self.thread is not None:
+            self.thread.join(timeout=2.0)
+            self.thread = None
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+    
+    def _run(self):
+        """Accept loop, commands are handled one connection at a time"""
+        while self.server_socket is not None:
+            try:
+                client_socket, _ = self.server_socket.accept()
+            except OSError:
+                break
+            with client_socket:
+                client_socket.settimeout(5.0)
+                try:
+                    reader = client_socket.makefile('r', encoding='utf-8')
+                    for line in reader:
+                        _, reply = self.diagnostics.execute(line.strip())
+                        client_socket.sendall((reply + '\n').encode('utf-8'))
+                except OSError:
+                    pass
+
+def send_control_command(path, command, timeout=30.0):
+    """Send a command to a running server's control socket and return the reply"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as control_socket:
+        control_socket.settimeout(timeout)
+        control_socket.connect(path)
+        control_socket.sendall((command + '\n').encode('utf-8'))
+        control_socket.shutdown(socket.SHUT_WR)
+        return control_socket.makefile('r', encoding='utf-8').readline().rstrip('\n')
+
+def control_socket_path(config):
+    """Absolute path of the control socket, or None when it is disabled"""
+    path = config.config.get('control_socket', '')
+    if not path:
+        return None
+    if not os.path.isabs(path):
+        path = os.path.join(os.path.dirname(config.config_file), path)
+    return path
+
 class MessageReceiver:
     """Message receiving module, receives client messages via socket"""
     def __init__(self, config, gui):
         self.config = config
         self.gui = gui
         self.server_socket = None
+        self.http_socket = None
         self.is_running = False
-        self.clients = []
+        self.clients = ConnectionRegistry()
+        self.spool = None
+        self.admission = None
+        self.tls_context = None
+        self.listen_thread = None
+        self.wake_reader = None
+        self.wake_writer = None
+        self.workers = []
+        self.worker_queue = None
+        self.worker_wake_writer = None
+        self.worker_reply_writers = []
+        # The dispatch thread and apply_config() both write to the reply pipes
+        self.worker_reply_lock = threading.Lock()
+        self.forwarder = None
+        self.digest = None
+        self.scheduler = None
+        self.history = self._create_history()
+    
+    def start(self, host=None, port=None):
+        """Start server, listening on the configured address unless one is given"""
+        if self.is_running:
+            return False, "Server is already running"
+        
+        host = self.config.config['host'] if host is None else host
+        port = self.config.config['port'] if port is None else port
+        
+        self._start_forwarder()
+        self._start_digest()
+        self._start_scheduler()
+        
+        worker_count = int(self.config.config.get('workers', 1))
+        if worker_count > 1:
+            if hasattr(socket, 'SO_REUSEPORT'):
+                success, message = self._start_workers(worker_count, host, port)
+                if not success:
+                    self._stop_scheduler()
+                    self._stop_forwarder()
+                    self._stop_digest()
+                return success, message
+            self.gui.add_log_message("SO_REUSEPORT not available, falling back to a single process")
+        
+        try:
+            # Apply per-IP connection cap and rate limits
+            self.clients.max_per_ip = int(self.config.config.get('max_connections_per_ip', 0))
+            self.spool = self._create_spool()
+            self.admission = Admission(self.config.config)
+            self.tls_context = create_tls_context(
+                self.config.config.get('tls_certfile'),
+                self.config.config.get('tls_keyfile')
+            )
+            
+            # Create socket, bind address and port, and start listening
+            self.server_socket = create_server_socket(host, port, self.config.config['max_connections'])
+            self.http_socket = self._open_http(host)
+            
+            # Self-pipe used to wake the accept loop immediately on stop or rebind
+            self.wake_reader, self.wake_writer = socket.socketpair()
+            self.wake_reader.setblocking(False)
+            
+            # Set running state
+            self.is_running = True
+            
+            # Start listening thread
+            self.listen_thread = threading.Thread(target=self._listen_for_clients, daemon=True)
+            self.listen_thread.start()
+            
+            return True, f"Server started, listening on {host}:{port}{self._http_description(host)}"
+        except Exception as e:
+            if self.server_socket:
+                self.server_socket.close()
+                self.server_socket = None
+            if self.http_socket:
+                self.http_socket.close()
+                self.http_socket = None
+            self._stop_scheduler()
+            self._stop_forwarder()
+            self._stop_digest()
+            return False, f"Failed to start server: {str(e)}"
+    
+    def _create_spool(self):
+        """Create the attachment spool, relative directories are next to the config file"""
+        config_file = getattr(self.config, 'config_file', None)
+        base_dir = os.path.dirname(config_file) if config_file else os.getcwd()
+        return AttachmentSpool.from_config(self.config.config, base_dir)
+    
+    def _open_http(self, host):
+        """Open the HTTP ingest listener if an HTTP port is configured"""
+        http_port = int(self.config.config.get('http_port', 0))
+        if not http_port:
+            return None
+        return create_server_socket(host, http_port, self.config.config['max_connections'])
+    
+    def _http_description(self, host):
+        """Suffix describing the HTTP ingest listener in status messages"""
+        http_port = int(self.config.config.get('http_port', 0))
+        return f", HTTP ingest on {host}:{http_port}" if http_port else ""
+    
+    def _rebind_http(self, host):
+        """Replace the HTTP ingest listener after its address or port changed"""
+        old_socket = self.http_socket
+        self.http_socket = self._open_http(host)
+        self._wake()
+        if old_socket is not None:
+            # Hand over connections already waiting in the old socket's backlog
+            self._accept_pending(old_socket, self._serve_http)
+            old_socket.close()
+    
+    def _start_forwarder(self):
+        """Start forwarding to upstream servers if any are configured"""
+        upstreams = self.config.config.get('upstreams') or []
+        if not upstreams:
+            return
+        
+        forwarder = UpstreamForwarder(
+            upstreams,
+            self.gui.add_log_message,
+            batch_size=self.config.config.get('forward_batch_size', 50),
+            interval=self.config.config.get('forward_interval', 0.5),
+            queue_size=self.config.config.get('forward_queue_size', 1000),
+            token=self.config.config.get('forward_token', ''),
+            tls=self.config.config.get('forward_tls', False),
+            tls_cafile=self.config.config.get('forward_tls_cafile', '')
+        )
+        forwarder.start()
+        self.forwarder = forwarder
+        self.gui.add_log_message(f"Forwarding received messages to upstreams: {', '.join(map(str, upstreams))}")
+    
+    def _restart_forwarder(self):
+        """Replace the forwarder with one using the current settings, keeping pending messages"""
+        old_forwarder = self.forwarder
+        self.forwarder = None
+        self._start_forwarder()
+        if old_forwarder is None:
+            return
+        
+        old_forwarder.stop()
+        while True:
+            try:
+                item = old_forwarder.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None and self.forwarder is not None:
+                self.forwarder.submit(item['message'], item['source'], item.get('options'))
+    
+    def _stop_forwarder(self):
+        """Stop forwarding to upstream servers"""
+        if self.forwarder is not None:
+            self.forwarder.stop()
+            self.forwarder = None
     
-    def start(self):
-        """Start server"""
-        if self.is_running:
-            return False, "Server is already running"
+    def _start_digest(self):
+        """Start collecting low-priority messages into digests if enabled"""
+        window = float(self.config.config.get('digest_window', 0))
+        if window <= 0:
+            return
+        
+        digest = DigestScheduler(
+            self.gui.show_notification,
+            window=window,
+            max_messages=self.config.config.get('digest_max_messages', 0)
+        )
+        digest.start()
+        self.digest = digest
+        self.gui.add_log_message(f"Digest mode enabled, summarizing messages every {window:g}s")
+    
+    def _stop_digest(self):
+        """Stop digest mode, delivering any buffered messages"""
+        if self.digest is not None:
+            digest, self.digest = self.digest, None
+            digest.stop()
+    
+    def _start_scheduler(self):
+        """Start the delivery scheduler, loading messages scheduled before the last stop"""
+        path = self.config.config.get('schedule_file', '')
+        if path and not os.path.isabs(path):
+            config_file = getattr(self.config, 'config_file', None)
+            path = os.path.join(os.path.dirname(config_file) if config_file else os.getcwd(), path)
         
+        scheduler = DeliveryScheduler(self._deliver, path or None, self.config.config.get('max_scheduled', 0),
+                                      self.gui.add_log_message)
         try:
-            # Wait a short time to ensure previous socket is fully closed
-            time.sleep(0.5)
-            
-            # Create socket
-            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            
-            # Set socket options to reuse address and port
-            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            
-            # On some platforms, SO_REUSEPORT might be needed as well (if available)
-            # This is not available on all systems, so we use try/except
-            try:
-                self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
-            except (AttributeError, OSError):
-                # SO_REUSEPORT not available on this platform
-                pass
-                
-            # Set socket timeout to avoid blocking indefinitely
-            self.server_socket.settimeout(1.0)
+            scheduler.start()
+        except (OSError, ValueError) as e:
+            # Keep scheduling in memory rather than refusing to start
+            self.gui.add_log_message(f"Cannot use schedule file {path}: {e}, scheduled messages are not persisted")
+            scheduler = DeliveryScheduler(self._deliver, None, self.config.config.get('max_scheduled', 0),
+                                          self.gui.add_log_message)
+            scheduler.start()
+        self.scheduler = scheduler
+    
+    def _create_history(self):
+        """Open the message history database if enabled, relative paths are next to the config file"""
+        path = self.config.config.get('history_file', '')
+        if not path:
+            return None
+        if not os.path.isabs(path):
+            config_file = getattr(self.config, 'config_file', None)
+            path = os.path.join(os.path.dirname(config_file) if config_file else os.getcwd(), path)
+        try:
+            return MessageHistory(path, self.config.config.get('history_max_messages', 0),
+                                  self.config.config.get('history_search_index', True), self.gui.add_log_message)
+        except (OSError, sqlite3.Error) as e:
+            self.gui.add_log_message(f"Cannot open message history {path}: {e}")
+            return None
+    
+    def close_history(self):
+        """Write out the queued history records, called when the application exits"""
+        if self.history is not None:
+            self.history.close()
+    
+    def _stop_scheduler(self):
+        """Stop the delivery scheduler, pending messages stay in the schedule file"""
+        if self.scheduler is not None:
+            scheduler, self.scheduler = self.scheduler, None
+            scheduler.stop()
+    
+    def _worker_settings(self, worker_count):
+        """Settings passed to worker processes at start and after a reload"""
+        settings = {
+            'backlog': self.config.config['max_connections'],
+            'drain_timeout': float(self.config.config.get('drain_timeout', 2.0)),
+            'max_connections_per_ip': int(self.config.config.get('max_connections_per_ip', 0)),
+            'idle_timeout': float(self.config.config.get('idle_timeout', 0)),
+            'workers': worker_count,
+            'attachment_dir': self._create_spool().directory,
+            # Only messages that are forwarded without being shown here can be throttled
+            'reply_locally': self.forwarder is None or bool(self.config.config.get('deliver_locally', True)),
+            'digest': self.digest is not None
+        }
+        for key in ('ip_rate_limit', 'ip_rate_burst', 'token_rate_limit', 'token_rate_burst',
+                    'auth_tokens', 'forward_token', 'tls_certfile', 'tls_keyfile', 'http_port', 'http_max_body',
+                    'max_attachment_size', 'max_attachments', 'attachment_spool_size'):
+            if key in self.config.config:
+                settings[key] = self.config.config[key]
+        return settings
+    
+    def _start_workers(self, worker_count, host, port):
+        """Start pre-forked worker processes sharing the listening port"""
+        try:
+            # Use spawn so workers do not inherit the Tk interpreter state
+            context = multiprocessing.get_context('spawn')
+            self.worker_queue = context.Queue()
+            wake_reader, self.worker_wake_writer = context.Pipe(duplex=False)
+            self.worker_reply_writers = []
+            settings = self._worker_settings(worker_count)
             
-            # Bind address and port
-            self.server_socket.bind((self.config.config['host'], self.config.config['port']))
+            for worker_id in range(worker_count):
+                # Delivery statuses go back to each worker on its own pipe
+                reply_reader, reply_writer = context.Pipe(duplex=False)
+                self.worker_reply_writers.append(reply_writer)
+                process = context.Process(
+                    target=_worker_main,
+                    args=(worker_id, host, port, settings, self.worker_queue, wake_reader, reply_reader),
+                    daemon=True
+                )
+                process.start()
+                reply_reader.close()
+                self.workers.append(process)
+            wake_reader.close()
             
-            # Start listening
-            self.server_socket.listen(self.config.config['max_connections'])
+            # Wait until every worker is listening so start() reports bind errors
+            for _ in range(worker_count):
+                item = self.worker_queue.get(timeout=30)
+                if item[0] == 'error':
+                    raise RuntimeError(item[1])
             
             # Set running state
             self.is_running = True
             
-            # Start listening thread
-            self.listen_thread = threading.Thread(target=self._listen_for_clients, daemon=True)
-            self.listen_thread.start()
+            # Start dispatch thread forwarding worker messages to the delivery path,
+            # it keeps serving this generation of workers until they are stopped
+            self.dispatch_thread = threading.Thread(
+                target=self._dispatch_worker_messages,
+                args=(self.worker_queue, self.worker_reply_writers),
+                daemon=True
+            )
+            self.dispatch_thread.start()
             
-            return True, f"Server started, listening on {self.config.config['host']}:{self.config.config['port']}"
+            return True, (f"Server started with {worker_count} worker processes, "
+                          f"listening on {host}:{port}{self._http_description(host)}")
         except Exception as e:
-            return False, f"Failed to start server: {str(e)}"
+            self._stop_workers()
+            return False, f"Failed to start worker processes: {str(e)}"
+    
+    def _stop_workers(self):
+        """Stop worker processes and the dispatch thread"""
+        if self.worker_wake_writer is not None:
+            # Every worker selects on the pipe, one message wakes them all
+            try:
+                self.worker_wake_writer.send_bytes(b'stop')
+            except OSError:
+                pass  # Every worker has exited already
+        
+        drain_timeout = float(self.config.config.get('drain_timeout', 2.0))
+        deadline = time.monotonic() + drain_timeout + 1.0
+        for process in self.workers:
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                process.terminate()
+        self.workers = []
+        
+        if self.worker_wake_writer is not None:
+            self.worker_wake_writer.close()
+            self.worker_wake_writer = None
+        
+        if self.worker_queue is not None:
+            # Wake the dispatch thread so it can exit
+            self.worker_queue.put(None)
+            self.worker_queue = None
+        
+        with self.worker_reply_lock:
+            for reply_writer in self.worker_reply_writers:
+                reply_writer.close()
+            self.worker_reply_writers = []
+    
+    def _restart_workers(self, host, port):
+        """Replace the worker processes without refusing connections.
+        
+        The new workers bind the port next to the old ones (SO_REUSEPORT) and
+        the old ones are only stopped once every new one is listening.
+        """
+        old = (self.workers, self.worker_queue, self.worker_wake_writer, self.worker_reply_writers)
+        self.workers, self.worker_queue, self.worker_wake_writer, self.worker_reply_writers = [], None, None, []
+        success, message = self._start_workers(int(self.config.config.get('workers', 1)), host, port)
+        new = (self.workers, self.worker_queue, self.worker_wake_writer, self.worker_reply_writers)
+        
+        # On failure the old workers simply keep serving
+        self.workers, self.worker_queue, self.worker_wake_writer, self.worker_reply_writers = old
+        if success:
+            self._stop_workers()
+            self.workers, self.worker_queue, self.worker_wake_writer, self.worker_reply_writers = new
+        return success, message
+    
+    def _update_workers(self):
+        """Send reloaded settings to the running worker processes"""
+        settings = self._worker_settings(len(self.workers))
+        with self.worker_reply_lock:
+            for reply_writer in self.worker_reply_writers:
+                try:
+                    reply_writer.send(('settings', settings))
+                except OSError:
+                    pass  # The worker has exited
     
     def stop(self):
-        """Stop server"""
+        """Stop server, letting in-flight connections finish within drain_timeout seconds"""
         if not self.is_running:
             return False, "Server is not running"
         
@@ -240,98 +3331,782 @@ class MessageReceiver:
             # Set to not running state first to stop accept loop
             self.is_running = False
             
-            # Close all client connections
-            clients_copy = self.clients.copy()  # Create a copy to avoid modification during iteration
-            for client in clients_copy:
-                try:
-                    client.close()
-                except Exception as e:
-                    print(f"Error closing client connection: {e}")
+            # Stop worker processes if running in multi-process mode
+            if self.workers:
+                self._stop_workers()
+                self._stop_scheduler()
+                self._stop_forwarder()
+                self._stop_digest()
+                return True, "Server stopped"
             
-            # Clear clients list
-            self.clients.clear()
+            # Wake the accept loop and wait for it to exit
+            self._wake()
+            if self.listen_thread is not None:
+                self.listen_thread.join(timeout=1.0)
+                self.listen_thread = None
             
-            # Close server socket
+            # Close server socket so no new connections are queued
             if self.server_socket:
-                try:
-                    # Shutdown socket to release it immediately
-                    self.server_socket.shutdown(socket.SHUT_RDWR)
-                except Exception as e:
-                    # Socket might not be connected
-                    print(f"Socket shutdown error (can be ignored): {e}")
-                
-                # Close the socket
                 self.server_socket.close()
                 self.server_socket = None  # Clear the socket to allow for restart
+            if self.http_socket:
+                self.http_socket.close()
+                self.http_socket = None
             
-            # Wait a moment to ensure socket is fully released
-            time.sleep(0.5)
+            # Idle stream connections would never finish on their own, close them right away
+            # (an unacknowledged batch is resent by the forwarding server)
+            self.clients.shutdown_streams()
+            
+            # Drain in-flight connections until the deadline, then close the rest
+            if not self.clients.wait_until_empty(float(self.config.config.get('drain_timeout', 2.0))):
+                self.clients.shutdown_all()
+            
+            self.wake_reader.close()
+            self.wake_writer.close()
+            self.wake_reader = self.wake_writer = None
+            
+            # Stop forwarding after draining so in-flight messages are still queued,
+            # the scheduler first since it delivers through the forwarder and digest
+            self._stop_scheduler()
+            self._stop_forwarder()
+            self._stop_digest()
             
             return True, "Server stopped"
         except Exception as e:
             return False, f"Failed to stop server: {str(e)}"
     
+    def rebind(self, host, port):
+        """Move the listener to a new address without refusing connections.
+        
+        The new socket is bound before the old one is closed, and connections
+        already queued on the old socket are handed over to client threads.
+        Worker processes are replaced by new ones on the new address instead (see _restart_workers()).
+        """
+        if not self.is_running:
+            return False, "Server is not running"
+        
+        if self.workers:
+            return self._restart_workers(host, port)
+        
+        old_socket = self.server_socket
+        try:
+            new_socket = create_server_socket(host, port, self.config.config['max_connections'])
+        except Exception as e:
+            return False, f"Failed to rebind server: {str(e)}"
+        
+        # Swap sockets and wake the accept loop so it selects on the new one
+        self.server_socket = new_socket
+        self._wake()
+        
+        # Hand over connections already waiting in the old socket's backlog
+        self._accept_pending(old_socket)
+        old_socket.close()
+        
+        if self.http_socket is not None:
+            try:
+                self._rebind_http(host)
+            except Exception as e:
+                return False, f"Server rebound to {host}:{port}, but the HTTP listener failed: {str(e)}"
+        
+        return True, f"Server rebound, listening on {host}:{port}{self._http_description(host)}"
+    
+    def apply_config(self, old_config, changed):
+        """Apply reloaded settings to the running server.
+        
+        Only a change of the listen address rebinds the socket, everything else
+        is applied in place so open connections are kept. Worker processes are
+        sent their new settings, and replaced by new ones started before the old
+        ones stop when they have to bind again. Returns (success, message).
+        """
+        # The history is kept open while the server is stopped
+        if set(changed) & {'history_file', 'history_max_messages', 'history_search_index'}:
+            self.close_history()
+            self.history = self._create_history()
+        
+        if not self.is_running:
+            return True, "Server is not running, new settings apply on next start"
+        
+        config = self.config.config
+        changed = set(changed)
+        # Worker processes bind their own sockets, the rest of their settings is sent to them
+        rebind_keys = {'host', 'port', 'workers', 'max_connections', 'http_port'}
+        worker_keys = {'max_connections_per_ip', 'idle_timeout', 'drain_timeout', 'ip_rate_limit', 'ip_rate_burst',
+                       'token_rate_limit', 'token_rate_burst', 'auth_tokens', 'forward_token', 'tls_certfile',
+                       'tls_keyfile', 'http_max_body', 'attachment_dir', 'max_attachment_size', 'max_attachments',
+                       'attachment_spool_size', 'upstreams', 'deliver_locally', 'digest_window'}
+        forward_keys = {'upstreams', 'forward_batch_size', 'forward_interval', 'forward_queue_size',
+                        'forward_token', 'forward_tls', 'forward_tls_cafile'}
+        
+        # Switching between one and several processes needs a full restart
+        if 'workers' in changed and bool(self.workers) != (int(config.get('workers', 1)) > 1):
+            self.stop()
+            return self.start()
+        
+        if changed & forward_keys:
+            self._restart_forwarder()
+        if changed & {'digest_window', 'digest_max_messages'}:
+            self._stop_digest()
+            self._start_digest()
+        if changed & {'schedule_file', 'max_scheduled'}:
+            self._stop_scheduler()
+            self._start_scheduler()
+        
+        if self.workers:
+            if changed & rebind_keys:
+                return self._restart_workers(config['host'], config['port'])
+            if changed & worker_keys:
+                self._update_workers()
+            return True, "Settings applied to the running server"
+        
+        if 'max_connections_per_ip' in changed:
+            self.clients.max_per_ip = int(config.get('max_connections_per_ip', 0))
+        if changed & {'attachment_dir', 'max_attachment_size', 'max_attachments', 'attachment_spool_size'}:
+            self.spool = self._create_spool()
+        if changed & {'ip_rate_limit', 'ip_rate_burst', 'token_rate_limit', 'token_rate_burst', 'auth_tokens',
+                      'forward_token'}:
+            self.admission = Admission(config)
+        if changed & {'tls_certfile', 'tls_keyfile'}:
+            # New connections use the new certificate, open ones keep theirs
+            self.tls_context = create_tls_context(config.get('tls_certfile'), config.get('tls_keyfile'))
+        if 'idle_timeout' in changed:
+            # Let the accept loop pick up the new reaping interval
+            self._wake()
+        
+        if changed & {'host', 'port'}:
+            return self.rebind(config['host'], config['port'])
+        if 'http_port' in changed:
+            try:
+                self._rebind_http(config['host'])
+            except Exception as e:
+                return False, f"Failed to open the HTTP listener: {str(e)}"
+        if 'max_connections' in changed:
+            # Calling listen() again resizes the accept backlog
+            self.server_socket.listen(config['max_connections'])
+        
+        return True, "Settings applied to the running server"
+    
+    def _wake(self):
+        """Wake the accept loop"""
+        try:
+            self.wake_writer.send(b'\0')
+        except (AttributeError, OSError):
+            pass
+    
+    def _dispatch_worker_messages(self, message_queue, reply_writers):
+        """Forward messages received by one generation of worker processes to the delivery path"""
+        self.gui.update_status("Server is listening for client connections...")
+        
+        while True:
+            try:
+                item = message_queue.get()
+            except (EOFError, OSError):
+                break
+            if item is None:
+                break
+            
+            if item[0] == 'message':
+                _, message, client_address, options, worker_id, request_id = item
+                try:
+                    status = self._deliver(message, client_address, options)
+                except Exception as e:
+                    self.gui.add_log_message(f"Error delivering message from {client_address[0]}: {e}")
+                    status = 'throttled'  # Not delivered, let the client retry
+                if request_id is None:
+                    continue  # The worker already answered the client
+                try:
+                    with self.worker_reply_lock:
+                        reply_writers[worker_id].send((request_id, status))
+                except (IndexError, OSError):
+                    pass  # The workers were stopped meanwhile
+            else:
+                self.gui.update_status(item[1])
+                self.gui.add_log_message(item[1])
+    
     def _listen_for_clients(self):
         """Listen for client connections"""
         self.gui.update_status("Server is listening for client connections...")
         
+        last_reap = time.monotonic()
+        
         while self.is_running:
+            # Read on every pass so reloaded settings take effect
+            idle_timeout = float(self.config.config.get('idle_timeout', 0))
+            interval = reap_interval(idle_timeout)
+            server_socket = self.server_socket
+            http_socket = self.http_socket
+            listeners = [server_socket, self.wake_reader] + ([http_socket] if http_socket else [])
             try:
-                # Accept client connection with timeout
-                client_socket, client_address = self.server_socket.accept()
-                self.clients.append(client_socket)
-                
-                # Update status
-                self.gui.update_status(f"Accepted connection from {client_address[0]}:{client_address[1]}")
-                
-                # Start client handling thread
-                client_thread = threading.Thread(
-                    target=self._handle_client,
-                    args=(client_socket, client_address),
-                    daemon=True
-                )
-                client_thread.start()
-            except socket.timeout:
-                # This is expected due to the socket timeout we set
-                # Just continue the loop to check if we should still be running
-                continue
-            except socket.error as e:
+                # Wait for a connection or a wake-up from stop() or rebind()
+                readable, _, _ = select.select(listeners, [], [], interval)
+            except (OSError, ValueError) as e:
+                if server_socket is not self.server_socket or http_socket is not self.http_socket:
+                    # The socket was replaced by rebind() and closed
+                    continue
                 if self.is_running:  # Only report error if server should be running
                     self.gui.update_status(f"Error listening for client connections: {e}")
                 break
+            
+            if interval is not None and time.monotonic() - last_reap >= interval:
+                for connection in self.clients.reap_idle(idle_timeout):
+                    self.gui.add_log_message(f"Closed idle connection from {connection.address[0]}:{connection.address[1]}")
+                last_reap = time.monotonic()
+            
+            if self.wake_reader in readable:
+                try:
+                    self.wake_reader.recv(4096)
+                except BlockingIOError:
+                    pass
+                continue
+            try:
+                if http_socket in readable:
+                    self._accept_pending(http_socket, self._serve_http)
+                if server_socket in readable:
+                    self._accept_pending(server_socket)
             except Exception as e:
-                if self.is_running:
+                if self.is_running and server_socket is self.server_socket and http_socket is self.http_socket:
                     self.gui.update_status(f"Unexpected error in listener: {e}")
-                break
+                    break
+    
+    def _accept_pending(self, server_socket, serve=None):
+        """Accept every connection queued on a listening socket, serving each in its own thread"""
+        serve = serve or self._serve_client
+        while True:
+            try:
+                client_socket, client_address = server_socket.accept()
+            except BlockingIOError:
+                return
+            # Accepted sockets may inherit non-blocking mode from the listener on some platforms
+            client_socket.setblocking(True)
+            
+            connection = self.clients.add(client_socket, client_address)
+            if connection is None:
+                self.gui.add_log_message(f"Rejected connection from {client_address[0]}: per-IP connection limit reached")
+                reject_client(client_socket, "Too many connections from this address")
+                continue
+            
+            # Update status
+            self.gui.update_status(f"Accepted connection from {client_address[0]}:{client_address[1]}")
+            
+            # Start client handling thread
+            client_thread = threading.Thread(
+                target=self._handle_client,
+                args=(connection, serve),
+                daemon=True
+            )
+            client_thread.start()
     
-    def _handle_client(self, client_socket, client_address):
+    def _handle_client(self, connection, serve):
         """Handle client messages"""
         try:
-            # Receive message
-            message = client_socket.recv(4096).decode('utf-8')
-            
-            if message:
-                # Update status
-                status_msg = f"Received message from {client_address[0]}:{client_address[1]}"
-                self.gui.update_status(status_msg)
-                self.gui.add_log_message(status_msg)
-                
-                # Show notification
-                self.gui.show_notification(message)
-                
-                # Send confirmation to client
-                client_socket.send("Message received".encode('utf-8'))
+            serve(
+                connection.socket,
+                connection.address,
+                self._deliver,
+                connection,
+                self.admission,
+                self.tls_context
+            )
         except Exception as e:
-            self.gui.update_status(f"Error handling client message: {str(e)}")
+            if self.is_running:
+                self.gui.update_status(f"Error handling client message: {str(e)}")
         finally:
             # Close client connection
-            client_socket.close()
-            if client_socket in self.clients:
-                self.clients.remove(client_socket)
+            connection.socket.close()
+            self.clients.remove(connection)
+    
+    def _serve_client(self, client_socket, client_address, deliver, connection, admission, tls_context):
+        """Serve a socket client, spooling its attachments and capping envelopes at the HTTP body size limit"""
+        serve_client(client_socket, client_address, deliver, connection, admission, tls_context, self.spool,
+                     int(self.config.config.get('http_max_body', HTTP_DEFAULT_MAX_BODY)))
+    
+    def _serve_http(self, client_socket, client_address, deliver, connection, admission, tls_context):
+        """Serve an HTTP ingest connection with the configured body size limit"""
+        serve_http(client_socket, client_address, deliver, connection, admission, tls_context,
+                   int(self.config.config.get('http_max_body', HTTP_DEFAULT_MAX_BODY)))
+    
+    def get_client_stats(self):
+        """Return per-client statistics for the open connections"""
+        return [connection.info() for connection in self.clients.snapshot()]
+    
+    def _deliver(self, message, client_address, options=None):
+        """Deliver a received message to the GUI or headless sink and upstream servers.
+        
+        Returns 'queued' when the message was only queued for forwarding,
+        buffered for the next digest or scheduled for later, 'expired', 'full'
+        or 'duplicate' when a scheduled message was refused, and 'throttled' when the
+        forwarding queue is full and the message is not shown here either
+        (the client resends it). A None message with a
+        "cancel" option cancels a scheduled message, returning 'cancelled'
+        or 'not_found'. A "token" option is the client's token, it only decides
+        who may cancel a scheduled message and is not passed on.
+        """
+        options = options or {}
+        token = options.get('token')
+        if 'token' in options:
+            options = {key: value for key, value in options.items() if key != 'token'}
+        if 'cancel' in options:
+            return self._cancel_scheduled(options['cancel'], client_address, token)
+        if any(key in options for key in SCHEDULE_OPTIONS):
+            status = self._schedule(message, client_address, options, token)
+            if status is not None:
+                return status
+            options = {key: value for key, value in options.items() if key not in SCHEDULE_OPTIONS}
+        
+        # Update status
+        status_msg = f"Received message from {client_address[0]}:{client_address[1]}"
+        self.gui.update_status(status_msg)
+        self.gui.add_log_message(status_msg)
+        
+        # Forward to upstream servers, blocking the client while the queue is full
+        forwarder = self.forwarder
+        forwarded_only = False
+        if forwarder is not None:
+            # Spooled attachments stay on this server, upstreams only get the text
+            forward_options = {key: value for key, value in options.items() if key != 'attachments'}
+            forwarded = forwarder.submit(message, client_address, forward_options)
+            forwarded_only = not self.config.config.get('deliver_locally', True)
+            if not forwarded and forwarded_only:
+                # Nothing was kept, the client resends the message after a pause
+                self.gui.add_log_message(f"Forwarding queue full, asking {client_address[0]} to resend")
+                return 'throttled'
+            if not forwarded:
+                self.gui.add_log_message(f"Forwarding queue full, message from {client_address[0]} only delivered locally")
+        
+        # Record for the history browser
+        history = self.history
+        if history is not None:
+            history.add(message, client_address[0], classify_message(message), options.get('attachments'))
+        if forwarded_only:
+            return 'queued'
+        
+        # Buffer for the next digest unless the sender marked the message as high priority
+        # (messages with attachments are shown right away, a digest has no room for them)
+        digest = self.digest
+        attachments = options.get('attachments')
+        if digest is not None and options.get('priority') != 'high' and not attachments:
+            digest.add(message, client_address)
+            return 'queued'
+        
+        # Show notification
+        if attachments:
+            self.gui.show_notification(message, attachments)
+        else:
+            self.gui.show_notification(message)
+        return 'accepted'
+
+    def _schedule(self, message, client_address, options, token=None):
+        """Hand a message with deliver_at, delay or expire_at to the scheduler.
+        
+        Returns the delivery status, or None when the message is due now and
+        should be delivered right away.
+        """
+        now = time.time()
+        try:
+            deliver_at = float(options['deliver_at']) if options.get('deliver_at') is not None else None
+            if options.get('delay') is not None:
+                deliver_at = now + float(options['delay'])
+            expire_at = float(options['expire_at']) if options.get('expire_at') is not None else None
+        except (TypeError, ValueError):
+            self.gui.add_log_message(f"Invalid schedule from {client_address[0]}, delivering the message now")
+            return None
+        
+        if expire_at is not None and expire_at <= max(now, deliver_at or now):
+            self.gui.add_log_message(f"Message from {client_address[0]} expired before delivery")
+            return 'expired'
+        
+        scheduler = self.scheduler
+        if deliver_at is None or deliver_at <= now or scheduler is None:
+            return None
+        
+        schedule_id = str(options.get('schedule_id') or uuid.uuid4().hex)
+        rest = {key: value for key, value in options.items() if key not in SCHEDULE_OPTIONS}
+        status = scheduler.add(schedule_id, deliver_at, expire_at, message, client_address, rest,
+                               schedule_owner(token, client_address))
+        if status == 'full':
+            self.gui.add_log_message(f"Schedule full, message from {client_address[0]} refused")
+            return status
+        if status == 'duplicate':
+            self.gui.add_log_message(f"Schedule id {schedule_id} from {client_address[0]} is already pending, message refused")
+            return status
+        
+        when = datetime.datetime.fromtimestamp(deliver_at).strftime('%Y-%m-%d %H:%M:%S')
+        self.gui.add_log_message(f"Message {schedule_id} from {client_address[0]} scheduled for {when}")
+        return 'queued'
+    
+    def _cancel_scheduled(self, schedule_id, client_address, token=None):
+        """Cancel a scheduled message of the same sender, returns 'cancelled' or 'not_found'"""
+        scheduler = self.scheduler
+        # Someone else's message is reported as missing, its id is not confirmed either
+        if scheduler is None or not scheduler.cancel(schedule_id, schedule_owner(token, client_address)):
+            return 'not_found'
+        self.gui.add_log_message(f"Scheduled message {schedule_id} cancelled by {client_address[0]}")
+        return 'cancelled'
+
+class HistoryBrowser:
+    """Message history window, a virtual list over a MessageHistory.
+    
+    Only the rows that fit in the window exist as Treeview items, scrolling
+    changes which records they show. Records are fetched in blocks by a
+    background thread and the most recently used blocks are cached, so Tk
+    never waits on the database however many messages are stored. Filters
+    by source, status and text apply shortly after the user stops typing.
+    """
+    BLOCK_SIZE = 200
+    CACHED_BLOCKS = 20
+    FILTER_DELAY = 250  # Milliseconds of typing pause before a filter is applied
+    POLL_INTERVAL = 50  # Milliseconds between checks for fetched records
+    REFRESH_INTERVAL = 1.0  # Seconds between checks for new messages
+    STATUS_CHOICES = ('All', 'success', 'failure', 'info')
+    
+    def __init__(self, parent, history, thumbnails=None):
+        self.history = history
+        self.thumbnails = thumbnails
+        self.filters = (None, None, None)
+        self.generation = 0
+        self.total = None  # Matching records, None until counted
+        self.offset = 0
+        self.visible = 20
+        self.selected = None  # Index of the selected record
+        self.blocks = collections.OrderedDict()
+        self.previous_blocks = {}  # Shown while refreshed blocks are fetched
+        self.requested = set()
+        self.counting = False
+        self.requests = queue.Queue()
+        self.results = queue.Queue()
+        self.last_id = history.last_id
+        self.last_refresh = time.monotonic()
+        self.filter_job = None
+        self.poll_job = None
+        
+        self.window = tk.Toplevel(parent)
+        self.window.title("Message History")
+        self.window.geometry("900x500")
+        self.window.protocol("WM_DELETE_WINDOW", self.close)
+        self.create_widgets()
+        
+        # Queries run in a background thread, results are picked up by poll()
+        self.thread = threading.Thread(target=self._fetch, daemon=True)
+        self.thread.start()
+        self.requests.put((None, 'sources', None, None))
+        self.apply_filters()
+        self.poll()
+    
+    def create_widgets(self):
+        """Create the filter bar and the list"""
+        filter_frame = ttk.Frame(self.window, padding=(10, 10, 10, 5))
+        filter_frame.pack(fill=tk.X)
+        
+        ttk.Label(filter_frame, text="Source:").pack(side=tk.LEFT)
+        self.source_var = tk.StringVar()
+        self.source_box = ttk.Combobox(
+            filter_frame,
+            textvariable=self.source_var,
+            width=16,
+            # Refresh the sources in the background each time the list opens
+            postcommand=lambda: self.requests.put((None, 'sources', None, None))
+        )
+        self.source_box.pack(side=tk.LEFT, padx=(5, 15))
+        
+        ttk.Label(filter_frame, text="Status:").pack(side=tk.LEFT)
+        self.status_var = tk.StringVar(value='All')
+        status_box = ttk.Combobox(filter_frame, textvariable=self.status_var, values=self.STATUS_CHOICES,
+                                  state='readonly', width=9)
+        status_box.pack(side=tk.LEFT, padx=(5, 15))
+        
+        ttk.Label(filter_frame, text="Search:").pack(side=tk.LEFT)
+        self.text_var = tk.StringVar()
+        search_entry = ttk.Entry(filter_frame, textvariable=self.text_var, width=30)
+        search_entry.pack(side=tk.LEFT, padx=(5, 15), fill=tk.X, expand=True)
+        
+        self.count_var = tk.StringVar(value="Loading...")
+        ttk.Label(filter_frame, textvariable=self.count_var).pack(side=tk.RIGHT)
+        
+        for variable in (self.source_var, self.status_var, self.text_var):
+            variable.trace_add('write', self.schedule_filter)
+        
+        # List area
+        list_frame = ttk.Frame(self.window, padding=(10, 0, 10, 10))
+        list_frame.pack(fill=tk.BOTH, expand=True)
+        
+        # Fixed row height, so the number of visible rows follows from the widget height
+        self.row_height = tkfont.nametofont('TkDefaultFont').metrics('linespace') + 6
+        ttk.Style(self.window).configure('History.Treeview', rowheight=self.row_height)
+        
+        self.tree = ttk.Treeview(
+            list_frame,
+            columns=('received', 'source', 'status', 'message'),
+            show='headings',
+            selectmode='browse',
+            style='History.Treeview'
+        )
+        for column, heading, width, stretch in (('received', "Received", 140, False), ('source', "Source", 110, False),
+                                                ('status', "Status", 70, False), ('message', "Message", 500, True)):
+            self.tree.heading(column, text=heading)
+            self.tree.column(column, width=width, stretch=stretch)
+        self.tree.tag_configure('failure', foreground="#c0392b")
+        self.tree.tag_configure('success', foreground="#27ae60")
+        self.tree.tag_configure('loading', foreground="#999999")
+        self.tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        
+        self.scrollbar = ttk.Scrollbar(list_frame, command=self.on_scrollbar)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        
+        # The Treeview only holds the visible rows, so scrolling and keyboard navigation are handled here
+        self.tree.bind('<Configure>', self.on_resize)
+        self.tree.bind('<MouseWheel>', lambda event: self.scroll_by(-3 if event.delta > 0 else 3))
+        self.tree.bind('<Button-4>', lambda event: self.scroll_by(-3))
+        self.tree.bind('<Button-5>', lambda event: self.scroll_by(3))
+        self.tree.bind('<Up>', lambda event: self.move_selection(-1))
+        self.tree.bind('<Down>', lambda event: self.move_selection(1))
+        self.tree.bind('<Prior>', lambda event: self.move_selection(-self.visible))
+        self.tree.bind('<Next>', lambda event: self.move_selection(self.visible))
+        self.tree.bind('<Home>', lambda event: self.select(0))
+        self.tree.bind('<End>', lambda event: self.select((self.total or 1) - 1))
+        self.tree.bind('<<TreeviewSelect>>', self.on_select)
+        self.tree.bind('<Double-1>', self.open_selected)
+        self.tree.bind('<Return>', self.open_selected)
+    
+    def schedule_filter(self, *args):
+        """Apply the filters once typing pauses"""
+        if self.filter_job is not None:
+            self.window.after_cancel(self.filter_job)
+        self.filter_job = self.window.after(self.FILTER_DELAY, self.apply_filters)
+    
+    def apply_filters(self):
+        """Start over with the current filters"""
+        self.filter_job = None
+        status = self.status_var.get()
+        self.filters = (
+            self.source_var.get().strip() or None,
+            status if status in ('success', 'failure', 'info') else None,
+            self.text_var.get().strip() or None
+        )
+        self.offset = 0
+        self.selected = None
+        self.total = None
+        self.count_var.set("Searching...")
+        self._reload({})
+    
+    def refresh(self):
+        """Fetch again after new messages arrived, showing the old rows meanwhile"""
+        self._reload(self.blocks)
+    
+    def _reload(self, previous_blocks):
+        """Drop the cached blocks and request the count and the visible rows"""
+        self.generation += 1
+        self.previous_blocks = previous_blocks
+        self.blocks = collections.OrderedDict()
+        self.requested = set()
+        self.render()
+        self.counting = True
+        self.requests.put((self.generation, 'count', None, self.filters))
+    
+    def _request_block(self, block_index):
+        if block_index not in self.requested:
+            self.requested.add(block_index)
+            self.requests.put((self.generation, 'block', block_index, self.filters))
+    
+    def _wanted(self, block_index):
+        """Whether a block is still near the visible rows"""
+        first = self.offset // self.BLOCK_SIZE
+        last = (self.offset + self.visible) // self.BLOCK_SIZE
+        return first - 1 <= block_index <= last + 1
+    
+    def _record(self, index):
+        """Record at an index, None while it is being fetched, False past the end of the results"""
+        block_index, position = divmod(index, self.BLOCK_SIZE)
+        block = self.blocks.get(block_index)
+        if block is not None:
+            self.blocks.move_to_end(block_index)
+        else:
+            self._request_block(block_index)
+            block = self.previous_blocks.get(block_index)
+            if block is None:
+                return None
+        return block[position] if position < len(block) else False
+    
+    def _fetch(self):
+        """Background thread running the queries, skipping outdated ones"""
+        while True:
+            request = self.requests.get()
+            if request is None:
+                break
+            generation, kind, argument, filters = request
+            if generation is not None and generation != self.generation:
+                continue
+            try:
+                if kind == 'block':
+                    # Blocks scrolled past before their turn came are not fetched
+                    result = (self.history.query(argument * self.BLOCK_SIZE, self.BLOCK_SIZE, *filters)
+                              if self._wanted(argument) else None)
+                elif kind == 'count':
+                    result = self.history.count(*filters)
+                else:
+                    result = self.history.sources()
+            except sqlite3.Error as e:
+                kind, result = 'error', str(e)
+            self.results.put((generation, kind, argument, result))
+        self.history.release()
+    
+    def poll(self):
+        """Apply fetched results and check for new messages"""
+        changed = False
+        while True:
+            try:
+                generation, kind, argument, result = self.results.get_nowait()
+            except queue.Empty:
+                break
+            if kind == 'sources':
+                self.source_box.configure(values=[''] + result)
+                continue
+            if generation != self.generation:
+                continue
+            
+            if kind == 'block':
+                self.requested.discard(argument)
+                if result is not None:
+                    self.blocks[argument] = result
+                    while len(self.blocks) > self.CACHED_BLOCKS:
+                        self.blocks.popitem(last=False)
+                    changed = True
+            elif kind == 'count':
+                self.total = result
+                self.counting = False
+                self.count_var.set(f"{result:,} {'matching messages' if any(self.filters) else 'messages'}")
+                self.offset = max(0, min(self.offset, result - self.visible))
+                changed = True
+            else:
+                self.requested.discard(argument)
+                self.counting = False
+                self.count_var.set(f"Query failed: {result}")
+        if changed:
+            self.render()
+        
+        # A slow count is not restarted, or a busy server would keep it from ever finishing
+        if not self.counting and time.monotonic() - self.last_refresh >= self.REFRESH_INTERVAL:
+            self.last_refresh = time.monotonic()
+            if self.history.last_id != self.last_id:
+                self.last_id = self.history.last_id
+                self.refresh()
+        self.poll_job = self.window.after(self.POLL_INTERVAL, self.poll)
+    
+    def render(self):
+        """Fill the Treeview with the rows from offset on"""
+        self.tree.delete(*self.tree.get_children())
+        for index in range(self.offset, self.offset + self.visible):
+            if self.total is not None and index >= self.total:
+                break
+            record = self._record(index)
+            if record is False or (record is None and self.total is None):
+                break
+            if record is None:
+                self.tree.insert('', tk.END, iid=str(index), values=('', '', '', "Loading..."), tags=('loading',))
+                continue
+            
+            received = datetime.datetime.fromtimestamp(record['received']).strftime("%Y-%m-%d %H:%M:%S")
+            lines = record['message'].splitlines()
+            text = (lines[0] if lines else '')[:200]
+            if len(lines) > 1:
+                text += " …"
+            if record['attachments']:
+                text += f"  📎 {len(record['attachments'])}"
+            self.tree.insert('', tk.END, iid=str(index), values=(received, record['source'], record['status'], text),
+                             tags=(record['status'],))
+        
+        if self.selected is not None and self.tree.exists(str(self.selected)):
+            self.tree.selection_set(str(self.selected))
+        
+        # Prefetch the blocks next to the visible ones
+        if self.total:
+            first = self.offset // self.BLOCK_SIZE
+            last = min(self.offset + self.visible, self.total - 1) // self.BLOCK_SIZE
+            for block_index in (first - 1, last + 1):
+                if 0 <= block_index <= (self.total - 1) // self.BLOCK_SIZE and block_index not in self.blocks:
+                    self._request_block(block_index)
+        
+        if self.total:
+            self.scrollbar.set(self.offset / self.total, min(1.0, (self.offset + self.visible) / self.total))
+        else:
+            self.scrollbar.set(0.0, 1.0)
+    
+    def on_resize(self, event):
+        # One row's worth of height is taken by the headings
+        visible = max(1, event.height // self.row_height - 1)
+        if visible != self.visible:
+            self.visible = visible
+            self.scroll_to(self.offset, force=True)
+    
+    def scroll_to(self, offset, force=False):
+        """Show the rows from offset on"""
+        offset = max(0, min(offset, (self.total or 0) - self.visible))
+        if offset != self.offset or force:
+            self.offset = offset
+            self.render()
+    
+    def scroll_by(self, rows):
+        self.scroll_to(self.offset + rows)
+        return 'break'
+    
+    def on_scrollbar(self, *args):
+        """Scrollbar callback, 'moveto fraction' or 'scroll n units|pages'"""
+        if args[0] == 'moveto':
+            self.scroll_to(int(float(args[1]) * (self.total or 0)))
+        elif args[0] == 'scroll':
+            self.scroll_by(int(args[1]) * (self.visible if args[2] == 'pages' else 1))
+    
+    def select(self, index):
+        """Select the record at an index, scrolling it into view"""
+        if not self.total:
+            return 'break'
+        index = max(0, min(index, self.total - 1))
+        self.selected = index
+        if index < self.offset:
+            self.scroll_to(index, force=True)
+        elif index >= self.offset + self.visible:
+            self.scroll_to(index - self.visible + 1, force=True)
+        else:
+            self.render()
+        return 'break'
+    
+    def move_selection(self, rows):
+        if self.selected is None:
+            return self.select(self.offset)
+        return self.select(self.selected + rows)
+    
+    def on_select(self, event):
+        selection = self.tree.selection()
+        if selection:
+            self.selected = int(selection[0])
+    
+    def open_selected(self, event=None):
+        """Show the selected message with its attachments in a notification window"""
+        if self.selected is None:
+            return
+        record = self._record(self.selected)
+        if record:
+            NotificationWindow(record['message'], self.window, record['attachments'], self.thumbnails,
+                               record['received'])
+    
+    def is_open(self):
+        """Whether the window has not been closed yet"""
+        try:
+            return bool(self.window.winfo_exists())
+        except tk.TclError:
+            return False
+    
+    def close(self):
+        """Close the window and stop the query thread"""
+        if self.filter_job is not None:
+            self.window.after_cancel(self.filter_job)
+        if self.poll_job is not None:
+            self.window.after_cancel(self.poll_job)
+        self.requests.put(None)
+        if self.is_open():
+            self.window.destroy()
 
 class ServerGUI:
     """Server GUI Interface"""
-    def __init__(self, root):
+    def __init__(self, root, config_file=None):
         self.root = root
         self.root.title("NotifyPy Server")
         self.root.geometry("700x550")
@@ -341,7 +4116,21 @@ class ServerGUI:
         # self.root.iconbitmap("icon.ico")
         
         # Initialize configuration
-        self.config = ServerConfig()
+        self.config = ServerConfig(config_file)
+        
+        # Open notification windows, oldest first
+        self.notification_windows = []
+        self.history_browser = None
+        
+        # Pushbullet client, reused while the token stays the same
+        self.pushbullet = None
+        self.pushbullet_token = None
+        
+        # Attachment thumbnails, decoded once and shared by every window
+        cache_dir = self.config.config.get('thumbnail_cache_dir') or 'thumbnails'
+        if not os.path.isabs(cache_dir):
+            cache_dir = os.path.join(os.path.dirname(self.config.config_file), cache_dir)
+        self.thumbnails = ThumbnailCache(cache_dir, max_disk=self.config.config.get('thumbnail_cache_size', 0))
         
         # Create styles
         self.create_styles()
@@ -352,8 +4141,25 @@ class ServerGUI:
         # Initialize message receiver
         self.message_receiver = MessageReceiver(self.config, self)
         
+        # On-demand profiling via the Diagnostics menu, signals and the control socket
+        self.diagnostics = Diagnostics(self.config, self.message_receiver, self.add_log_message)
+        self.create_menu()
+        self.diagnostics.install_signal_handlers()
+        self.poll_signals()
+        self.control_server = None
+        path = control_socket_path(self.config)
+        if path:
+            self.control_server = ControlServer(path, self.diagnostics, self.add_log_message)
+            if not self.control_server.start():
+                self.control_server = None
+        
         # Auto-start server
         self.start_server()
+        
+        # Apply config file changes while running
+        self.config_watcher = ConfigWatcher(self.config, self.on_config_reloaded, self.add_log_message)
+        if self.config.config.get('watch_config', True):
+            self.config_watcher.start()
     
     def create_styles(self):
         """Create custom styles"""
@@ -473,7 +4279,16 @@ class ServerGUI:
             command=self.test_notification,
             width=15
         )
-        test_button.pack(side=tk.LEFT)
+        test_button.pack(side=tk.LEFT, padx=(0, 10))
+        
+        # Message history button
+        history_button = ttk.Button(
+            button_frame, 
+            text="Message History", 
+            command=self.show_history,
+            width=15
+        )
+        history_button.pack(side=tk.LEFT)
         
         # Log area
         log_frame = ttk.LabelFrame(main_container, text="Server Log", padding=15)
@@ -519,14 +4334,91 @@ class ServerGUI:
         self.host_entry = host_entry
         self.port_entry = port_entry
     
+    def create_menu(self):
+        """Create menu bar"""
+        menubar = tk.Menu(self.root)
+        view_menu = tk.Menu(menubar, tearoff=0)
+        view_menu.add_command(label="Message History", command=self.show_history)
+        menubar.add_cascade(label="View", menu=view_menu)
+        diagnostics_menu = tk.Menu(menubar, tearoff=0)
+        diagnostics_menu.add_command(label="Show Stats", command=self.show_stats)
+        diagnostics_menu.add_command(label="Dump Thread Stacks", command=lambda: self.run_diagnostic(self.diagnostics.dump_threads))
+        diagnostics_menu.add_separator()
+        diagnostics_menu.add_command(label="Start Profiler", command=lambda: self.run_diagnostic(self.diagnostics.start_profiler))
+        diagnostics_menu.add_command(label="Stop Profiler", command=lambda: self.run_diagnostic(self.diagnostics.stop_profiler))
+        diagnostics_menu.add_separator()
+        diagnostics_menu.add_command(label="Memory Snapshot", command=lambda: self.run_diagnostic(self.diagnostics.memory_snapshot))
+        diagnostics_menu.add_command(label="Stop Memory Tracing", command=lambda: self.run_diagnostic(self.diagnostics.stop_memory_tracing))
+        menubar.add_cascade(label="Diagnostics", menu=diagnostics_menu)
+        self.root.config(menu=menubar)
+    
+    def show_history(self):
+        """Open the message history browser, or raise it if it is already open"""
+        history = self.message_receiver.history
+        if history is None:
+            messagebox.showinfo("Message History", "Message history is disabled, set history_file in the config file")
+            return
+        
+        browser = self.history_browser
+        if browser is not None and browser.is_open() and browser.history is history:
+            browser.window.lift()
+            return
+        if browser is not None:
+            browser.close()
+        self.history_browser = HistoryBrowser(self.root, history, self.thumbnails)
+    
+    def run_diagnostic(self, action):
+        """Run a diagnostics action and report the result"""
+        try:
+            success, message = action()
+        except Exception as e:
+            success, message = False, f"Diagnostics failed: {str(e)}"
+        self.add_log_message(message)
+        self.update_status(message)
+        if not success:
+            messagebox.showwarning("Diagnostics", message)
+    
+    def show_stats(self):
+        """Show a summary of the server state"""
+        stats = self.diagnostics.stats()
+        lines = [
+            f"Uptime: {stats['uptime']:.0f}s",
+            f"Running: {stats['running']}",
+            f"Open connections: {len(stats['connections'])}",
+            f"Threads: {len(stats['threads'])}",
+            f"Notification windows alive: {stats['notification_windows']}",
+            f"Forwarding queue: {stats['forward_queue'] if stats['forward_queue'] is not None else 'off'}",
+            f"Digest buffered: {stats['digest_buffered'] if stats['digest_buffered'] is not None else 'off'}",
+            f"Profiling: {stats['profiling']}, tracing memory: {stats['tracing_memory']}"
+        ]
+        if 'rss_bytes' in stats:
+            lines.append(f"Memory (RSS): {stats['rss_bytes'] / 1048576:.1f} MB, open files: {stats['open_fds']}")
+        messagebox.showinfo("Server Stats", '\n'.join(lines))
+    
+    def poll_signals(self):
+        """Return to the interpreter periodically so signal handlers run while Tk is idle.
+        
+        Also refreshes the Tk statistics reported by the diagnostics, which
+        may only be read from this thread.
+        """
+        self.diagnostics.extra_stats = {
+            'tk_widgets': self.count_widgets(self.root),
+            'log_lines': int(self.log_text.index('end-1c').split('.')[0]) - 1,
+            'open_notification_windows': sum(1 for window in self.notification_windows if window.is_open()),
+            'thumbnail_cache': self.thumbnails.stats()
+        }
+        self.root.after(500, self.poll_signals)
+    
+    def count_widgets(self, widget):
+        """Number of Tk widgets below widget, including windows"""
+        return sum(1 + self.count_widgets(child) for child in widget.winfo_children())
+    
     def toggle_server(self):
         """Toggle server state"""
         if self.message_receiver.is_running:
             success, message = self.message_receiver.stop()
             if success:
                 self.server_state.set("Start Server")
-                self.host_entry.config(state=tk.NORMAL)
-                self.port_entry.config(state=tk.NORMAL)
                 self.status_indicator.itemconfig(1, fill="#cccccc")  # Gray indicates stopped
                 self.server_button.configure(style="TButton")
             else:
@@ -535,8 +4427,6 @@ class ServerGUI:
             success, message = self.message_receiver.start()
             if success:
                 self.server_state.set("Stop Server")
-                self.host_entry.config(state=tk.DISABLED)
-                self.port_entry.config(state=tk.DISABLED)
                 self.status_indicator.itemconfig(1, fill="#4CAF50")  # Green indicates running
                 self.server_button.configure(style="TButton")
             else:
@@ -551,8 +4441,6 @@ class ServerGUI:
             success, message = self.message_receiver.start()
             if success:
                 self.server_state.set("Stop Server")
-                self.host_entry.config(state=tk.DISABLED)
-                self.port_entry.config(state=tk.DISABLED)
                 self.status_indicator.itemconfig(1, fill="#4CAF50")  # Green indicates running
             else:
                 messagebox.showerror("Error", message)
@@ -571,6 +4459,9 @@ class ServerGUI:
             if port <= 0 or port > 65535:
                 raise ValueError("Invalid port range")
             
+            # Remember the current address to detect changes
+            old_address = (self.config.config['host'], self.config.config['port'])
+            
             # Update configuration
             self.config.config['host'] = host
             self.config.config['port'] = port
@@ -591,6 +4482,14 @@ class ServerGUI:
             # Save configuration
             if self.config.save_config():
                 message = "Settings saved"
+                
+                # Move a running server to the new address without stopping it
+                if self.message_receiver.is_running and (host, port) != old_address:
+                    success, rebind_message = self.message_receiver.rebind(host, port)
+                    self.add_log_message(rebind_message)
+                    if not success:
+                        messagebox.showerror("Error", rebind_message)
+                
                 messagebox.showinfo("Success", message)
                 
                 # Send test notification if Pushbullet is configured
@@ -613,16 +4512,29 @@ class ServerGUI:
         self.show_notification("This is a test notification message.\nIf you can see this message, the notification system is working properly!")
         self.add_log_message("Test notification sent")
     
-    def show_notification(self, message):
+    def show_notification(self, message, attachments=None):
         """Show notification"""
         # Create notification window
-        notification = NotificationWindow(message, self.root)
+        notification = NotificationWindow(message, self.root, attachments, self.thumbnails)
+        self.track_notification_window(notification)
         
         # Send Pushbullet notification if configured
         self.send_pushbullet_notification(message)
         
         # Log
         self.add_log_message(f"Showing notification: {message}")
+        for attachment in attachments or []:
+            self.add_log_message(f"Attachment {attachment['name']} ({attachment['size']} bytes) saved to {attachment['path']}")
+    
+    def track_notification_window(self, notification):
+        """Remember an open notification window, closing the oldest beyond max_notification_windows"""
+        # Drop windows the user already closed
+        self.notification_windows = [window for window in self.notification_windows if window.is_open()]
+        self.notification_windows.append(notification)
+        
+        limit = int(self.config.config.get('max_notification_windows', 0))
+        while limit and len(self.notification_windows) > limit:
+            self.notification_windows.pop(0).close()
     
     def update_status(self, message):
         """Update status bar"""
@@ -643,8 +4555,11 @@ class ServerGUI:
         self.add_log_message("正在尝试发送Pushbullet通知...")
         
         try:
-            # Create Pushbullet instance
-            pb = Pushbullet(token)
+            # Reuse the Pushbullet instance, creating one logs in and lists devices
+            if self.pushbullet is None or self.pushbullet_token != token:
+                self.pushbullet = Pushbullet(token)
+                self.pushbullet_token = token
+            pb = self.pushbullet
             
             # Get devices (for debugging)
             devices = pb.devices
@@ -696,24 +4611,141 @@ class ServerGUI:
         # Insert message
         self.log_text.insert(tk.END, log_entry)
         
+        # Drop the oldest lines beyond log_max_lines
+        max_lines = int(self.config.config.get('log_max_lines', 0))
+        if max_lines:
+            line_count = int(self.log_text.index('end-1c').split('.')[0]) - 1
+            if line_count > max_lines:
+                self.log_text.delete('1.0', f'{line_count - max_lines + 1}.0')
+        
         # Scroll to bottom
         self.log_text.see(tk.END)
         
         # Disable text box editing
         self.log_text.config(state=tk.DISABLED)
     
+    def on_config_reloaded(self, old_config, changed):
+        """Apply a reloaded config file to the running server and the settings form"""
+        success, message = self.message_receiver.apply_config(old_config, changed)
+        self.add_log_message(message)
+        
+        self.host_var.set(self.config.config['host'])
+        self.port_var.set(str(self.config.config['port']))
+        self.pushbullet_token_var.set(self.config.config.get('pushbullet_token', ''))
+    
     def on_closing(self):
         """Handle window closing"""
         if self.message_receiver.is_running:
-            if messagebox.askyesno("Confirm", "Server is running. Are you sure you want to exit?"):
-                self.message_receiver.stop()
-                self.root.destroy()
-        else:
-            self.root.destroy()
+            if not messagebox.askyesno("Confirm", "Server is running. Are you sure you want to exit?"):
+                return
+            self.message_receiver.stop()
+        
+        self.config_watcher.stop()
+        if self.control_server is not None:
+            self.control_server.stop()
+        if self.history_browser is not None:
+            self.history_browser.close()
+        self.message_receiver.close_history()
+        self.root.destroy()
+
+class HeadlessServer:
+    """Headless relay without a GUI, logs received messages to the console"""
+    def __init__(self, config_file=None):
+        # Initialize configuration
+        self.config = ServerConfig(config_file)
+        
+        # Initialize message receiver
+        self.message_receiver = MessageReceiver(self.config, self)
+        self.stop_event = threading.Event()
+    
+    def run(self):
+        """Start the server and block until interrupted"""
+        success, message = self.message_receiver.start()
+        self.add_log_message(message)
+        if not success:
+            return False
+        
+        # Apply config file changes while running
+        config_watcher = ConfigWatcher(self.config, self.on_config_reloaded, self.add_log_message)
+        if self.config.config.get('watch_config', True):
+            config_watcher.start()
+        
+        # Stop cleanly on SIGTERM as well as Ctrl+C
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop_event.set())
+        
+        # On-demand profiling via signals and the control socket
+        diagnostics = Diagnostics(self.config, self.message_receiver, self.add_log_message)
+        diagnostics.install_signal_handlers()
+        control_server = None
+        path = control_socket_path(self.config)
+        if path:
+            control_server = ControlServer(path, diagnostics, self.add_log_message)
+            if not control_server.start():
+                control_server = None
+        
+        try:
+            while not self.stop_event.wait(1.0):
+                pass
+        except KeyboardInterrupt:
+            pass
+        
+        config_watcher.stop()
+        if control_server is not None:
+            control_server.stop()
+        _, message = self.message_receiver.stop()
+        self.add_log_message(message)
+        self.message_receiver.close_history()
+        return True
+    
+    def on_config_reloaded(self, old_config, changed):
+        """Apply a reloaded config file to the running server"""
+        _, message = self.message_receiver.apply_config(old_config, changed)
+        self.add_log_message(message)
+    
+    def update_status(self, message):
+        """Status updates are only logged in headless mode"""
+        pass
+    
+    def show_notification(self, message, attachments=None):
+        """Show notification"""
+        self.add_log_message(f"Notification: {message}")
+        for attachment in attachments or []:
+            self.add_log_message(f"Attachment {attachment['name']} ({attachment['size']} bytes) saved to {attachment['path']}")
+    
+    def add_log_message(self, message):
+        """Add log message"""
+        timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
+        print(f"[{timestamp}] {message}", flush=True)
 
 def main():
+    # Required for worker processes in frozen (PyInstaller) builds
+    multiprocessing.freeze_support()
+    
+    parser = argparse.ArgumentParser(description='NotifyPy Server')
+    parser.add_argument('--headless', action='store_true', help='Run without GUI and log notifications to the console')
+    parser.add_argument('--config', metavar='PATH', help='Configuration file (default: server_config.json next to this script)')
+    parser.add_argument('--control', metavar='COMMAND',
+                        help='Send a diagnostics command to the running server and print the reply '
+                             '(stats, threads, profile start [interval_ms], profile stop, memory, memory stop)')
+    args = parser.parse_args()
+    
+    if args.control:
+        path = control_socket_path(ServerConfig(args.config))
+        if not path:
+            print("Control socket is disabled in server_config.json")
+            sys.exit(1)
+        try:
+            print(send_control_command(path, args.control))
+        except OSError as e:
+            print(f"Failed to reach the server control socket {path}: {str(e)}")
+            sys.exit(1)
+        sys.exit(0)
+    
+    if args.headless:
+        sys.exit(0 if HeadlessServer(args.config).run() else 1)
+    
     root = tk.Tk()
-    app = ServerGUI(root)
+    app = ServerGUI(root, args.config)
     root.mainloop()
 
 if __name__ == "__main__":
@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import csv
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.client
+import statistics
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(script_dir)
+import send
+from benchmark import BenchConfig
+from server import send_control_command
+
+# Metrics sampled from the server's control socket, with the growth allowed
+# between the first and last third of the run before it counts as a leak
+COUNT_LIMITS = {
+    'threads': 3,
+    'open_fds': 8,
+    'connections': 4,
+    'notification_windows': 5,
+    'open_notification_windows': 5,
+    'tk_widgets': 100,
+    'log_lines': 100,
+}
+
+class Traffic:
+    """Sends synthetic messages at a fixed rate and records their latency.
+    
+    Messages alternate between one-shot socket sends, high-priority
+    envelopes and POSTs over a keep-alive HTTP connection.
+    """
+    def __init__(self, port, http_port, rate):
+        self.sender = send.MessageSender(BenchConfig({'server_ip': '127.0.0.1', 'server_port': port}),
+                                         max_retries=0)
+        self.http_port = http_port
+        self.http = None
+        self.interval = 1.0 / rate
+        self.latencies = []
+        self.errors = 0
+        self.sent = 0
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+    
+    def start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+    
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+        if self.http is not None:
+            self.http.close()
+    
+    def take_latencies(self):
+        """Latencies in seconds recorded since the previous call, and the error count"""
+        with self.lock:
+            latencies, self.latencies = self.latencies, []
+            errors, self.errors = self.errors, 0
+        return latencies, errors
+    
+    def _post(self, message):
+        """POST a message over the keep-alive connection, reconnecting once if it was closed"""
+        for attempt in range(2):
+            if self.http is None:
+                self.http = http.client.HTTPConnection('127.0.0.1', self.http_port, timeout=5)
+            try:
+                self.http.request('POST', '/notify', body=message.encode('utf-8'),
+                                  headers={'Content-Type': 'text/plain; charset=utf-8'})
+                response = self.http.getresponse()
+                response.read()
+                return response.status == 200
+            except (OSError, http.client.HTTPException):
+                self.http.close()
+                self.http = None
+        return False
+    
+    def _run(self):
+        next_send = time.monotonic()
+        while not self.stop_event.is_set():
+            kind = self.sent % 3
+            message = f"soak message {self.sent}"
+            start = time.perf_counter()
+            if kind == 0:
+                success, _ = self.sender.send_message(message)
+            elif kind == 1:
+                success, _ = self.sender.send_message(message, priority='high')
+            else:
+                success = self._post(message)
+            elapsed = time.perf_counter() - start
+            
+            with self.lock:
+                if success:
+                    self.latencies.append(elapsed)
+                else:
+                    self.errors += 1
+            self.sent += 1
+            
+            next_send += self.interval
+            delay = next_send - time.monotonic()
+            if delay > 0:
+                self.stop_event.wait(delay)
+            else:
+                # Falling behind, do not try to catch up in a burst
+                next_send = time.monotonic()
+
+def start_server(directory, args):
+    """Start the server in a subprocess with a soak configuration, returns (process, control socket)"""
+    config_file = os.path.join(directory, 'server_config.json')
+    control_path = os.path.join(directory, 'control.sock')
+    with open(config_file, 'w', encoding='utf-8') as f:
+        json.dump({
+            'host': '127.0.0.1',
+            'port': args.port,
+            'http_port': args.http_port,
+            'max_connections': 128,
+            'ip_rate_limit': 0,
+            'control_socket': control_path,
+            'diagnostics_dir': os.path.join(directory, 'diagnostics'),
+            'watch_config': False,
+        }, f, indent=4)
+    
+    command = [sys.executable, os.path.join(script_dir, 'server.py'), '--config', config_file]
+    if not args.gui:
+        command.append('--headless')
+    elif not os.environ.get('DISPLAY'):
+        if shutil.which('xvfb-run') is None:
+            raise SystemExit("--gui needs a display or xvfb-run")
+        command = ['xvfb-run', '--auto-servernum'] + command
+    
+    log = open(args.server_log, 'w') if args.server_log else subprocess.DEVNULL
+    process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT)
+    
+    # Wait for the control socket, the server opens it before it starts listening
+    deadline = time.monotonic() + 30
+    while True:
+        if process.poll() is not None:
+            raise SystemExit(f"Server exited with status {process.returncode} during startup")
+        try:
+            if json.loads(send_control_command(control_path, 'stats', timeout=2))['running']:
+                return process, control_path
+        except (OSError, ValueError):
+            pass
+        if time.monotonic() > deadline:
+            process.kill()
+            raise SystemExit("Server did not start within 30 seconds")
+        time.sleep(0.2)
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a list of values"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def sample(control_path, traffic, started):
+    """One row of measurements"""
+    stats = json.loads(send_control_command(control_path, 'stats'))
+    latencies, errors = traffic.take_latencies()
+    row = {
+        'elapsed': round(time.monotonic() - started, 1),
+        'threads': len(stats['threads']),
+        'open_fds': stats.get('open_fds'),
+        'rss_mb': round(stats['rss_bytes'] / 1048576, 2) if 'rss_bytes' in stats else None,
+        'connections': len(stats['connections']),
+        'notification_windows': stats['notification_windows'],
+        'open_notification_windows': stats.get('open_notification_windows'),
+        'tk_widgets': stats.get('tk_widgets'),
+        'log_lines': stats.get('log_lines'),
+        'sent': traffic.sent,
+        'errors': errors,
+        'latency_p50_ms': None,
+        'latency_p99_ms': None,
+    }
+    if latencies:
+        row['latency_p50_ms'] = round(percentile(latencies, 0.5) * 1000, 3)
+        row['latency_p99_ms'] = round(percentile(latencies, 0.99) * 1000, 3)
+    return row
+
+def find_growth(rows, args):
+    """Compare the first and last third of the samples after warm-up, returns a list of failures"""
+    rows = [row for row in rows if row['elapsed'] >= args.warmup]
+    if len(rows) < 6:
+        return [f"Only {len(rows)} samples after warm-up, run longer to detect growth"]
+    third = len(rows) // 3
+    first, last = rows[:third], rows[-third:]
+    
+    def values(part, key):
+        return [row[key] for row in part if row[key] is not None]
+    
+    failures = []
+    for key, limit in COUNT_LIMITS.items():
+        before, after = values(first, key), values(last, key)
+        if before and after and max(after) > max(before) + limit:
+            failures.append(f"{key} grew from at most {max(before)} to {max(after)} (allowed +{limit})")
+    
+    before, after = values(first, 'rss_mb'), values(last, 'rss_mb')
+    if before and after:
+        growth = statistics.median(after) / statistics.median(before) - 1
+        if growth > args.rss_growth:
+            failures.append(f"RSS grew by {growth:.0%}, from {statistics.median(before):.1f} MB "
+                            f"to {statistics.median(after):.1f} MB (allowed {args.rss_growth:.0%})")
+    
+    before, after = values(first, 'latency_p99_ms'), values(last, 'latency_p99_ms')
+    if before and after and statistics.median(after) > statistics.median(before) * args.latency_growth:
+        failures.append(f"p99 latency grew from {statistics.median(before):.2f} ms "
+                        f"to {statistics.median(after):.2f} ms (allowed x{args.latency_growth:g})")
+    
+    errors = sum(row['errors'] for row in rows)
+    if errors > args.max_errors:
+        failures.append(f"{errors} messages failed after warm-up (allowed {args.max_errors})")
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the server under synthetic traffic and fail on resource growth')
+    parser.add_argument('--duration', type=float, default=3600, help='Seconds to run (default: one hour)')
+    parser.add_argument('--rate', type=float, default=20, help='Messages per second')
+    parser.add_argument('--interval', type=float, default=10, help='Seconds between samples')
+    parser.add_argument('--warmup', type=float, default=60, help='Seconds of samples ignored while caches fill')
+    parser.add_argument('--gui', action='store_true', help='Run the GUI server (under xvfb-run without a display)')
+    parser.add_argument('--port', type=int, default=5997, help='Socket port of the soak server')
+    parser.add_argument('--http-port', type=int, default=5996, help='HTTP port of the soak server')
+    parser.add_argument('--rss-growth', type=float, default=0.25, help='Allowed RSS growth as a fraction')
+    parser.add_argument('--latency-growth', type=float, default=3.0, help='Allowed p99 latency growth factor')
+    parser.add_argument('--max-errors', type=int, default=0, help='Allowed failed messages after warm-up')
+    parser.add_argument('--csv', help='Write the samples to this CSV file')
+    parser.add_argument('--server-log', help='Write the server output to this file')
+    args = parser.parse_args()
+    
+    with tempfile.TemporaryDirectory() as directory:
+        process, control_path = start_server(directory, args)
+        traffic = Traffic(args.port, args.http_port, args.rate)
+        rows = []
+        started = time.monotonic()
+        traffic.start()
+        try:
+            while time.monotonic() - started < args.duration:
+                time.sleep(min(args.interval, max(0.0, args.duration - (time.monotonic() - started))))
+                if process.poll() is not None:
+                    raise SystemExit(f"Server exited with status {process.returncode}")
+                row = sample(control_path, traffic, started)
+                rows.append(row)
+                print(f"[{row['elapsed']:>8.0f}s] threads={row['threads']} fds={row['open_fds']} "
+                      f"rss={row['rss_mb']}MB windows={row['notification_windows']} widgets={row['tk_widgets']} "
+                      f"p99={row['latency_p99_ms']}ms errors={row['errors']}", flush=True)
+        except KeyboardInterrupt:
+            print("Interrupted, analysing the samples collected so far")
+        finally:
+            traffic.stop()
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+    
+    if args.csv and rows:
+        with open(args.csv, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+    
+    failures = find_growth(rows, args)
+    if failures:
+        print("FAIL")
+        for failure in failures:
+            print(f"  {failure}")
+        sys.exit(1)
+    print(f"PASS: {traffic.sent} messages, no unbounded growth detected")
+
+if __name__ == "__main__":
+    main()
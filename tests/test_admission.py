@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import socket
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from server import Admission, serve_client, serve_http, REPLY_ACCEPTED, REPLY_UNAUTHORIZED, REPLY_THROTTLED
+
+CLIENT = ('192.0.2.1', 40000)
+
+def exchange(serve, payload, admission, delivered):
+    """Serve one connection from CLIENT and return everything the server sent back"""
+    client, server = socket.socketpair()
+    def deliver(message, source, options):
+        delivered.append((message, source))
+        return 'accepted'
+    thread = threading.Thread(target=lambda: (serve(server, CLIENT, deliver, admission=admission), server.close()))
+    thread.start()
+    client.sendall(payload)
+    client.shutdown(socket.SHUT_WR)
+    reply = b''
+    while True:
+        chunk = client.recv(65536)
+        if not chunk:
+            break
+        reply += chunk
+    thread.join(5)
+    client.close()
+    return reply.decode('utf-8')
+
+def envelope(*messages, token=None):
+    fields = {'notifypy': 1, 'messages': list(messages)}
+    if token is not None:
+        fields['token'] = token
+    return json.dumps(fields).encode('utf-8') + b'\n'
+
+def is_throttled(reply):
+    prefix, suffix = REPLY_THROTTLED.split('{}')
+    return reply.startswith(prefix) and reply.endswith(suffix)
+
+def test_rejected_tokens_do_not_drain_the_rate_limit():
+    admission = Admission({'auth_tokens': ['good'], 'ip_rate_limit': 0.01, 'ip_rate_burst': 2})
+    delivered = []
+    
+    for _ in range(5):
+        assert exchange(serve_client, envelope("spam", token="bad"), admission, delivered) == REPLY_UNAUTHORIZED
+    assert exchange(serve_client, envelope("one", "two", token="good"), admission, delivered) == REPLY_ACCEPTED
+    assert delivered == [("one", CLIENT), ("two", CLIENT)]
+    
+    # The burst is used up now, and a throttled request delivers nothing
+    assert is_throttled(exchange(serve_client, envelope("three", token="good"), admission, delivered))
+    assert len(delivered) == 2
+
+def test_a_batch_is_charged_per_message():
+    admission = Admission({'ip_rate_limit': 0.01, 'ip_rate_burst': 3})
+    delivered = []
+    
+    assert exchange(serve_client, envelope("a", "b"), admission, delivered) == REPLY_ACCEPTED
+    assert is_throttled(exchange(serve_client, envelope("c", "d"), admission, delivered))
+    assert exchange(serve_client, b"e", admission, delivered) == REPLY_ACCEPTED
+    assert [message for message, _ in delivered] == ["a", "b", "e"]
+
+def test_token_limit_applies_across_addresses():
+    admission = Admission({'token_rate_limit': 0.01, 'token_rate_burst': 1})
+    delivered = []
+    
+    assert exchange(serve_client, envelope("a", token="shared"), admission, delivered) == REPLY_ACCEPTED
+    assert is_throttled(exchange(serve_client, envelope("b", token="shared"), admission, delivered))
+    # Other tokens and clients without one have buckets of their own
+    assert exchange(serve_client, envelope("c", token="other"), admission, delivered) == REPLY_ACCEPTED
+    assert exchange(serve_client, b"d", admission, delivered) == REPLY_ACCEPTED
+
+def test_worker_share_divides_the_rates():
+    admission = Admission({'ip_rate_limit': 10, 'token_rate_limit': 4}, share=2)
+    assert admission.ip_limiter.rate == 5 and admission.token_limiter.rate == 2
+
+def http_post(body, token=None):
+    authorization = f"Authorization: Bearer {token}\r\n" if token else ""
+    return (f"POST /notify HTTP/1.1\r\nHost: test\r\nConnection: close\r\nContent-Type: application/json\r\n"
+            f"{authorization}Content-Length: {len(body)}\r\n\r\n").encode('latin-1') + body
+
+def test_http_admission():
+    admission = Admission({'auth_tokens': ['good'], 'ip_rate_limit': 0.01, 'ip_rate_burst': 2})
+    delivered = []
+    
+    reply = exchange(serve_http, http_post(b'["a"]', "bad"), admission, delivered)
+    assert reply.startswith("HTTP/1.1 401 ")
+    # A token in the body counts like the header
+    reply = exchange(serve_http, http_post(b'{"messages": ["a", "b"], "token": "good"}'), admission, delivered)
+    assert reply.startswith("HTTP/1.1 200 ")
+    
+    reply = exchange(serve_http, http_post(b'["c"]', "good"), admission, delivered)
+    assert reply.startswith("HTTP/1.1 429 ") and "\r\nRetry-After: " in reply
+    assert [message for message, _ in delivered] == ["a", "b"]
+
+def stream(token, *frames):
+    handshake = b'NOTIFYPY-STREAM/1' + (b' ' + token.encode('utf-8') if token else b'') + b'\n'
+    return handshake + b''.join(json.dumps(frame).encode('utf-8') + b'\n' for frame in frames)
+
+def frame(seq, *messages, source=None):
+    return {'seq': seq, 'messages': [{'message': message, 'source': source} if source else {'message': message}
+                                     for message in messages]}
+
+def test_stream_frames_are_rate_limited():
+    admission = Admission({'ip_rate_limit': 0.01, 'ip_rate_burst': 2})
+    delivered = []
+    
+    reply = exchange(serve_client, stream(None, frame(1, "a", "b"), frame(2, "c")), admission, delivered)
+    acks = [json.loads(line) for line in reply.splitlines()]
+    assert acks[0] == {'ack': 1, 'status': 'accepted'}
+    assert acks[1]['ack'] == 2 and acks[1]['status'] == 'throttled' and acks[1]['retry_after'] > 0
+    assert [message for message, _ in delivered] == ["a", "b"]
+
+def test_forward_token_streams_are_exempt_and_keep_sources():
+    admission = Admission({'ip_rate_limit': 0.01, 'ip_rate_burst': 1, 'forward_token': 'cluster'})
+    delivered = []
+    
+    frames = [frame(seq, f"m{seq}", source=['198.51.100.7', 5000]) for seq in range(1, 4)]
+    reply = exchange(serve_client, stream('cluster', *frames), admission, delivered)
+    assert [json.loads(line)['status'] for line in reply.splitlines()] == ['accepted'] * 3
+    assert delivered == [(f"m{seq}", ('198.51.100.7', 5000)) for seq in range(1, 4)]
+
+def test_other_streams_cannot_claim_a_source():
+    admission = Admission({'forward_token': 'cluster'})
+    delivered = []
+    
+    reply = exchange(serve_client, stream(None, frame(1, "spoofed", source=['198.51.100.7', 5000])), admission,
+                     delivered)
+    assert json.loads(reply) == {'ack': 1, 'status': 'accepted'}
+    assert delivered == [("spoofed", CLIENT)]
+
+def test_stream_handshake_checks_the_token():
+    admission = Admission({'auth_tokens': ['good']})
+    delivered = []
+    
+    assert exchange(serve_client, stream('bad', frame(1, "a")), admission, delivered) == REPLY_UNAUTHORIZED
+    assert delivered == []
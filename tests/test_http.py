@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import socket
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from server import serve_http, parse_http_body, HTTPError, HTTP_MAX_HEADER_SIZE
+
+class Recorder:
+    """deliver() stand-in that keeps every message it is given"""
+    def __init__(self, status='accepted'):
+        self.status = status
+        self.delivered = []
+    
+    def __call__(self, message, source, options):
+        self.delivered.append((message, options))
+        return self.status
+
+def exchange(request, deliver, max_body=1024):
+    """Send raw request bytes to serve_http() and return the parsed responses"""
+    client, server = socket.socketpair()
+    thread = threading.Thread(target=lambda: (serve_http(server, ('127.0.0.1', 1), deliver, max_body=max_body),
+                                              server.close()))
+    thread.start()
+    
+    # The server may answer and close before reading everything, as it does for oversize requests
+    try:
+        client.sendall(request)
+        client.shutdown(socket.SHUT_WR)
+    except OSError:
+        pass
+    data = b''
+    while True:
+        try:
+            chunk = client.recv(65536)
+        except ConnectionResetError:
+            break
+        if not chunk:
+            break
+        data += chunk
+    thread.join(5)
+    client.close()
+    
+    responses = []
+    while data:
+        head, _, data = data.partition(b'\r\n\r\n')
+        lines = head.decode('latin-1').split('\r\n')
+        headers = dict(line.split(': ', 1) for line in lines[1:])
+        length = int(headers['Content-Length'])
+        responses.append((int(lines[0].split()[1]), headers, json.loads(data[:length])))
+        data = data[length:]
+    return responses
+
+def post(body, content_type, extra=b''):
+    return (b'POST /notify HTTP/1.1\r\nHost: test\r\nConnection: close\r\nContent-Type: ' + content_type.encode()
+            + b'\r\nContent-Length: ' + str(len(body)).encode() + b'\r\n' + extra + b'\r\n' + body)
+
+def chunked(*chunks):
+    return b''.join(b'%x\r\n%s\r\n' % (len(chunk), chunk) for chunk in chunks) + b'0\r\n\r\n'
+
+def test_chunked_json_batch_is_reassembled():
+    deliver = Recorder()
+    body = json.dumps(["first", {"message": "second", "priority": "high"}]).encode('utf-8')
+    request = (b'POST /notify HTTP/1.1\r\nHost: test\r\nConnection: close\r\n'
+               b'Content-Type: application/json\r\nTransfer-Encoding: chunked\r\n\r\n'
+               + chunked(body[:7], body[7:20], body[20:]))
+    
+    [(status, _, payload)] = exchange(request, deliver)
+    assert status == 200 and payload == {'status': 'accepted', 'count': 2}
+    assert deliver.delivered == [("first", {}), ("second", {'priority': 'high'})]
+
+def test_keep_alive_serves_several_requests():
+    deliver = Recorder()
+    first = post(b"one", 'text/plain').replace(b'Connection: close', b'Connection: keep-alive')
+    
+    responses = exchange(first + post(b"two", 'text/plain'), deliver)
+    assert [status for status, _, _ in responses] == [200, 200]
+    assert responses[0][1]['Connection'] == 'keep-alive' and responses[1][1]['Connection'] == 'close'
+    assert deliver.delivered == [("one", {}), ("two", {})]
+
+def test_ndjson_lines_are_delivered_across_chunks():
+    deliver = Recorder()
+    body = b'"one"\n{"message": "two", "delay": 5}\n\n"three"\n'
+    request = (b'POST /notify HTTP/1.1\r\nHost: test\r\nConnection: close\r\n'
+               b'Content-Type: application/x-ndjson\r\nTransfer-Encoding: chunked\r\n\r\n'
+               + chunked(body[:3], body[3:25], body[25:]))
+    
+    [(status, _, payload)] = exchange(request, deliver)
+    assert status == 200 and payload == {'status': 'accepted', 'count': 3}
+    assert deliver.delivered == [("one", {}), ("two", {'delay': 5}), ("three", {})]
+
+@pytest.mark.parametrize('line', [b'{"message": 1}', b'{"message": '])
+def test_ndjson_stops_at_a_malformed_line(line):
+    deliver = Recorder()
+    request = post(b'"one"\n' + line + b'\n"three"\n', 'application/x-ndjson')
+    request = request.replace(b'Connection: close', b'Connection: keep-alive')
+    
+    # The rest of the body is not read, so the connection is not kept alive
+    [(status, headers, payload)] = exchange(request, deliver)
+    assert status == 400 and payload['error'].endswith('after 0 messages')
+    assert headers['Connection'] == 'close'
+    assert deliver.delivered == []
+
+def test_oversize_headers_are_refused():
+    deliver = Recorder()
+    request = post(b"hi", 'text/plain', b'X-Padding: ' + b'a' * HTTP_MAX_HEADER_SIZE + b'\r\n')
+    
+    [(status, headers, _)] = exchange(request, deliver)
+    assert status == 431 and headers['Connection'] == 'close'
+    assert deliver.delivered == []
+
+@pytest.mark.parametrize('chunked_body', [False, True])
+def test_oversize_body_is_refused_before_delivery(chunked_body):
+    deliver = Recorder()
+    body = b'x' * 2048
+    if chunked_body:
+        request = (b'POST /notify HTTP/1.1\r\nHost: test\r\nContent-Type: text/plain\r\n'
+                   b'Transfer-Encoding: chunked\r\n\r\n' + chunked(body[:1000], body[1000:]))
+    else:
+        request = post(body, 'text/plain')
+    
+    [(status, headers, _)] = exchange(request, deliver, max_body=1024)
+    assert status == 413 and headers['Connection'] == 'close'
+    assert deliver.delivered == []
+
+def test_schedule_statuses_map_to_http_statuses():
+    assert exchange(post(b"later", 'text/plain'), Recorder('duplicate'))[0][0] == 409
+    assert exchange(post(b"later", 'text/plain'), Recorder('full'))[0][0] == 503
+    status, headers, _ = exchange(post(b"later", 'text/plain'), Recorder('throttled'))[0]
+    assert status == 429 and headers['Retry-After'] == '1'
+
+def test_form_body_fields():
+    body = b'message=first&message=second+line&priority=high&delay=5&token=secret&unknown=1'
+    items, token = parse_http_body(body, 'application/x-www-form-urlencoded')
+    assert items == [("first", {'priority': 'high', 'delay': '5'}), ("second line", {'priority': 'high', 'delay': '5'})]
+    assert token == 'secret'
+    
+    # Without a message field the whole body is the message, as curl -d "text" sends it
+    assert parse_http_body(b'disk full', 'application/x-www-form-urlencoded') == ([("disk full", {})], None)
+
+@pytest.mark.parametrize('body', [b'{"messages": "abc"}', b'{"message": 123}', b'[1, 2]', b'"text"', b'{"message": '])
+def test_invalid_json_bodies_are_bad_requests(body):
+    with pytest.raises(HTTPError) as error:
+        parse_http_body(body, 'application/json')
+    assert error.value.status == 400
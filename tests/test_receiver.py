@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import socket
+import threading
+import http.client
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from server import (HeadlessServer, REPLY_ACCEPTED, REPLY_QUEUED, REPLY_EXPIRED, REPLY_SCHEDULE_FULL,
+                    REPLY_SCHEDULE_ID_TAKEN, REPLY_CANCELLED, REPLY_NOT_SCHEDULED)
+
+# stop() and start() only wait on the self-pipe wake-up, never on a poll interval
+LIFECYCLE_LIMIT = 0.25
+
+@pytest.fixture
+def server(tmp_path):
+    """Headless server on an ephemeral loopback port with no files besides its config"""
+    config_file = tmp_path / 'server_config.json'
+    config_file.write_text(json.dumps({
+        'host': '127.0.0.1',
+        'port': 0,
+        'schedule_file': '',
+        'history_file': '',
+        'control_socket': '',
+        'watch_config': False,
+    }), encoding='utf-8')
+    server = HeadlessServer(str(config_file))
+    yield server
+    server.message_receiver.stop()
+    server.message_receiver.close_history()
+
+def listening_port(receiver):
+    return receiver.server_socket.getsockname()[1]
+
+def send(port, message, sock=None):
+    """Send one plain message and return the reply"""
+    sock = sock or socket.create_connection(('127.0.0.1', port), timeout=5)
+    with sock:
+        sock.sendall(message.encode('utf-8'))
+        return sock.recv(1024).decode('utf-8')
+
+def timed(func, *args):
+    started = time.monotonic()
+    result = func(*args)
+    return result, time.monotonic() - started
+
+def test_stop_and_start_complete_in_milliseconds(server):
+    receiver = server.message_receiver
+    
+    (success, message), elapsed = timed(receiver.start)
+    assert success, message
+    assert elapsed < LIFECYCLE_LIMIT
+    assert send(listening_port(receiver), "before restart") == REPLY_ACCEPTED
+    
+    (success, message), elapsed = timed(receiver.stop)
+    assert success, message
+    assert elapsed < LIFECYCLE_LIMIT
+    assert not receiver.listen_thread
+    
+    (success, message), elapsed = timed(receiver.start)
+    assert success, message
+    assert elapsed < LIFECYCLE_LIMIT
+    assert send(listening_port(receiver), "after restart") == REPLY_ACCEPTED
+
+def test_stop_lets_in_flight_connection_finish(server):
+    receiver = server.message_receiver
+    receiver.start()
+    port = listening_port(receiver)
+    
+    # Accepted before stop(), but the message only arrives while stop() is draining
+    client = socket.create_connection(('127.0.0.1', port), timeout=5)
+    deadline = time.monotonic() + 5
+    while not len(receiver.clients) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    
+    result = []
+    stopping = threading.Thread(target=lambda: result.append(timed(receiver.stop)))
+    stopping.start()
+    time.sleep(0.05)
+    assert send(port, "in flight", client) == REPLY_ACCEPTED
+    stopping.join(timeout=5)
+    
+    (success, message), elapsed = result[0]
+    assert success, message
+    assert elapsed < LIFECYCLE_LIMIT
+
+def test_rebind_hands_over_queued_connections(server):
+    receiver = server.message_receiver
+    receiver.start()
+    old_port = listening_port(receiver)
+    
+    # Queued on the old socket's backlog while the listener moves
+    queued = socket.create_connection(('127.0.0.1', old_port), timeout=5)
+    
+    (success, message), elapsed = timed(receiver.rebind, '127.0.0.1', 0)
+    assert success, message
+    assert elapsed < LIFECYCLE_LIMIT
+    new_port = listening_port(receiver)
+    assert new_port != old_port
+    
+    assert send(old_port, "queued before rebind", queued) == REPLY_ACCEPTED
+    assert send(new_port, "after rebind") == REPLY_ACCEPTED
+    with pytest.raises(ConnectionRefusedError):
+        socket.create_connection(('127.0.0.1', old_port), timeout=5).close()
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def test_idle_http_keep_alive_is_not_a_stream(server):
+    receiver = server.message_receiver
+    http_port = receiver.config.config['http_port'] = free_port()
+    receiver.start()
+    
+    connection = http.client.HTTPConnection('127.0.0.1', http_port, timeout=5)
+    connection.request('POST', '/notify', body="keep-alive".encode('utf-8'), headers={'Content-Type': 'text/plain'})
+    response = connection.getresponse()
+    assert response.status == 200
+    response.read()
+    
+    # Waiting for its next request, the connection is idle rather than a stream
+    deadline = time.monotonic() + 5
+    while not any(info['idle'] for info in receiver.get_client_stats()) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    [info] = receiver.get_client_stats()
+    assert info['idle'] and not info['stream']
+    
+    # and stop() closes it right away instead of waiting out drain_timeout
+    (success, message), elapsed = timed(receiver.stop)
+    assert success, message
+    assert elapsed < LIFECYCLE_LIMIT
+    connection.close()
+
+def send_envelope(port, **envelope):
+    """Send one JSON envelope and return the reply"""
+    with socket.create_connection(('127.0.0.1', port), timeout=5) as sock:
+        sock.sendall(json.dumps(dict(notifypy=1, **envelope)).encode('utf-8') + b'\n')
+        return sock.recv(1024).decode('utf-8')
+
+def test_worker_processes_report_delivery_statuses(server):
+    receiver = server.message_receiver
+    receiver.config.config.update({'workers': 2, 'max_scheduled': 2})
+    port = free_port()
+    success, message = receiver.start('127.0.0.1', port)
+    assert success, message
+    
+    # Workers wait for the delivery process instead of accepting everything
+    assert send_envelope(port, cancel="doesnotexist") == REPLY_NOT_SCHEDULED
+    assert send_envelope(port, message="later", delay=60, schedule_id="first") == REPLY_QUEUED
+    # Another sender cannot replace a pending message by reusing its id
+    assert send_envelope(port, message="hijacked", delay=1, schedule_id="first") == REPLY_SCHEDULE_ID_TAKEN
+    assert send_envelope(port, message="later", delay=60, schedule_id="second") == REPLY_QUEUED
+    assert send_envelope(port, message="later", delay=60, schedule_id="third") == REPLY_SCHEDULE_FULL
+    assert send_envelope(port, message="stale", expire_at=1) == REPLY_EXPIRED
+    assert send_envelope(port, cancel="first") == REPLY_CANCELLED
+    assert send_envelope(port, cancel="first") == REPLY_NOT_SCHEDULED
+    assert send(port, "now") == REPLY_ACCEPTED
+
+def test_only_the_sender_can_cancel_a_scheduled_message(server):
+    receiver = server.message_receiver
+    success, message = receiver.start('127.0.0.1', 0)
+    assert success, message
+    port = listening_port(receiver)
+    
+    assert send_envelope(port, message="later", delay=60, schedule_id="mine", token="alice") == REPLY_QUEUED
+    # Someone else cannot tell the id from a missing one, let alone cancel it
+    assert send_envelope(port, cancel="mine", token="mallory") == REPLY_NOT_SCHEDULED
+    assert send_envelope(port, cancel="mine") == REPLY_NOT_SCHEDULED
+    assert send_envelope(port, cancel="mine", token="alice") == REPLY_CANCELLED
+    
+    # Without a token the sender's address owns the message
+    assert send_envelope(port, message="later", delay=60, schedule_id="anonymous") == REPLY_QUEUED
+    assert send_envelope(port, cancel="anonymous", token="mallory") == REPLY_NOT_SCHEDULED
+    assert send_envelope(port, cancel="anonymous") == REPLY_CANCELLED
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from server import DeliveryScheduler
+
+SOURCE = ('192.0.2.1', 40000)
+
+def journal_line(op, schedule_id, due=None, expire_at=None, message="later"):
+    if op == 'remove':
+        return json.dumps({'op': 'remove', 'id': schedule_id}) + '\n'
+    return json.dumps({'op': 'add', 'id': schedule_id, 'due': due, 'expire_at': expire_at, 'message': message,
+                       'source': list(SOURCE), 'options': {}}) + '\n'
+
+def started(path, deliver=None, **kwargs):
+    scheduler = DeliveryScheduler(deliver or (lambda message, source, options: None), str(path), **kwargs)
+    scheduler.start()
+    return scheduler
+
+def wait_loaded(scheduler):
+    deadline = time.monotonic() + 10
+    while scheduler.loading and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert not scheduler.loading
+
+def test_replay_restores_pending_messages(tmp_path):
+    path = tmp_path / 'scheduled.jsonl'
+    later = time.time() + 3600
+    path.write_text(journal_line('add', 'kept', later) + journal_line('add', 'cancelled', later)
+                    + journal_line('remove', 'cancelled') + journal_line('add', 'moved', later)
+                    + journal_line('add', 'moved', later + 60, message="moved later"), encoding='utf-8')
+    
+    scheduler = started(path)
+    wait_loaded(scheduler)
+    try:
+        assert sorted(scheduler.entries) == ['kept', 'moved']
+        assert scheduler.entries['moved']['message'] == "moved later"
+    finally:
+        scheduler.stop()
+
+def test_replay_survives_a_torn_line_and_compacts_it(tmp_path):
+    path = tmp_path / 'scheduled.jsonl'
+    later = time.time() + 3600
+    path.write_text(journal_line('add', 'kept', later) + journal_line('add', 'torn', later)[:30], encoding='utf-8')
+    
+    scheduler = started(path)
+    wait_loaded(scheduler)
+    assert scheduler.add('new', later, None, "new", SOURCE, {}) == 'queued'
+    scheduler.stop()
+    
+    records = [json.loads(line) for line in path.read_text(encoding='utf-8').splitlines()]
+    assert [record['id'] for record in records] == ['kept', 'new']
+
+def test_messages_due_while_stopped_are_delivered_unless_expired(tmp_path):
+    path = tmp_path / 'scheduled.jsonl'
+    now = time.time()
+    path.write_text(journal_line('add', 'due', now - 60, message="missed") +
+                    journal_line('add', 'expired', now - 60, expire_at=now - 30, message="stale"), encoding='utf-8')
+    
+    delivered = []
+    done = threading.Event()
+    scheduler = started(path, lambda message, source, options: (delivered.append((message, source)), done.set()))
+    try:
+        assert done.wait(5)
+        time.sleep(0.1)
+        assert delivered == [("missed", SOURCE)]
+    finally:
+        scheduler.stop()
+    
+    # Both are journaled as done, a restart delivers nothing again
+    scheduler = started(path)
+    wait_loaded(scheduler)
+    assert len(scheduler) == 0
+    scheduler.stop()
+
+def test_ids_in_the_unloaded_journal_are_taken(tmp_path):
+    path = tmp_path / 'scheduled.jsonl'
+    later = time.time() + 3600
+    with open(path, 'w', encoding='utf-8') as f:
+        for number in range(50000):
+            f.write(journal_line('add', f"filler-{number}", later))
+        f.write(journal_line('add', 'last', later, message="original"))
+    
+    scheduler = started(path)
+    try:
+        # Called before the journal has been read, but it must still see the pending message
+        assert scheduler.add('last', later, None, "replacement", SOURCE, {}) == 'duplicate'
+        assert scheduler.entries['last']['message'] == "original"
+        assert scheduler.cancel('filler-49999')
+        assert not scheduler.cancel('filler-49999')
+        assert len(scheduler) == 50000
+    finally:
+        scheduler.stop()
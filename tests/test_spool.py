@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import socket
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from server import AttachmentSpool
+
+def receive(spool, *attachments):
+    """Spool attachments given as (name, data) pairs the way serve_client() reads them"""
+    client, server = socket.socketpair()
+    with client, server:
+        client.sendall(b''.join(data for _, data in attachments))
+        return spool.receive(server, b'', spool.validate([{'name': name, 'size': len(data)}
+                                                            for name, data in attachments]))
+
+def test_prune_removes_the_oldest_files(tmp_path):
+    spool = AttachmentSpool(str(tmp_path), max_total=2500)
+    [old] = receive(spool, ('old.bin', b'a' * 1000))
+    os.utime(old['path'], (1, 1))
+    [kept] = receive(spool, ('kept.bin', b'b' * 1000))
+    [new] = receive(spool, ('new.bin', b'c' * 1000))
+    
+    assert not os.path.exists(old['path'])
+    assert os.path.exists(kept['path']) and os.path.exists(new['path'])
+
+def test_attachments_larger_than_the_spool_are_kept_until_the_next_one(tmp_path):
+    spool = AttachmentSpool(str(tmp_path), max_total=1000)
+    [large] = receive(spool, ('large.bin', b'a' * 4000))
+    assert os.path.getsize(large['path']) == 4000
+    
+    [small] = receive(spool, ('small.bin', b'b' * 10))
+    assert not os.path.exists(large['path']) and os.path.exists(small['path'])
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import hashlib
+import threading
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from server import ThumbnailCache
+
+def spooled_image(directory, size=(1600, 1200)):
+    """An image attachment as AttachmentSpool.receive() describes it"""
+    path = os.path.join(directory, 'photo.png')
+    Image.new('RGB', size, 'red').save(path)
+    with open(path, 'rb') as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    return {'name': 'photo.png', 'path': path, 'size': os.path.getsize(path), 'sha256': digest}
+
+def test_get_async_decodes_off_the_calling_thread(tmp_path):
+    cache = ThumbnailCache(str(tmp_path / 'thumbnails'))
+    attachment = spooled_image(str(tmp_path))
+    
+    done = threading.Event()
+    results = []
+    def callback(image):
+        results.append((image, threading.current_thread()))
+        done.set()
+    
+    assert cache.get_async(attachment, callback) is None
+    assert done.wait(5)
+    image, thread = results[0]
+    assert thread is not threading.current_thread()
+    assert image.size[0] <= cache.size[0] and image.size[1] <= cache.size[1]
+    
+    # Once decoded, the thumbnail is returned right away without a callback
+    assert cache.get_async(attachment, callback) is image
+    assert len(results) == 1
+    assert cache.stats()['decoded'] == 1
+
+def test_get_async_reports_non_images(tmp_path):
+    cache = ThumbnailCache(str(tmp_path / 'thumbnails'))
+    path = tmp_path / 'notes.txt'
+    path.write_text("not an image", encoding='utf-8')
+    attachment = {'name': 'notes.txt', 'path': str(path), 'size': 12, 'sha256': 'ab' * 32}
+    
+    done = threading.Event()
+    results = []
+    assert cache.get_async(attachment, lambda image: (results.append(image), done.set())) is None
+    assert done.wait(5)
+    assert results == [None]